@@ -0,0 +1,190 @@
+"""Byte-budgeted LRU cache of per-album search state.
+
+Each cached album holds its AlbumEncodings, FAISS index and (numpy fallback)
+search matrix. Every entry's footprint is measured from the actual arrays and
+index sizes, and once the total exceeds the budget the least recently used
+albums are dropped; the next search reloads them from the store.
+
+Search counts per album are kept in a small JSON file so the hottest albums
+can be loaded again right after a restart.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, Counter
+
+from embedding_store import temp_path
+
+ALBUM_CACHE_MAX_MB = int(os.environ.get('ALBUM_CACHE_MAX_MB', 2048))
+PREWARM_ALBUMS = int(os.environ.get('PREWARM_ALBUMS', 0))  # hottest albums to load at startup
+HOT_ALBUMS_SAVE_INTERVAL = 60
+
+HOT_ALBUMS_FILE = 'hot_albums.json'
+
+
+class AlbumCache:
+    """Album ids are keyed as strings, so '7' from a URL and 7 from a JSON body share an entry"""
+
+    def __init__(self, max_bytes, sizeof, hot_path=None):
+        """``sizeof(encodings, index, matrix)`` returns the resident bytes of one entry"""
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._hot_path = hot_path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # album_id -> {'encodings', 'index', 'matrix', 'nbytes'}, LRU first
+        self._bytes = 0
+        self._searches = Counter(self._read_hot_albums())
+        self._searches_saved_at = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, album_id):
+        """Cached (encodings, index, matrix) or None; counts a hit or miss and marks the album used"""
+        album_id = str(album_id)
+        with self._lock:
+            entry = self._entries.get(album_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(album_id)
+            return entry['encodings'], entry['index'], entry['matrix']
+
+    def peek(self, album_id):
+        """Like ``get`` without touching stats or recency"""
+        album_id = str(album_id)
+        with self._lock:
+            entry = self._entries.get(album_id)
+            return None if entry is None else (entry['encodings'], entry['index'], entry['matrix'])
+
+    def __contains__(self, album_id):
+        album_id = str(album_id)
+        with self._lock:
+            return album_id in self._entries
+
+    def put(self, album_id, encodings, index=None, matrix=None):
+        """Insert or replace an album's whole entry"""
+        album_id = str(album_id)
+        with self._lock:
+            entry = self._entries.pop(album_id, None)
+            if entry is not None:
+                self._bytes -= entry['nbytes']
+            self._entries[album_id] = self._entry(encodings, index, matrix)
+            self._bytes += self._entries[album_id]['nbytes']
+            self._evict(keep=album_id)
+
+    def update(self, album_id, generation=None, **fields):
+        """Replace some fields ('encodings', 'index', 'matrix') of a cached album.
+
+        With ``generation``, only applies if the cached encodings are still of
+        that store generation. Returns False if nothing was updated.
+        """
+        album_id = str(album_id)
+        with self._lock:
+            entry = self._entries.get(album_id)
+            if entry is None:
+                return False
+            if generation is not None and entry['encodings'].generation != generation:
+                return False
+            entry.update(fields)
+            self._resize(album_id)
+            self._evict(keep=album_id)
+            return True
+
+    def resize(self, album_id):
+        """Re-measure an entry after its index was modified in place"""
+        album_id = str(album_id)
+        with self._lock:
+            if album_id in self._entries:
+                self._resize(album_id)
+                self._evict(keep=album_id)
+
+    def pop(self, album_id):
+        album_id = str(album_id)
+        with self._lock:
+            entry = self._entries.pop(album_id, None)
+            if entry is not None:
+                self._bytes -= entry['nbytes']
+            return entry is not None
+
+    def items(self):
+        """Snapshot of [(album_id, encodings, index, matrix)]"""
+        with self._lock:
+            return [(album_id, e['encodings'], e['index'], e['matrix']) for album_id, e in self._entries.items()]
+
+    def _entry(self, encodings, index, matrix):
+        return {'encodings': encodings, 'index': index, 'matrix': matrix,
+                'nbytes': self._sizeof(encodings, index, matrix)}
+
+    def _resize(self, album_id):
+        entry = self._entries[album_id]
+        nbytes = self._sizeof(entry['encodings'], entry['index'], entry['matrix'])
+        self._bytes += nbytes - entry['nbytes']
+        entry['nbytes'] = nbytes
+
+    def _evict(self, keep):
+        """Drop least recently used albums until within budget (never ``keep`` itself)"""
+        while self._bytes > self.max_bytes:
+            victim = next((album_id for album_id in self._entries if album_id != keep), None)
+            if victim is None:
+                return
+            self._bytes -= self._entries.pop(victim)['nbytes']
+            self.evictions += 1
+            print(f"♻️ Evicted album {victim} from cache ({self._bytes / 2 ** 20:.0f} MB in use)")
+
+    # Hot album tracking
+
+    def record_search(self, album_id):
+        album_id = str(album_id)
+        with self._lock:
+            self._searches[album_id] += 1
+            due = time.time() - self._searches_saved_at >= HOT_ALBUMS_SAVE_INTERVAL
+            if due:
+                self._searches_saved_at = time.time()
+                snapshot = dict(self._searches)
+        if due:
+            self._write_hot_albums(snapshot)
+
+    def hot_albums(self, limit):
+        with self._lock:
+            return [album_id for album_id, _ in self._searches.most_common(limit)]
+
+    def _read_hot_albums(self):
+        if not self._hot_path or not os.path.exists(self._hot_path):
+            return {}
+        try:
+            with open(self._hot_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_hot_albums(self, searches):
+        if not self._hot_path:
+            return
+        try:
+            tmp_path = temp_path(self._hot_path)
+            with open(tmp_path, 'w') as f:
+                json.dump(searches, f)
+            os.replace(tmp_path, self._hot_path)
+        except OSError as e:
+            print(f"⚠️ Could not save hot albums: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'albums': len(self._entries),
+                'size_mb': round(self._bytes / 2 ** 20, 1),
+                'max_mb': round(self.max_bytes / 2 ** 20, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'album_sizes_mb': {album_id: round(e['nbytes'] / 2 ** 20, 2) for album_id, e in self._entries.items()}
+            }
@@ -0,0 +1,204 @@
+"""FAISS index construction, tuning and persistence.
+
+Albums below ``ANN_MIN_FACES`` use an exact ``IndexFlatIP``. Larger albums
+use an approximate index (HNSW or IVF-PQ, see ``ANN_INDEX_TYPE``). Every
+index is wrapped in ``IndexIDMap2`` keyed by store row number, so appends and
+removals map directly onto the embedding store.
+
+Approximate indexes are expensive to train, so they are persisted next to the
+encodings (``album_<id>/index.faiss`` + ``index.json``) together with the
+store generation they were built from; a restart reuses them as long as the
+store has not changed since.
+
+With EMBEDDING_PRECISION (quantization.py) below float32, flat and HNSW
+indexes keep their vectors as float16 / int8 scalar-quantized codes, or as PQ
+codes for flat indexes of at least PQ_MIN_FACES faces (smaller albums, and HNSW
+graphs, use int8). Such indexes are persisted as well, tagged with the
+precision they were built at.
+"""
+import os
+import json
+import numpy as np
+
+import faiss
+
+from embedding_store import get_album_dir, temp_path
+from quantization import configured_precision, rerank_margin as precision_margin
+
+# Index selection
+ANN_MIN_FACES = int(os.environ.get('ANN_MIN_FACES', 50000))
+ANN_INDEX_TYPE = os.environ.get('ANN_INDEX_TYPE', 'hnsw')  # 'hnsw' or 'ivfpq'
+
+# HNSW knobs
+HNSW_M = int(os.environ.get('HNSW_M', 32))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('HNSW_EF_CONSTRUCTION', 80))
+HNSW_EF_SEARCH = int(os.environ.get('HNSW_EF_SEARCH', 128))
+
+# IVF-PQ knobs (IVF_NLIST=0 picks ~4*sqrt(n) lists)
+IVF_NLIST = int(os.environ.get('IVF_NLIST', 0))
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 16))
+PQ_M = int(os.environ.get('PQ_M', 64))
+PQ_NBITS = 8
+IVF_TRAIN_SAMPLE = int(os.environ.get('IVF_TRAIN_SAMPLE', 100000))
+# PQ codebooks need ~39 training faces per centroid (2^PQ_NBITS of them)
+PQ_MIN_FACES = int(os.environ.get('PQ_MIN_FACES', 10000))
+
+INDEX_FILE = 'index.faiss'
+INDEX_META_FILE = 'index.json'
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivfpq')
+SQ_TYPES = {'float16': faiss.ScalarQuantizer.QT_fp16, 'int8': faiss.ScalarQuantizer.QT_8bit}
+
+
+def choose_index_type(num_faces):
+    """Exact search below ANN_MIN_FACES, the configured ANN type above it"""
+    if num_faces < ANN_MIN_FACES:
+        return 'flat'
+    return ANN_INDEX_TYPE if ANN_INDEX_TYPE in INDEX_TYPES else 'hnsw'
+
+def _inner_index(index):
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+def index_type_of(index):
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivfpq'
+    return 'flat'
+
+def index_precision(index):
+    """'float32', 'float16', 'int8' or 'pq': how the index stores its vectors"""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return 'pq'
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return 'float16' if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'int8'
+    return 'float32'
+
+def rerank_margin(index):
+    """Re-ranking margin for hits of this index (0 when its scores are exact)"""
+    return 0.0 if index is None else precision_margin(index_precision(index))
+
+def index_nbytes(index):
+    """Approximate resident bytes of an index (vectors/codes, graph links, id maps)"""
+    inner = _inner_index(index)
+    ntotal = int(index.ntotal)
+    nbytes = 0
+    if isinstance(index, faiss.IndexIDMap):
+        nbytes += ntotal * 8
+        if isinstance(index, faiss.IndexIDMap2):
+            nbytes += ntotal * 48  # reverse id -> row hash map
+    if isinstance(inner, faiss.IndexHNSW):
+        storage = faiss.downcast_index(inner.storage)
+        nbytes += ntotal * storage.code_size + inner.hnsw.neighbors.size() * 4 + ntotal * 16
+    elif isinstance(inner, faiss.IndexIVF):
+        nbytes += ntotal * (inner.code_size + 8) + inner.nlist * inner.d * 4
+        if isinstance(inner, faiss.IndexIVFPQ):
+            nbytes += inner.pq.centroids.size() * 4
+    else:
+        nbytes += ntotal * inner.code_size
+        if isinstance(inner, faiss.IndexPQ):
+            nbytes += inner.pq.centroids.size() * 4
+    return nbytes
+
+def supports_remove(index):
+    """HNSW graphs cannot delete; removed rows are filtered at search time instead"""
+    return index_type_of(index) != 'hnsw'
+
+def apply_search_params(index, nprobe=None, ef_search=None):
+    """Set the recall/latency knobs of an approximate index (no-op for flat)"""
+    inner = _inner_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search or HNSW_EF_SEARCH
+    elif isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe or IVF_NPROBE
+
+def _create_index(index_type, dim, num_faces, precision):
+    if index_type == 'hnsw':
+        if precision == 'float32':
+            inner = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            inner = faiss.IndexHNSWSQ(dim, SQ_TYPES.get(precision, SQ_TYPES['int8']), HNSW_M,
+                                      faiss.METRIC_INNER_PRODUCT)
+        inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return inner
+    if index_type == 'ivfpq':
+        nlist = IVF_NLIST or max(1, int(4 * np.sqrt(num_faces)))
+        quantizer = faiss.IndexFlatIP(dim)
+        return faiss.IndexIVFPQ(quantizer, dim, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    if precision == 'pq' and num_faces >= PQ_MIN_FACES:
+        return faiss.IndexPQ(dim, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    if precision != 'float32':
+        return faiss.IndexScalarQuantizer(dim, SQ_TYPES.get(precision, SQ_TYPES['int8']), faiss.METRIC_INNER_PRODUCT)
+    return faiss.IndexFlatIP(dim)
+
+def build_index(album, index_type=None, precision=None):
+    """Build (and train, if needed) an ID-mapped index over the album's live rows.
+
+    ``index_type`` defaults to ``choose_index_type(len(album))`` and
+    ``precision`` to EMBEDDING_PRECISION. Training an approximate index can
+    take a while on big albums; callers run it off the request path.
+    """
+    if len(album) == 0:
+        return None
+    index_type = index_type or choose_index_type(len(album))
+    precision = precision or configured_precision()
+
+    if len(album.deleted_rows):
+        rows = album.live_rows()
+        vectors = np.ascontiguousarray(album.embeddings[rows])
+    else:
+        rows = np.arange(album.num_rows, dtype=np.int64)
+        vectors = album.embeddings
+
+    inner = _create_index(index_type, album.dim, len(rows), precision)
+    if not inner.is_trained:
+        sample = vectors
+        if len(vectors) > IVF_TRAIN_SAMPLE:
+            pick = np.random.default_rng(0).choice(len(vectors), IVF_TRAIN_SAMPLE, replace=False)
+            sample = np.ascontiguousarray(vectors[np.sort(pick)])
+        inner.train(sample)
+
+    index = faiss.IndexIDMap2(inner)
+    index.add_with_ids(vectors, rows)
+    apply_search_params(index)
+    return index
+
+def worth_saving(index):
+    """Exact flat indexes rebuild faster than they load; anything trained or compressed is kept"""
+    return index_type_of(index) != 'flat' or index_precision(index) != 'float32'
+
+def save_index(encodings_dir, album_id, index, generation):
+    """Persist an index with the store generation (and precision) it matches"""
+    if not worth_saving(index):
+        return False
+    index_type = index_type_of(index)
+    album_dir = get_album_dir(encodings_dir, album_id)
+    tmp_path = temp_path(os.path.join(album_dir, INDEX_FILE))
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, os.path.join(album_dir, INDEX_FILE))
+
+    meta_tmp_path = temp_path(os.path.join(album_dir, INDEX_META_FILE))
+    with open(meta_tmp_path, 'w') as f:
+        json.dump({'type': index_type, 'precision': configured_precision(), 'generation': generation,
+                   'ntotal': int(index.ntotal)}, f)
+    os.replace(meta_tmp_path, os.path.join(album_dir, INDEX_META_FILE))
+    return True
+
+def load_saved_index(encodings_dir, album_id, generation):
+    """Load the persisted index if it was built from this store generation at the
+    configured precision, else None"""
+    album_dir = get_album_dir(encodings_dir, album_id)
+    meta_path = os.path.join(album_dir, INDEX_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta.get('generation') != generation or meta.get('precision', 'float32') != configured_precision():
+        return None
+    index = faiss.read_index(os.path.join(album_dir, INDEX_FILE))
+    apply_search_params(index)
+    return index
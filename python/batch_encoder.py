@@ -0,0 +1,166 @@
+"""Staged, batched face encoder for album encoding.
+
+``FaceAnalysis.get`` runs detection, then every loaded head (landmarks,
+gender/age, recognition) face by face on one image at a time. For album
+encoding we only need boxes and embeddings, so this module splits the work in
+two stages:
+
+1. Detection over batches of images letterboxed to the detector input size
+   (640x640). Models exported with a batch axis run the whole batch in one
+   ONNX call; others run image by image on the same letterboxed inputs.
+2. Recognition: aligned 112x112 crops from many photos are collected and sent
+   to the ArcFace model as one batched tensor.
+
+Batch sizes of both stages are tunable (DET_BATCH_SIZE, REC_BATCH_SIZE).
+
+Images arrive pre-shrunk (image_io.decode_for_detection); boxes are mapped
+back to original coordinates. Faces smaller than SMALL_FACE_SIDE pixels in
+the shrunk image are cropped from a full-resolution decode of their photo
+instead, reusing the detected landmarks.
+"""
+import os
+import cv2
+import numpy as np
+from insightface.utils import face_align
+from insightface.model_zoo.scrfd import distance2bbox, distance2kps
+
+import metrics
+from image_io import load_image_from_bytes
+
+DET_BATCH_SIZE = int(os.environ.get('DET_BATCH_SIZE', 8))
+REC_BATCH_SIZE = int(os.environ.get('REC_BATCH_SIZE', 64))
+# Re-crop faces smaller than this (px in the shrunk image) at full resolution; 0 = never
+SMALL_FACE_SIDE = int(os.environ.get('SMALL_FACE_SIDE', 56))
+
+
+def supports_batched_detection(det_model):
+    """True if the detector ONNX graph has a dynamic batch axis"""
+    batch_dim = det_model.session.get_inputs()[0].shape[0]
+    return getattr(det_model, 'batched', False) and not isinstance(batch_dim, int)
+
+def letterbox(image, input_size):
+    """Resize keeping aspect ratio onto a zero-padded canvas (SCRFD convention: top-left aligned).
+
+    Returns (canvas, scale) where original coordinates = canvas coordinates / scale.
+    """
+    in_w, in_h = input_size
+    im_ratio = image.shape[0] / image.shape[1]
+    if im_ratio > in_h / in_w:
+        new_h = in_h
+        new_w = int(new_h / im_ratio)
+    else:
+        new_w = in_w
+        new_h = int(new_w * im_ratio)
+    scale = new_h / image.shape[0]
+    canvas = np.zeros((in_h, in_w, 3), dtype=np.uint8)
+    canvas[:new_h, :new_w] = cv2.resize(image, (new_w, new_h))
+    return canvas, scale
+
+def _anchor_centers(det_model, height, width, stride):
+    key = (height, width, stride)
+    anchor_centers = det_model.center_cache.get(key)
+    if anchor_centers is None:
+        anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+        anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+        if det_model._num_anchors > 1:
+            anchor_centers = np.stack([anchor_centers] * det_model._num_anchors, axis=1).reshape((-1, 2))
+        if len(det_model.center_cache) < 100:
+            det_model.center_cache[key] = anchor_centers
+    return anchor_centers
+
+def _decode_detections(det_model, outs, input_size, scale):
+    """SCRFD post-processing for one image of a batched forward pass (mirrors SCRFD.detect)"""
+    fmc = det_model.fmc
+    in_w, in_h = input_size
+    scores_list, bboxes_list, kpss_list = [], [], []
+    for idx, stride in enumerate(det_model._feat_stride_fpn):
+        scores = outs[idx]
+        bbox_preds = outs[idx + fmc] * stride
+        anchor_centers = _anchor_centers(det_model, in_h // stride, in_w // stride, stride)
+        pos_inds = np.where(scores >= det_model.det_thresh)[0]
+        bboxes = distance2bbox(anchor_centers, bbox_preds)
+        scores_list.append(scores[pos_inds])
+        bboxes_list.append(bboxes[pos_inds])
+        if det_model.use_kps:
+            kps_preds = outs[idx + fmc * 2] * stride
+            kpss = distance2kps(anchor_centers, kps_preds).reshape((len(anchor_centers), -1, 2))
+            kpss_list.append(kpss[pos_inds])
+
+    scores = np.vstack(scores_list)
+    order = scores.ravel().argsort()[::-1]
+    bboxes = np.vstack(bboxes_list) / scale
+    pre_det = np.hstack((bboxes, scores)).astype(np.float32, copy=False)[order]
+    keep = det_model.nms(pre_det)
+    det = pre_det[keep]
+    kpss = (np.vstack(kpss_list) / scale)[order][keep] if det_model.use_kps else None
+    return det, kpss
+
+def detect_batch(det_model, images):
+    """Detect faces in a list of images. Returns [(det (n x 5: bbox + score), kpss (n x 5 x 2))]"""
+    if not supports_batched_detection(det_model):
+        return [det_model.detect(image, max_num=0, metric='default') for image in images]
+
+    input_size = det_model.input_size
+    letterboxed = [letterbox(image, input_size) for image in images]
+    blob = cv2.dnn.blobFromImages(
+        [canvas for canvas, _ in letterboxed], 1.0 / det_model.input_std, input_size,
+        (det_model.input_mean, det_model.input_mean, det_model.input_mean), swapRB=True)
+    net_outs = det_model.session.run(det_model.output_names, {det_model.input_name: blob})
+    return [
+        _decode_detections(det_model, [out[i] for out in net_outs], input_size, scale)
+        for i, (_, scale) in enumerate(letterboxed)
+    ]
+
+def needs_full_resolution(bbox, decoded):
+    """True if a face is too small in the shrunk image for a good aligned crop"""
+    if not SMALL_FACE_SIDE or decoded.data is None or decoded.scale.min() >= 1:
+        return False
+    return min(bbox[2] - bbox[0], bbox[3] - bbox[1]) < SMALL_FACE_SIDE
+
+def encode_images(face_app, items, det_batch_size=None, rec_batch_size=None):
+    """Detect and embed every face of ``items`` = [(photo_id, DecodedImage), ...].
+
+    Returns ``{photo_id: [(embedding, bbox), ...]}`` (photos without faces map
+    to an empty list), the same pairs ``FaceAnalysis.get`` would yield, with
+    bboxes in original image coordinates.
+    """
+    det_batch_size = det_batch_size or DET_BATCH_SIZE
+    rec_batch_size = rec_batch_size or REC_BATCH_SIZE
+    det_model = face_app.det_model
+    rec_model = face_app.models['recognition']
+    crop_size = rec_model.input_size[0]
+
+    results = {photo_id: [] for photo_id, _ in items}
+    crops, owners = [], []
+
+    def flush_recognition():
+        if not crops:
+            return
+        with metrics.timed('recognition'):
+            embeddings = rec_model.get_feat(crops)
+        for (photo_id, bbox), embedding in zip(owners, embeddings):
+            results[photo_id].append((embedding, bbox))
+        crops.clear()
+        owners.clear()
+
+    for start in range(0, len(items), det_batch_size):
+        chunk = items[start:start + det_batch_size]
+        with metrics.timed('detection'):
+            detections = detect_batch(det_model, [decoded.pixels for _, decoded in chunk])
+        for (photo_id, decoded), (det, kpss) in zip(chunk, detections):
+            if kpss is None:
+                continue
+            full_resolution = None
+            for i in range(det.shape[0]):
+                source, landmarks = decoded.pixels, kpss[i]
+                if needs_full_resolution(det[i], decoded):
+                    if full_resolution is None:
+                        full_resolution = load_image_from_bytes(decoded.data)
+                    if full_resolution is not None:
+                        source, landmarks = full_resolution, kpss[i] / decoded.scale
+                crops.append(face_align.norm_crop(source, landmark=landmarks, image_size=crop_size))
+                owners.append((photo_id, (det[i, :4] / np.tile(decoded.scale, 2)).tolist()))
+                if len(crops) >= rec_batch_size:
+                    flush_recognition()
+    flush_recognition()
+    return results
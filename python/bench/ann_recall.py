@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Recall@threshold and latency of the ANN index tiers against exact flat search.
+
+Generates a synthetic album of identities (each face = identity vector + noise,
+L2-normalized, 512-d) so that real matches exist above the threshold, then
+compares every approximate index type with IndexFlatIP using range search.
+
+Usage:
+    python python/bench/ann_recall.py --faces 200000 --queries 200 --threshold 0.4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ann_index  # noqa: E402
+from embedding_store import AlbumEncodings, BBOX_DIM, normalize_rows  # noqa: E402
+from vector_search import range_search  # noqa: E402
+
+
+def synthetic_album(num_faces, dim, faces_per_identity, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    num_identities = max(1, num_faces // faces_per_identity)
+    identities = normalize_rows(rng.standard_normal((num_identities, dim)))
+    owners = rng.integers(0, num_identities, num_faces)
+    embeddings = normalize_rows(identities[owners] + noise * rng.standard_normal((num_faces, dim)) / np.sqrt(dim))
+    photo_ids = [int(i) for i in range(num_faces)]
+    album = AlbumEncodings('bench', embeddings, np.zeros((num_faces, BBOX_DIM), dtype=np.float32), photo_ids)
+    return album, identities, rng
+
+def timed_range_search(index, queries, threshold):
+    hits, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        rows, _ = range_search(index, query[None, :], threshold)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits.append(set(rows.tolist()))
+    return hits, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--faces-per-identity', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=1.0)
+    parser.add_argument('--threshold', type=float, default=0.4)
+    parser.add_argument('--types', default='hnsw,ivfpq')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    album, identities, rng = synthetic_album(args.faces, args.dim, args.faces_per_identity, args.noise)
+    picks = rng.integers(0, len(identities), args.queries)
+    queries = normalize_rows(identities[picks] + args.noise * rng.standard_normal((args.queries, args.dim)) / np.sqrt(args.dim))
+
+    print(f"Album: {args.faces} faces, {len(identities)} identities; {args.queries} queries @ threshold {args.threshold}")
+    flat = ann_index.build_index(album, 'flat')
+    truth, flat_latencies = timed_range_search(flat, queries, args.threshold)
+    total_truth = sum(len(t) for t in truth)
+    results = {
+        'faces': args.faces,
+        'threshold': args.threshold,
+        'flat': {'p50_ms': float(np.percentile(flat_latencies, 50)), 'p95_ms': float(np.percentile(flat_latencies, 95)),
+                 'avg_hits': total_truth / args.queries}
+    }
+    print(f"  flat   p50 {results['flat']['p50_ms']:.2f} ms, avg hits {results['flat']['avg_hits']:.1f}")
+
+    for index_type in args.types.split(','):
+        start = time.perf_counter()
+        index = ann_index.build_index(album, index_type)
+        build_s = time.perf_counter() - start
+        hits, latencies = timed_range_search(index, queries, args.threshold)
+        found = sum(len(h & t) for h, t in zip(hits, truth))
+        false_hits = sum(len(h - t) for h, t in zip(hits, truth))
+        recall = found / total_truth if total_truth else 1.0
+        results[index_type] = {
+            'build_s': build_s,
+            'recall_at_threshold': recall,
+            'extra_hits': false_hits,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95))
+        }
+        print(f"  {index_type:6s} p50 {results[index_type]['p50_ms']:.2f} ms, "
+              f"recall@{args.threshold} {recall:.4f}, extra hits {false_hits}, build {build_s:.1f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
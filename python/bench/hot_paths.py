@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the service's hot paths: album encoding and search.
+
+Runs face_api in-process (Flask test client) against a temporary data
+directory, so nothing touches Google Drive or the real encodings:
+
+- encode: POST /encode-album for --encode-photos generated JPEGs served by the
+  local stub image server (stub_image_server.py), timed until the job
+  completes -> photos/s and the job's own throughput counters.
+- search: for every album size in --sizes, a synthetic album of normalized
+  512-d faces (see ann_recall.py) is written to the store and searched through
+  POST /search with the FAISS and the NumPy path -> p50/p95/p99 latency
+  (end-to-end and the index part alone), cold load time and the memory the
+  cached album holds.
+
+By default the InsightFace model is replaced with a stub whose detector returns
+1-3 faces per photo and whose recognizer maps each face crop to one of the
+synthetic identities, so queries really match; --det-ms / --rec-ms add a fixed
+latency per photo / face to stand in for inference. --real-model loads
+buffalo_l instead. Service settings (EMBEDDING_PRECISION, ANN_MIN_FACES,
+ENCODER_MODE, ...) are read from the environment as usual.
+
+Results are written as JSON with --output; --compare prints the change of
+every throughput, latency and memory figure against an earlier result file.
+
+Usage:
+    python python/bench/hot_paths.py --sizes 1000,10000,100000 --queries 200 --output bench.json
+    python python/bench/hot_paths.py --compare bench.json --output bench-new.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import base64
+import zlib
+import tempfile
+import argparse
+import platform
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ann_recall import synthetic_album  # noqa: E402
+from stub_image_server import make_jpeg, start_server  # noqa: E402
+
+# Five-point landmark template of a 112x112 ArcFace crop
+ARCFACE_LANDMARKS = np.array([[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366],
+                              [41.5493, 92.3655], [70.7299, 92.2041]], dtype=np.float32) / 112
+# Figures compared by --compare, and whether higher is better
+COMPARED = {'photos_per_second': True, 'p50': False, 'p95': False, 'p99': False,
+            'cold_load_ms': False, 'footprint_mb': False}
+
+
+class StubFace:
+    __slots__ = ('bbox', 'kps', 'det_score', 'embedding')
+
+    def __init__(self, bbox, kps, embedding):
+        self.bbox, self.kps, self.det_score, self.embedding = bbox, kps, 0.9, embedding
+
+class StubDetector:
+    taskname = 'detection'
+    batched = False
+
+    def __init__(self, det_ms):
+        self.det_ms = det_ms
+        # Fixed batch dimension: batch_encoder detects photo by photo
+        self.session = SimpleNamespace(get_inputs=lambda: [SimpleNamespace(shape=[1, 3, 640, 640])])
+
+    def detect(self, image, input_size=None, max_num=0, metric='default'):
+        """1-3 faces side by side, the count fixed by the image content"""
+        if self.det_ms:
+            time.sleep(self.det_ms / 1000)
+        height, width = image.shape[:2]
+        count = 1 + zlib.crc32(image[:4].tobytes()) % 3
+        side = min(width // 4, height // 2)
+        boxes = np.array([[x, height // 4, x + side, height // 4 + side, 0.9]
+                          for x in (width // 16 + i * width // 3 for i in range(count))], dtype=np.float32)
+        kpss = boxes[:, None, :2] + ARCFACE_LANDMARKS[None] * side
+        return boxes, kpss
+
+class StubRecognizer:
+    taskname = 'recognition'
+    input_size = (112, 112)
+
+    def __init__(self, rec_ms, noise):
+        self.rec_ms = rec_ms
+        self.noise = noise
+        self.identities = None
+
+    def get_feat(self, crops):
+        """Embedding of a random identity (picked by the crop content) plus noise"""
+        if self.rec_ms:
+            time.sleep(self.rec_ms * len(crops) / 1000)
+        embeddings = []
+        for crop in crops:
+            rng = np.random.default_rng(zlib.crc32(np.ascontiguousarray(crop).tobytes()))
+            identity = self.identities[rng.integers(len(self.identities))]
+            noise = rng.standard_normal(len(identity)) / np.sqrt(len(identity))
+            embeddings.append(identity + self.noise * noise)
+        return np.asarray(embeddings, dtype=np.float32)
+
+class StubFaceAnalysis:
+    """Stand-in for insightface FaceAnalysis with the interface batch_encoder and face_api use"""
+
+    def __init__(self, det_ms=0.0, rec_ms=0.0, noise=1.0):
+        self.det_model = StubDetector(det_ms)
+        self.models = {'detection': self.det_model, 'recognition': StubRecognizer(rec_ms, noise)}
+
+    def set_identities(self, identities):
+        self.models['recognition'].identities = identities
+
+    def get(self, image, max_num=0):
+        from insightface.utils import face_align
+        boxes, kpss = self.det_model.detect(image)
+        crops = [face_align.norm_crop(image, landmark=kps, image_size=112) for kps in kpss]
+        embeddings = self.models['recognition'].get_feat(crops)
+        return [StubFace(box[:4], kps, embedding) for box, kps, embedding in zip(boxes, kpss, embeddings)]
+
+
+def load_service(args, data_dir):
+    """Import face_api against ``data_dir``, with the stub model unless --real-model"""
+    os.environ['ENCODINGS_DIR'] = os.path.join(data_dir, 'encodings')
+    os.environ['JOBS_DIR'] = os.path.join(data_dir, 'jobs')
+    os.environ['FACE_CACHE_DIR'] = os.path.join(data_dir, 'face_cache')
+    stub = None
+    if not args.real_model:
+        import face_model
+        os.environ['ENCODE_PROCESSES'] = '0'  # worker processes would load the real model
+        stub = StubFaceAnalysis(args.det_ms, args.rec_ms, args.noise)
+        face_model.load_face_model = lambda intra_op_threads=None: stub
+        face_model.warm_up = lambda face_app: None
+    with quiet(args):
+        import face_api
+        face_api.wait_until_ready()
+    if face_api.model_state['status'] != 'ready':
+        sys.exit(f"Model failed to load: {face_api.model_state['error']}")
+    return face_api, stub
+
+@contextlib.contextmanager
+def quiet(args):
+    """Swallow the service's per-request log lines unless --verbose"""
+    if args.verbose:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def percentiles(latencies):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {'p50': round(float(p50), 3), 'p95': round(float(p95), 3), 'p99': round(float(p99), 3),
+            'mean': round(float(np.mean(latencies)), 3) if latencies else 0.0}
+
+def bench_encode(face_api, stub, args):
+    """Encode an album served by the stub image server, timed until the job completes"""
+    _, identities, _ = synthetic_album(args.encode_photos * 2, args.dim, args.faces_per_identity, args.noise, seed=1)
+    if stub is not None:
+        stub.set_identities(identities)
+    server_args = SimpleNamespace(port=0, latency_ms=args.image_latency_ms, error_rate=args.image_error_rate,
+                                  retry_after=1, width=args.width, height=args.height, seed=0)
+    server, counters = start_server(server_args)
+    base = f'http://127.0.0.1:{server.server_port}'
+    photos = [{'id': i, 'url': f'{base}/{i}.jpg'} for i in range(args.encode_photos)]
+    client = face_api.app.test_client()
+
+    with quiet(args):
+        start = time.perf_counter()
+        response = client.post('/encode-album', json={'album_id': 'bench-encode', 'photos': photos})
+        job_id = response.json['job_id']
+        while True:
+            job = client.get(f'/jobs/{job_id}').json
+            if job['status'] in ('completed', 'failed', 'cancelled'):
+                break
+            time.sleep(0.02)
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    if job['status'] != 'completed':
+        sys.exit(f"Encode job {job['status']}: {job.get('error')}")
+    return {
+        'photos': args.encode_photos,
+        'faces': job.get('total_faces'),
+        'failed_photos': len(job.get('failed_photos', [])),
+        'elapsed_s': round(elapsed, 3),
+        'photos_per_second': round(args.encode_photos / elapsed, 2),
+        'faces_per_second': job.get('faces_per_second'),
+        'encode_seconds': job.get('encode_seconds'),
+        'image_requests': counters['requests']
+    }
+
+def wait_for_index_build(face_api, album_id):
+    start = time.perf_counter()
+    while True:
+        with face_api.cache_lock:
+            if album_id not in face_api.pending_index_builds:
+                return time.perf_counter() - start
+        time.sleep(0.05)
+
+def bench_search_backend(face_api, album_id, queries, args):
+    """Cold load, then ``queries`` searches; FAISS or NumPy as set in face_api.FAISS_AVAILABLE"""
+    client = face_api.app.test_client()
+    face_api.album_cache.pop(album_id)
+    rss_before = rss_bytes()
+
+    def search(image):
+        start = time.perf_counter()
+        response = client.post('/search', json={'album_id': album_id, 'image': image, 'threshold': args.threshold})
+        latency = (time.perf_counter() - start) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"/search returned {response.status_code}: {response.json}")
+        return latency, response.json
+
+    with quiet(args):
+        cold_ms, _ = search(queries[0])
+        build_wait = wait_for_index_build(face_api, album_id)
+        for image in queries[:args.warmup]:
+            search(image)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            outcomes = list(executor.map(search, queries))
+        elapsed = time.perf_counter() - start
+
+    encodings, index, matrix = face_api.album_cache.peek(album_id)
+    rss_after = rss_bytes()
+    last = outcomes[-1][1]
+    return {
+        'search_method': last['search_method'],
+        'index_type': last['index_type'],
+        'cold_load_ms': round(cold_ms, 3),
+        'index_build_wait_s': round(build_wait, 3),
+        'latency_ms': percentiles([latency for latency, _ in outcomes]),
+        'search_ms': percentiles([result['search_time_ms'] for _, result in outcomes]),
+        'queries_per_second': round(len(outcomes) / elapsed, 1),
+        'avg_matches': round(float(np.mean([result['total_matches'] for _, result in outcomes])), 1),
+        'memory': {
+            'footprint_mb': round(face_api.album_footprint(encodings, index, matrix) / 2 ** 20, 2),
+            'encodings_mb': round(encodings.nbytes / 2 ** 20, 2),
+            'index_mb': round(face_api.ann_index.index_nbytes(index) / 2 ** 20, 2) if index is not None else 0.0,
+            'matrix_mb': round(matrix.nbytes / 2 ** 20, 2) if matrix is not None else 0.0,
+            'rss_delta_mb': round((rss_after - rss_before) / 2 ** 20, 1) if rss_before is not None else None
+        }
+    }
+
+def bench_search(face_api, stub, size, args):
+    """Search one synthetic album of ``size`` faces through every available backend"""
+    from embedding_store import get_album_dir, save_album
+
+    album, identities, _ = synthetic_album(size, args.dim, args.faces_per_identity, args.noise)
+    album.album_id = f'bench-{size}'
+    save_album(face_api.ENCODINGS_DIR, album)
+    if stub is not None:
+        stub.set_identities(identities)
+    queries = ['data:image/jpeg;base64,' + base64.b64encode(make_jpeg(100000 + i, (args.width, args.height))).decode()
+               for i in range(args.queries)]
+
+    results = {'faces': size, 'store_mb': round(dir_bytes(get_album_dir(face_api.ENCODINGS_DIR, album.album_id)) / 2 ** 20, 2)}
+    faiss_available = face_api.FAISS_AVAILABLE
+    backends = (['faiss'] if faiss_available else []) + ['numpy']
+    try:
+        for backend in backends:
+            face_api.FAISS_AVAILABLE = backend == 'faiss'
+            results[backend] = bench_search_backend(face_api, album.album_id, queries, args)
+    finally:
+        face_api.FAISS_AVAILABLE = faiss_available
+        face_api.album_cache.pop(album.album_id)
+    return results
+
+def environment(face_api):
+    from ann_index import ANN_MIN_FACES
+    from quantization import configured_precision
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'faiss': face_api.faiss.__version__ if face_api.FAISS_AVAILABLE else None,
+        'cpu_count': os.cpu_count(),
+        'encoder_mode': face_api.ENCODER_MODE,
+        'embedding_precision': configured_precision(),
+        'ann_min_faces': ANN_MIN_FACES
+    }
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, key, value
+
+def compare(previous, results):
+    """Print the relative change of every compared figure present in both result sets"""
+    old = {path: value for path, _, value in flatten(previous)}
+    print(f"\nChange against {previous.get('environment', {}).get('git_commit') or 'previous run'}:")
+    for path, key, value in flatten(results):
+        if key not in COMPARED or path not in old or path.startswith('environment'):
+            continue
+        if not old[path]:
+            continue
+        change = (value - old[path]) / old[path]
+        better = change > 0 if COMPARED[key] else change < 0
+        marker = '' if abs(change) < 0.05 else (' better' if better else ' WORSE')
+        print(f"  {path:45s} {old[path]:>10} -> {value:>10}  {change:+7.1%}{marker}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Album sizes (faces) to search')
+    parser.add_argument('--queries', type=int, default=200, help='Searches per album size and backend')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrent searches (exercises coalescing)')
+    parser.add_argument('--threshold', type=float, default=0.4)
+    parser.add_argument('--encode-photos', type=int, default=200, help='0 = skip the encode benchmark')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--faces-per-identity', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=1.0)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--image-latency-ms', type=float, default=5, help='Mean stub image server latency')
+    parser.add_argument('--image-error-rate', type=float, default=0.0)
+    parser.add_argument('--det-ms', type=float, default=0.0, help='Stub model latency per photo')
+    parser.add_argument('--rec-ms', type=float, default=0.0, help='Stub model latency per face')
+    parser.add_argument('--real-model', action='store_true', help='Load the InsightFace model instead of the stub')
+    parser.add_argument('--verbose', action='store_true', help="Show the service's log output")
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Earlier JSON result to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        face_api, stub = load_service(args, data_dir)
+        results = {'environment': environment(face_api), 'args': vars(args), 'search': {}}
+
+        if args.encode_photos:
+            results['encode'] = encode = bench_encode(face_api, stub, args)
+            print(f"Encode: {encode['photos']} photos, {encode['faces']} faces in {encode['elapsed_s']:.2f}s "
+                  f"-> {encode['photos_per_second']:.1f} photos/s")
+
+        for size in (int(size) for size in args.sizes.split(',') if size):
+            result = results['search'][str(size)] = bench_search(face_api, stub, size, args)
+            for backend in ('faiss', 'numpy'):
+                if backend in result:
+                    run, latency = result[backend], result[backend]['latency_ms']
+                    print(f"Search {size:>8} faces  {backend:5s} {run['index_type']:8s} p50 {latency['p50']:8.2f} "
+                          f"p95 {latency['p95']:8.2f} p99 {latency['p99']:8.2f} ms  cold {run['cold_load_ms']:8.1f} ms  "
+                          f"{run['memory']['footprint_mb']:8.1f} MB  ~{run['avg_matches']} matches")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Memory saved by compressed embedding storage against the change in match results.
+
+Builds the same synthetic album (see ann_recall.py) at every precision, as a
+NumPy search matrix and, when FAISS is installed, as a flat index, and
+compares the matched photos of each with exact float32 search, with and
+without re-ranking near the threshold.
+
+Usage:
+    python python/bench/quantization.py --faces 100000 --queries 200 --threshold 0.4
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import quantization  # noqa: E402
+from ann_recall import synthetic_album  # noqa: E402
+from embedding_store import load_album, normalize_rows, save_album  # noqa: E402
+from vector_search import build_search_matrix, search_index_many, search_matrix_many  # noqa: E402
+
+try:
+    import faiss
+    import ann_index
+except ImportError:
+    faiss = None
+
+
+def matched_sets(outcomes):
+    return [set(match['photo_id'] for match in matches) for matches, _ in outcomes]
+
+def compare(found, truth):
+    """Recall and precision of matched photos against exact search"""
+    total_truth = sum(len(t) for t in truth)
+    total_found = sum(len(f) for f in found)
+    common = sum(len(f & t) for f, t in zip(found, truth))
+    return {
+        'recall': round(common / total_truth, 5) if total_truth else 1.0,
+        'precision': round(common / total_found, 5) if total_found else 1.0,
+        'missed': total_truth - common,
+        'extra': total_found - common
+    }
+
+def timed(search, query_sets, thresholds):
+    latencies, outcomes = [], []
+    for query_set, threshold in zip(query_sets, thresholds):
+        start = time.perf_counter()
+        outcomes.extend(search([query_set], [threshold]))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return outcomes, float(np.percentile(latencies, 50))
+
+def run_matrix(album, precision, query_sets, thresholds, truth):
+    start = time.perf_counter()
+    matrix = build_search_matrix(album, precision)
+    build_s = time.perf_counter() - start
+    outcomes, p50 = timed(lambda q, t: search_matrix_many(matrix, q, t), query_sets, thresholds)
+
+    margins = dict(quantization.RERANK_MARGINS)
+    quantization.RERANK_MARGINS.update(dict.fromkeys(margins, 0.0))
+    try:
+        no_rerank = search_matrix_many(matrix, query_sets, thresholds)
+    finally:
+        quantization.RERANK_MARGINS.update(margins)
+
+    margin = quantization.rerank_margin(matrix.matrix.dtype)
+    approx = quantization.scores(normalize_rows(np.concatenate(query_sets)), matrix.matrix, matrix.scale)
+    reranked = int((np.abs(approx - thresholds[0]) <= margin).sum()) if margin > 0 else 0
+    return {
+        'precision': str(matrix.matrix.dtype),
+        'bytes_per_face': round(matrix.nbytes / len(matrix), 1),
+        'size_mb': round(matrix.nbytes / 2 ** 20, 2),
+        'build_s': round(build_s, 3),
+        'search_p50_ms': round(p50, 3),
+        'rerank_margin': margin,
+        'reranked_rows': reranked,
+        'vs_float32': compare(matched_sets(outcomes), truth),
+        'vs_float32_no_rerank': compare(matched_sets(no_rerank), truth)
+    }
+
+def run_index(album, precision, query_sets, thresholds, truth):
+    start = time.perf_counter()
+    index = ann_index.build_index(album, 'flat', precision)
+    build_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'index.faiss')
+        faiss.write_index(index, path)
+        start = time.perf_counter()
+        faiss.read_index(path)
+        load_s = time.perf_counter() - start
+
+    margin = ann_index.rerank_margin(index)
+    outcomes, p50 = timed(lambda q, t: search_index_many(index, album, q, t, margin=margin), query_sets, thresholds)
+    no_rerank = search_index_many(index, album, query_sets, thresholds)
+    nbytes = ann_index.index_nbytes(index)
+    return {
+        'precision': ann_index.index_precision(index),
+        'bytes_per_face': round(nbytes / index.ntotal, 1),
+        'size_mb': round(nbytes / 2 ** 20, 2),
+        'build_s': round(build_s, 3),
+        'load_s': round(load_s, 3),
+        'search_p50_ms': round(p50, 3),
+        'rerank_margin': margin,
+        'vs_float32': compare(matched_sets(outcomes), truth),
+        'vs_float32_no_rerank': compare(matched_sets(no_rerank), truth)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--faces-per-identity', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=1.0)
+    parser.add_argument('--threshold', type=float, default=0.4)
+    parser.add_argument('--precisions', default=','.join(quantization.PRECISIONS))
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    args = parser.parse_args()
+
+    album, identities, rng = synthetic_album(args.faces, args.dim, args.faces_per_identity, args.noise)
+    picks = rng.integers(0, len(identities), args.queries)
+    queries = normalize_rows(identities[picks] + args.noise * rng.standard_normal((args.queries, args.dim)) / np.sqrt(args.dim))
+    query_sets = [queries[i:i + 1] for i in range(args.queries)]
+    thresholds = [args.threshold] * args.queries
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        # Searches re-rank from the memory-mapped store, as in the service
+        save_album(store_dir, album)
+        album = load_album(store_dir, album.album_id)
+
+        truth = matched_sets(search_matrix_many(build_search_matrix(album, 'float32'), query_sets, thresholds))
+        print(f"Album: {args.faces} faces, {len(identities)} identities; {args.queries} queries @ threshold "
+              f"{args.threshold}, avg {sum(len(t) for t in truth) / args.queries:.1f} matches")
+        results = {'faces': args.faces, 'threshold': args.threshold, 'matrix': {}, 'faiss_flat': {}}
+        for precision in args.precisions.split(','):
+            runs = [('matrix', run_matrix)]
+            if faiss is not None:
+                runs.append(('faiss_flat', run_index))
+            for backend, run in runs:
+                result = run(album, precision, query_sets, thresholds, truth)
+                results[backend][precision] = result
+                diff, raw = result['vs_float32'], result['vs_float32_no_rerank']
+                print(f"  {backend:10s} {precision:8s} {result['bytes_per_face']:7.1f} B/face "
+                      f"{result['size_mb']:8.1f} MB  p50 {result['search_p50_ms']:.2f} ms  "
+                      f"recall {diff['recall']:.4f} precision {diff['precision']:.4f} "
+                      f"(no re-rank: {raw['recall']:.4f} / {raw['precision']:.4f})")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
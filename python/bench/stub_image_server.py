@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Local stub image server with injected latency and errors.
+
+Serves generated JPEGs at /<photo_id>.jpg so the downloader and the encode
+pipeline can be exercised without Google Drive. A fraction of requests can be
+delayed, answered with 429 (with Retry-After) or 503, or reset mid-response.
+
+Usage:
+    python python/bench/stub_image_server.py --port 8099 --latency-ms 50 --error-rate 0.2
+    python python/bench/stub_image_server.py --check 200 --error-rate 0.3
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def make_jpeg(photo_id, size):
+    rng = np.random.default_rng(photo_id)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def make_handler(args):
+    rng = random.Random(args.seed)
+    lock = threading.Lock()
+    counters = {'requests': 0, 'errors': 0}
+    cache = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with lock:
+                counters['requests'] += 1
+                roll = rng.random()
+                latency = rng.uniform(0, 2 * args.latency_ms) / 1000
+            time.sleep(latency)
+
+            if roll < args.error_rate:
+                with lock:
+                    counters['errors'] += 1
+                kind = ('429', '503', 'reset')[int(roll / args.error_rate * 3)]
+                if kind == 'reset':
+                    self.close_connection = True
+                    self.connection.close()
+                    return
+                self.send_response(int(kind))
+                if kind == '429':
+                    self.send_header('Retry-After', str(args.retry_after))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            try:
+                photo_id = int(self.path.strip('/').split('.')[0])
+            except ValueError:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if photo_id not in cache:
+                cache[photo_id] = make_jpeg(photo_id, (args.width, args.height))
+            body = cache[photo_id]
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler, counters
+
+def start_server(args):
+    handler, counters = make_handler(args)
+    ThreadingHTTPServer.request_queue_size = 256
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counters
+
+def check(args, server, counters):
+    """Download ``args.check`` photos through the real downloader and report retries/losses"""
+    import asyncio
+    import downloader
+
+    base = f'http://127.0.0.1:{server.server_port}'
+
+    async def fetch_all():
+        session = await downloader.get_session()
+        return await asyncio.gather(*[
+            downloader.download_image_async(session, f'{base}/{i}.jpg', i) for i in range(args.check)
+        ])
+
+    start = time.perf_counter()
+    results = downloader.run_async(fetch_all())
+    elapsed = time.perf_counter() - start
+    failed = [photo_id for photo_id, image_bytes, _ in results if image_bytes is None]
+    report = {
+        'photos': args.check,
+        'failed': len(failed),
+        'elapsed_s': round(elapsed, 2),
+        'server': dict(counters),
+        'downloader': downloader.get_stats()
+    }
+    print(json.dumps(report, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=20, help='Mean injected latency')
+    parser.add_argument('--error-rate', type=float, default=0.1, help='Fraction of requests answered 429/503/reset')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', type=int, default=0, help='Download this many photos through downloader.py and exit')
+    args = parser.parse_args()
+
+    server, counters = start_server(args)
+    if args.check:
+        check(args, server, counters)
+        return
+    print(f"Serving stub images on http://127.0.0.1:{server.server_port}/<photo_id>.jpg")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Face clustering: the people of an album.
+
+Graph-based: every live face is linked to its CLUSTER_K nearest neighbours
+from a FAISS kNN search (exact up to CLUSTER_EXACT_MAX faces, HNSW above, so
+large albums never pay for all-pairs similarity). Links below
+CLUSTER_THRESHOLD, and links between two faces of the same photo (never the
+same person), are dropped; connected components of the remaining graph are
+the people. Every face gets a cluster, singletons included, so a search over
+the cluster centroids followed by expanding the matching clusters to their
+photos covers the whole album.
+
+Stored next to the encodings, tagged with the store generation they were
+computed from:
+
+    album_<id>/people.json            {"generation", "dim", "count", "people": [...]}
+    album_<id>/people_centroids.f32   normalized centroid per person (count x dim)
+"""
+import os
+import json
+import numpy as np
+
+from embedding_store import get_album_dir, normalize_rows, temp_path
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+CLUSTER_K = int(os.environ.get('CLUSTER_K', 16))
+CLUSTER_THRESHOLD = float(os.environ.get('CLUSTER_THRESHOLD', 0.5))
+CLUSTER_EXACT_MAX = int(os.environ.get('CLUSTER_EXACT_MAX', 20000))
+PEOPLE_MIN_PHOTOS = int(os.environ.get('PEOPLE_MIN_PHOTOS', 2))  # smaller clusters are hidden from /people
+
+PEOPLE_FILE = 'people.json'
+CENTROIDS_FILE = 'people_centroids.f32'
+KNN_BLOCK = 1024
+
+
+class People:
+    """Clusters of one album generation. ``people[i]`` = {'person_id', 'face_count', 'photo_ids', 'cover'}"""
+    __slots__ = ('generation', 'centroids', 'people')
+
+    def __init__(self, generation, centroids, people):
+        self.generation = generation
+        self.centroids = centroids
+        self.people = people
+
+    def __len__(self):
+        return len(self.people)
+
+    def listed(self, min_photos=None):
+        """People with at least ``min_photos`` photos, most photographed first"""
+        min_photos = PEOPLE_MIN_PHOTOS if min_photos is None else min_photos
+        return [person for person in self.people if len(person['photo_ids']) >= min_photos]
+
+
+def knn(vectors, k):
+    """(similarities, neighbours) of the ``k`` nearest rows of every row (itself included)"""
+    n, dim = vectors.shape
+    if faiss is not None:
+        if n <= CLUSTER_EXACT_MAX:
+            index = faiss.IndexFlatIP(dim)
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = max(64, 2 * k)
+        index.add(vectors)
+        return index.search(vectors, k)
+
+    # Without FAISS: exact search in blocks so memory stays at KNN_BLOCK x n
+    similarities = np.empty((n, k), dtype=np.float32)
+    neighbours = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, KNN_BLOCK):
+        block = vectors[start:start + KNN_BLOCK] @ vectors.T
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        similarities[start:start + len(block)] = np.take_along_axis(block, top, axis=1)
+        neighbours[start:start + len(block)] = top
+    return similarities, neighbours
+
+def connected_components(n, src, dst):
+    """Component label (smallest member) per node, by min-label propagation with pointer jumping"""
+    labels = np.arange(n)
+    while True:
+        lowest = np.minimum(labels[src], labels[dst])
+        updated = labels.copy()
+        np.minimum.at(updated, src, lowest)
+        np.minimum.at(updated, dst, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+def cluster_album(album, threshold=None, k=None):
+    """Cluster the live faces of ``album`` (AlbumEncodings). Returns People"""
+    threshold = CLUSTER_THRESHOLD if threshold is None else threshold
+    rows = album.live_rows()
+    n = len(rows)
+    if n == 0:
+        return People(album.generation, np.empty((0, album.dim), dtype=np.float32), [])
+
+    vectors = np.ascontiguousarray(album.embeddings[rows], dtype=np.float32)
+    photo_codes, photo_ids = album.photo_index()
+    photo_codes = photo_codes[rows]
+
+    similarities, neighbours = knn(vectors, min((k or CLUSTER_K) + 1, n))
+    src = np.repeat(np.arange(n), neighbours.shape[1])
+    dst = neighbours.ravel()
+    keep = (dst >= 0) & (similarities.ravel() >= threshold) & (src != dst)
+    keep &= photo_codes[src] != photo_codes[np.maximum(dst, 0)]
+    labels = connected_components(n, src[keep], dst[keep])
+
+    # Dense person ids, largest cluster first
+    _, labels, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    labels = rank[labels]
+    sizes = np.bincount(labels)
+
+    centroids = np.zeros((len(sizes), vectors.shape[1]), dtype=np.float32)
+    np.add.at(centroids, labels, vectors)
+    centroids = normalize_rows(centroids)
+
+    # Faces grouped by person, each group ordered closest-to-centroid first
+    closeness = np.einsum('ij,ij->i', vectors, centroids[labels])
+    order = np.lexsort((-closeness, labels))
+    people = []
+    for person_id, members in enumerate(np.split(order, np.cumsum(sizes)[:-1])):
+        cover = members[0]
+        codes = photo_codes[members]
+        _, first = np.unique(codes, return_index=True)
+        people.append({
+            'person_id': person_id,
+            'face_count': int(len(members)),
+            'photo_ids': [photo_ids[code] for code in codes[np.sort(first)]],
+            'cover': {'photo_id': photo_ids[photo_codes[cover]],
+                      'bbox': album.bboxes[rows[cover]].tolist()}
+        })
+    return People(album.generation, centroids, people)
+
+def search_people(people, query_embeddings, threshold):
+    """Match query faces against cluster centroids and expand the matching clusters.
+
+    Returns (matches, max_similarity) like vector_search.search_matrix_many, each
+    match also carrying its 'person_id'.
+    """
+    if len(people) == 0:
+        return [], 0.0
+    similarities = (normalize_rows(query_embeddings) @ people.centroids.T).max(axis=0)
+    matches, seen = [], set()
+    for person_id in np.argsort(-similarities):
+        if similarities[person_id] <= threshold:
+            break
+        for photo_id in people.people[person_id]['photo_ids']:
+            if photo_id not in seen:
+                seen.add(photo_id)
+                matches.append({'photo_id': photo_id, 'similarity': round(float(similarities[person_id]), 3),
+                                'person_id': int(person_id)})
+    return matches, float(similarities.max())
+
+def save_people(encodings_dir, album_id, people):
+    album_dir = get_album_dir(encodings_dir, album_id)
+    centroids_path = os.path.join(album_dir, CENTROIDS_FILE)
+    centroids_tmp = temp_path(centroids_path)
+    np.ascontiguousarray(people.centroids, dtype=np.float32).tofile(centroids_tmp)
+    os.replace(centroids_tmp, centroids_path)
+    meta = {
+        'generation': people.generation,
+        'dim': int(people.centroids.shape[1]),
+        'count': len(people),
+        'people': people.people
+    }
+    meta_path = os.path.join(album_dir, PEOPLE_FILE)
+    meta_tmp = temp_path(meta_path)
+    with open(meta_tmp, 'w') as f:
+        json.dump(meta, f, separators=(',', ':'))
+    os.replace(meta_tmp, meta_path)
+
+def load_people(encodings_dir, album_id, generation=None):
+    """Saved People of an album, or None if missing (or not of ``generation``)"""
+    album_dir = get_album_dir(encodings_dir, album_id)
+    try:
+        with open(os.path.join(album_dir, PEOPLE_FILE), 'r') as f:
+            meta = json.load(f)
+        if generation is not None and meta['generation'] != generation:
+            return None
+        centroids = np.fromfile(os.path.join(album_dir, CENTROIDS_FILE), dtype=np.float32,
+                                count=meta['count'] * meta['dim']).reshape(meta['count'], meta['dim'])
+    except (OSError, ValueError, KeyError):
+        return None
+    return People(meta['generation'], centroids, meta['people'])
@@ -0,0 +1,89 @@
+"""Micro-batching of concurrent requests into one processing call.
+
+The first request to arrive opens a batch and becomes its leader: it waits
+up to SEARCH_COALESCE_MS for more requests to join (or until the batch holds
+SEARCH_COALESCE_MAX), then processes the whole batch on its own thread and
+hands every follower its result. With no concurrent traffic a request pays at
+most the window; under load, many selfies share one detection/recognition
+pass and one index search per album.
+"""
+import os
+import threading
+
+SEARCH_COALESCE_MS = float(os.environ.get('SEARCH_COALESCE_MS', 3))  # 0 = disabled
+SEARCH_COALESCE_MAX = int(os.environ.get('SEARCH_COALESCE_MAX', 32))
+
+
+class _Batch:
+    __slots__ = ('items', 'results', 'full', 'done')
+
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class Coalescer:
+    """``process(items)`` returns one result per item; a result that is an
+    exception is raised in that item's caller"""
+
+    def __init__(self, process, window_ms=SEARCH_COALESCE_MS, max_batch=SEARCH_COALESCE_MAX):
+        self._process = process
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._open = None
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item):
+        if self.window <= 0 or self.max_batch <= 1:
+            return self._unwrap(self._run([item])[0])
+
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch()
+            position = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                self._open = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+            batch.results = self._run(batch.items)
+            batch.done.set()
+        else:
+            batch.done.wait()
+        return self._unwrap(batch.results[position])
+
+    def _run(self, items):
+        with self._lock:
+            self.batches += 1
+            self.items += len(items)
+        try:
+            return self._process(items)
+        except Exception as e:
+            return [e] * len(items)
+
+    @staticmethod
+    def _unwrap(result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch': self.max_batch,
+                'batches': self.batches,
+                'requests': self.items,
+                'avg_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0
+            }
@@ -0,0 +1,124 @@
+"""Near-duplicate and burst-shot detection while encoding an album.
+
+Event albums hold many copies of one shot (re-exports, resized uploads) and
+bursts of almost identical frames. With DEDUP_ENABLED, every downloaded photo
+gets a 64-bit difference hash (dHash) of a small grayscale thumbnail:
+
+- Pre-pass: a photo within DEDUP_HASH_DISTANCE bits of an earlier photo skips
+  detection and recognition entirely and becomes an alias of it.
+- Post-pass: a photo within DEDUP_BURST_DISTANCE bits joins that photo's
+  burst group. Once encoded, if its faces pair up one-to-one with the faces of
+  the group's first encoded photo at DEDUP_FACE_SIMILARITY or more, it is
+  collapsed into an alias of that photo instead of adding its own rows.
+
+Aliases have no rows in the embedding store; searches return them next to
+their canonical photo (embedding_store ``aliases``).
+"""
+import os
+import threading
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from embedding_store import normalize_rows
+
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'false').lower() == 'true'
+DEDUP_HASH_DISTANCE = int(os.environ.get('DEDUP_HASH_DISTANCE', 4))
+DEDUP_BURST_DISTANCE = int(os.environ.get('DEDUP_BURST_DISTANCE', 12))
+DEDUP_FACE_SIMILARITY = float(os.environ.get('DEDUP_FACE_SIMILARITY', 0.95))
+
+HASH_SIZE = 8
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image_bytes):
+    """64-bit difference hash of an encoded image, or None if it can't be decoded"""
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))  # JPEG: decode at a fraction of full size
+            thumbnail = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    except Exception:
+        return None
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hamming_distances(hashes, image_hash):
+    """Bit distance of every hash in ``hashes`` (uint64 array) to ``image_hash``"""
+    return _POPCOUNT[(hashes ^ np.uint64(image_hash)).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class NearDuplicates:
+    """Hashes and burst groups of the photos of one encode run (thread-safe)"""
+
+    def __init__(self, hash_distance=DEDUP_HASH_DISTANCE, burst_distance=DEDUP_BURST_DISTANCE,
+                 face_similarity=DEDUP_FACE_SIMILARITY):
+        self.hash_distance = hash_distance
+        self.burst_distance = burst_distance
+        self.face_similarity = face_similarity
+        self._lock = threading.Lock()
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._photo_ids = []
+        self._groups = []       # burst group of each hashed photo
+        self._group_of = {}     # photo_id -> burst group
+        self._anchors = {}      # burst group -> (photo_id, normalized face embeddings)
+        self.duplicates = 0     # photos that skipped inference
+        self.collapsed = 0      # encoded photos folded into their burst anchor
+
+    def representative(self, photo_id, image_bytes):
+        """Id of an earlier near-identical photo (skip inference), or None.
+
+        Otherwise the photo is hashed in, joining the burst group of its
+        nearest earlier photo when within DEDUP_BURST_DISTANCE.
+        """
+        image_hash = dhash(image_bytes)
+        if image_hash is None:
+            return None
+        with self._lock:
+            group = len(self._photo_ids)
+            if len(self._photo_ids):
+                distances = hamming_distances(self._hashes[:len(self._photo_ids)], image_hash)
+                nearest = int(np.argmin(distances))
+                if distances[nearest] <= self.hash_distance:
+                    self.duplicates += 1
+                    return self._photo_ids[nearest]
+                if distances[nearest] <= self.burst_distance:
+                    group = self._groups[nearest]
+            if len(self._photo_ids) == len(self._hashes):
+                self._hashes = np.resize(self._hashes, max(64, 2 * len(self._hashes)))
+            self._hashes[len(self._photo_ids)] = image_hash
+            self._photo_ids.append(photo_id)
+            self._groups.append(group)
+            self._group_of[photo_id] = group
+        return None
+
+    def collapse(self, photo_id, results):
+        """Photo id to fold an encoded photo into, or None to keep its faces.
+
+        The first photo of a burst group to finish with faces becomes the
+        group's anchor; later ones collapse into it when every face pairs up.
+        """
+        if not results:
+            return None
+        with self._lock:
+            group = self._group_of.get(photo_id)
+            if group is None:
+                return None
+            embeddings = normalize_rows([r['embedding'] for r in results])
+            anchor = self._anchors.get(group)
+            if anchor is None:
+                self._anchors[group] = (photo_id, embeddings)
+                return None
+            anchor_id, anchor_embeddings = anchor
+            if len(embeddings) != len(anchor_embeddings):
+                return None
+            similarities = embeddings @ anchor_embeddings.T
+            if min(similarities.max(axis=0).min(), similarities.max(axis=1).min()) < self.face_similarity:
+                return None
+            self.collapsed += 1
+            return anchor_id
+
+    def stats(self):
+        with self._lock:
+            return {'inferences_avoided': self.duplicates, 'duplicates_collapsed': self.collapsed}
@@ -0,0 +1,113 @@
+"""Long-lived image downloader shared by all encode requests.
+
+One asyncio loop runs in a daemon thread and owns one aiohttp session, whose
+connector keeps connections alive, caps connections per host and caches DNS,
+so Google Drive TLS handshakes happen once per connection rather than once
+per batch. 429 and 5xx responses, timeouts and connection errors are retried
+with exponential backoff and full jitter, honouring Retry-After.
+"""
+import os
+import time
+import atexit
+import random
+import asyncio
+import threading
+import aiohttp
+
+import metrics
+
+DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', 15))
+DOWNLOAD_MAX_CONNECTIONS = int(os.environ.get('DOWNLOAD_MAX_CONNECTIONS', 64))
+DOWNLOAD_PER_HOST = int(os.environ.get('DOWNLOAD_PER_HOST', 16))
+DNS_CACHE_SECONDS = int(os.environ.get('DNS_CACHE_SECONDS', 300))
+KEEPALIVE_SECONDS = float(os.environ.get('KEEPALIVE_SECONDS', 30))
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', 3))
+RETRY_BASE_SECONDS = float(os.environ.get('RETRY_BASE_SECONDS', 0.5))
+RETRY_MAX_SECONDS = float(os.environ.get('RETRY_MAX_SECONDS', 10))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'}
+
+_loop = None
+_loop_lock = threading.Lock()
+_session = None
+
+stats = {'downloads': 0, 'retries': 0, 'failures': 0, 'bytes': 0}
+
+
+def get_loop():
+    """The shared event loop, started on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='download-loop', daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    """Run a coroutine on the shared loop from a worker thread and wait for it"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+async def get_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=DOWNLOAD_MAX_CONNECTIONS,
+            limit_per_host=DOWNLOAD_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_SECONDS,
+            keepalive_timeout=KEEPALIVE_SECONDS
+        )
+        _session = aiohttp.ClientSession(connector=connector, headers=HEADERS)
+    return _session
+
+@atexit.register
+def close_session():
+    if _session is not None and not _session.closed:
+        try:
+            run_async(_session.close())
+        except Exception:
+            pass
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number ``attempt`` (0-based)"""
+    if retry_after is not None:
+        try:
+            return min(RETRY_MAX_SECONDS, max(0.0, float(retry_after)))
+        except ValueError:
+            pass  # HTTP-date form: fall back to backoff
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+async def download_image_async(session, url, photo_id, timeout=DOWNLOAD_TIMEOUT, retries=None):
+    """Download image asynchronously. Returns (photo_id, image_bytes or None, error or None)"""
+    retries = DOWNLOAD_RETRIES if retries is None else retries
+    error = None
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        retry_after = None
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 200:
+                    image_bytes = await response.read()
+                    stats['downloads'] += 1
+                    stats['bytes'] += len(image_bytes)
+                    metrics.observe('download', time.perf_counter() - start)
+                    return photo_id, image_bytes, None
+                error = f"HTTP {response.status}"
+                if response.status not in RETRY_STATUSES:
+                    break
+                retry_after = response.headers.get('Retry-After')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        except Exception as e:
+            error = str(e)
+            break
+
+        if attempt < retries:
+            stats['retries'] += 1
+            await asyncio.sleep(retry_delay(attempt, retry_after))
+
+    stats['failures'] += 1
+    return photo_id, None, error
+
+def get_stats():
+    return dict(stats)
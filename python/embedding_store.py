@@ -0,0 +1,558 @@
+"""Binary per-album embedding store.
+
+Each album lives in its own directory under ENCODINGS_DIR:
+
+    album_<id>/embeddings.f32   raw float32 matrix (count x dim), L2-normalized rows
+    album_<id>/bboxes.f32       raw float32 matrix (count x 4)
+    album_<id>/meta.json        {"version", "dim", "count", "generation", "segment", "photo_ids", "deleted_rows", "aliases"}
+    album_<id>/journal.jsonl    changes since meta.json was written, one JSON line each
+
+The matrix files carry no header so they can be memory-mapped straight into
+NumPy and handed to FAISS without any conversion.
+
+Writes are crash-safe and proportional to the change:
+
+- Appends, tombstones and alias changes write their rows to the end of the
+  matrix files, fsync them, then commit by appending one line to the journal.
+  Loading replays the journal on top of meta.json. A torn last line, or matrix
+  bytes past the committed count, belong to a write that never committed: they
+  are ignored on load and cut off by the next write.
+- Full rewrites (``save_album``, ``compact_album``, ``install_album``) write a
+  new segment of matrix files (``embeddings.<segment>.f32``) next to the live
+  one and swap in meta.json pointing to it with an atomic rename; the old
+  segment and the journal are deleted afterwards. Readers and crashes see the
+  old album or the new one, never a mix.
+- ``compact_journal`` folds a long journal back into meta.json, which callers
+  do in the background (JOURNAL_COMPACT_ENTRIES).
+
+Row numbers are stable face ids: appends add rows at the end and removals
+only record the rows in ``deleted_rows`` (tombstones). ``compact_album``
+drops tombstoned rows and renumbers, which callers do once fragmentation
+crosses their threshold. ``generation`` increases on every change.
+
+``aliases`` are [alias_photo_id, photo_id] pairs: near-duplicate photos
+(dedup.py) that have no rows of their own and match wherever their canonical
+photo does.
+"""
+import os
+import json
+import shutil
+import threading
+import numpy as np
+
+STORE_VERSION = 1
+EMBEDDING_DIM = 512
+BBOX_DIM = 4
+
+EMBEDDINGS_FILE = 'embeddings.f32'
+BBOXES_FILE = 'bboxes.f32'
+META_FILE = 'meta.json'
+JOURNAL_FILE = 'journal.jsonl'
+
+STORE_FSYNC = os.environ.get('STORE_FSYNC', 'true').lower() == 'true'
+# Journal entries after which the journal is folded back into meta.json
+JOURNAL_COMPACT_ENTRIES = int(os.environ.get('JOURNAL_COMPACT_ENTRIES', 64))
+WRITE_BLOCK_ROWS = 65536
+
+
+class AlbumEncodings:
+    """Face embeddings of one album, row-aligned with photo ids and bboxes"""
+    __slots__ = ('album_id', 'embeddings', 'bboxes', 'photo_ids', 'deleted_rows', 'generation', 'aliases',
+                 'journal_entries', '_photo_index', '_alias_groups')
+
+    def __init__(self, album_id, embeddings, bboxes, photo_ids, deleted_rows=None, generation=0, aliases=None,
+                 journal_entries=0):
+        self.album_id = album_id
+        self.embeddings = embeddings
+        self.bboxes = bboxes
+        self.photo_ids = photo_ids
+        self.deleted_rows = np.asarray(deleted_rows if deleted_rows is not None else [], dtype=np.int64)
+        self.generation = generation
+        self.aliases = dict(aliases or {})  # alias photo id -> canonical photo id
+        self.journal_entries = journal_entries  # changes not yet folded into meta.json
+        self._photo_index = None
+        self._alias_groups = None
+
+    def __len__(self):
+        """Number of live (not tombstoned) faces"""
+        return len(self.photo_ids) - len(self.deleted_rows)
+
+    @property
+    def num_rows(self):
+        return len(self.photo_ids)
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    @property
+    def nbytes(self):
+        """Approximate anonymous memory held by this object.
+
+        Memory-mapped embeddings/bboxes are page cache the kernel can drop
+        under pressure, so only in-RAM arrays and the photo id list count.
+        """
+        total = 64 * len(self.photo_ids) + 128 * len(self.aliases) + self.deleted_rows.nbytes
+        for array in (self.embeddings, self.bboxes):
+            if not isinstance(array, np.memmap):
+                total += array.nbytes
+        if self._photo_index is not None:
+            total += self._photo_index[0].nbytes + 64 * len(self._photo_index[1])
+        return total
+
+    @property
+    def fragmentation(self):
+        """Fraction of stored rows that are tombstones"""
+        return len(self.deleted_rows) / self.num_rows if self.num_rows else 0.0
+
+    def live_rows(self):
+        """Row numbers (= face ids) of faces that are not tombstoned"""
+        rows = np.arange(self.num_rows, dtype=np.int64)
+        if len(self.deleted_rows):
+            rows = np.setdiff1d(rows, self.deleted_rows, assume_unique=True)
+        return rows
+
+    def rows_for_photos(self, photo_ids):
+        """Live row numbers belonging to any of ``photo_ids`` (the photo_id -> face id map)"""
+        codes, unique_photo_ids = self.photo_index()
+        code_of = {photo_id: code for code, photo_id in enumerate(unique_photo_ids)}
+        target_codes = [code_of[p] for p in photo_ids if p in code_of]
+        if not target_codes:
+            return np.empty(0, dtype=np.int64)
+        rows = np.flatnonzero(np.isin(codes, target_codes)).astype(np.int64)
+        if len(self.deleted_rows):
+            rows = np.setdiff1d(rows, self.deleted_rows, assume_unique=True)
+        return rows
+
+    def photo_index(self):
+        """Dense int32 photo code per row plus the unique photo ids, computed once"""
+        if self._photo_index is None:
+            code_of = {}
+            codes = np.empty(len(self.photo_ids), dtype=np.int32)
+            for row, photo_id in enumerate(self.photo_ids):
+                codes[row] = code_of.setdefault(photo_id, len(code_of))
+            self._photo_index = (codes, list(code_of))
+        return self._photo_index
+
+    def alias_groups(self):
+        """canonical photo id -> [alias photo ids], computed once"""
+        if self._alias_groups is None:
+            groups = {}
+            for alias, photo_id in self.aliases.items():
+                groups.setdefault(photo_id, []).append(alias)
+            self._alias_groups = groups
+        return self._alias_groups
+
+
+def get_album_dir(encodings_dir, album_id):
+    return os.path.join(encodings_dir, f'album_{album_id}')
+
+def get_legacy_json_path(encodings_dir, album_id):
+    return os.path.join(encodings_dir, f'album_{album_id}.json')
+
+def album_exists(encodings_dir, album_id):
+    return os.path.exists(os.path.join(get_album_dir(encodings_dir, album_id), META_FILE))
+
+def normalize_rows(matrix):
+    """Return a float32 copy of ``matrix`` with L2-normalized rows"""
+    matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def empty_album(album_id, dim=EMBEDDING_DIM):
+    return AlbumEncodings(
+        album_id,
+        np.empty((0, dim), dtype=np.float32),
+        np.empty((0, BBOX_DIM), dtype=np.float32),
+        []
+    )
+
+def build_album(album_id, records, aliases=None):
+    """Build an in-memory album from ``{'photo_id', 'embedding', 'bbox'}`` records
+    (plus ``aliases`` {alias photo id: canonical photo id})"""
+    if not records:
+        album = empty_album(album_id)
+        album.aliases = dict(aliases or {})
+        return album
+    embeddings = normalize_rows([r['embedding'] for r in records])
+    bboxes = np.array([r['bbox'] for r in records], dtype=np.float32).reshape(-1, BBOX_DIM)
+    photo_ids = [r['photo_id'] for r in records]
+    return AlbumEncodings(album_id, embeddings, bboxes, photo_ids, aliases=aliases)
+
+def _fsync_file(f):
+    if STORE_FSYNC:
+        f.flush()
+        os.fsync(f.fileno())
+
+def _fsync_dir(path):
+    """Persist renames / new files in ``path`` (the directory entry itself)"""
+    if STORE_FSYNC:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def temp_path(path):
+    """Temp file next to ``path``, unique per process and thread (writers may share the directory)"""
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+def write_json_atomic(path, data, **dump_args):
+    """Write JSON through a temp file and an atomic rename: readers and crashes see the old or the new file"""
+    tmp_path = temp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, **dump_args)
+        _fsync_file(f)
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path) or '.')
+
+def _write_meta(album_dir, dim, photo_ids, deleted_rows=(), generation=0, aliases=None, segment=0):
+    meta = {
+        'version': STORE_VERSION,
+        'dim': int(dim),
+        'count': len(photo_ids),
+        'generation': generation,
+        'segment': segment,
+        'photo_ids': photo_ids,
+        'deleted_rows': [int(r) for r in deleted_rows],
+        'aliases': [[alias, photo_id] for alias, photo_id in (aliases or {}).items()]
+    }
+    write_json_atomic(os.path.join(album_dir, META_FILE), meta, separators=(',', ':'))
+
+def _read_meta(album_dir):
+    with open(os.path.join(album_dir, META_FILE), 'r') as f:
+        return json.load(f)
+
+def _meta_aliases(meta):
+    return {alias: photo_id for alias, photo_id in meta.get('aliases', [])}
+
+def _read_journal(album_dir, generation):
+    """Entries newer than ``generation``, and the byte length of the intact part of the journal"""
+    entries, valid_bytes = [], 0
+    try:
+        with open(os.path.join(album_dir, JOURNAL_FILE), 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line) if line.endswith(b'\n') else None
+                except ValueError:
+                    entry = None
+                if entry is None:
+                    break  # torn last line: the change it belonged to never committed
+                valid_bytes += len(line)
+                if entry['generation'] > generation:
+                    entries.append(entry)
+    except FileNotFoundError:
+        pass
+    return entries, valid_bytes
+
+def _read_state(album_dir):
+    """meta.json with the journal replayed on top of it"""
+    meta = _read_meta(album_dir)
+    entries, journal_bytes = _read_journal(album_dir, meta.get('generation', 0))
+    state = {
+        'dim': meta['dim'],
+        'segment': meta.get('segment', 0),
+        'generation': meta.get('generation', 0),
+        'photo_ids': meta['photo_ids'],
+        'deleted_rows': set(meta.get('deleted_rows', [])),
+        'aliases': _meta_aliases(meta),
+        'journal_entries': len(entries),
+        'journal_bytes': journal_bytes
+    }
+    for entry in entries:
+        if entry['op'] == 'append':
+            state['photo_ids'].extend(entry['photo_ids'])
+            state['aliases'].update(_meta_aliases(entry))
+        elif entry['op'] == 'tombstone':
+            state['deleted_rows'].update(entry['rows'])
+        elif entry['op'] == 'unlink':
+            renamed = dict(entry['renamed'])
+            if renamed:
+                state['photo_ids'] = [renamed.get(p, p) for p in state['photo_ids']]
+            state['aliases'] = _meta_aliases(entry)
+        state['generation'] = entry['generation']
+    return state
+
+def _append_journal(album_dir, state, entry):
+    """Commit one change by appending it to the journal (a torn tail is cut off first)"""
+    path = os.path.join(album_dir, JOURNAL_FILE)
+    created = not os.path.exists(path)
+    line = json.dumps({'generation': state['generation'] + 1, **entry}, separators=(',', ':')) + '\n'
+    with open(path, 'ab') as f:
+        if f.tell() != state['journal_bytes']:
+            f.truncate(state['journal_bytes'])
+        f.write(line.encode())
+        _fsync_file(f)
+    if created:
+        _fsync_dir(album_dir)
+
+def _discard_journal(album_dir):
+    try:
+        os.remove(os.path.join(album_dir, JOURNAL_FILE))
+    except FileNotFoundError:
+        pass
+
+def _matrix_paths(album_dir, segment):
+    """(embeddings, bboxes) files of a segment; segment 0 keeps the original file names"""
+    if not segment:
+        return os.path.join(album_dir, EMBEDDINGS_FILE), os.path.join(album_dir, BBOXES_FILE)
+    return os.path.join(album_dir, f'embeddings.{segment}.f32'), os.path.join(album_dir, f'bboxes.{segment}.f32')
+
+def _write_matrix(path, matrix, rows=None):
+    """Write (the ``rows`` of) a matrix blockwise, so a memory-mapped source is never loaded whole"""
+    count = len(matrix) if rows is None else len(rows)
+    with open(path, 'wb') as f:
+        for start in range(0, count, WRITE_BLOCK_ROWS):
+            block = matrix[start:start + WRITE_BLOCK_ROWS] if rows is None else matrix[rows[start:start + WRITE_BLOCK_ROWS]]
+            f.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+        _fsync_file(f)
+
+def _append_matrix(path, matrix, rows_before, row_width):
+    """Append rows to a raw matrix file, dropping bytes past ``rows_before``"""
+    expected_size = rows_before * row_width * 4
+    with open(path, 'ab') as f:
+        if f.tell() != expected_size:
+            f.truncate(expected_size)
+            f.seek(expected_size)
+        f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+        _fsync_file(f)
+
+def _link_or_copy(source_path, path):
+    """Hard-link ``source_path`` as ``path``, or stream a copy across filesystems"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source_path, path)
+    except OSError:
+        shutil.copyfile(source_path, path)
+        with open(path, 'rb+') as f:
+            _fsync_file(f)
+
+def _map_matrix(path, count, width, mmap):
+    if count == 0:
+        return np.empty((0, width), dtype=np.float32)
+    if mmap:
+        return np.memmap(path, dtype=np.float32, mode='r', shape=(count, width))
+    return np.fromfile(path, dtype=np.float32, count=count * width).reshape(count, width)
+
+def _previous_state(album_dir):
+    return _read_state(album_dir) if os.path.exists(os.path.join(album_dir, META_FILE)) else None
+
+def _new_segment(previous):
+    return previous['segment'] + 1 if previous is not None else 0
+
+def _commit_segment(album_dir, previous, segment, dim, photo_ids, deleted_rows, aliases):
+    """Swap in a fully written segment: meta.json is renamed over the old one, then
+    the old segment files and the journal (all older than the new meta) are dropped"""
+    _fsync_dir(album_dir)
+    generation = previous['generation'] + 1 if previous is not None else 1
+    _write_meta(album_dir, dim, photo_ids, deleted_rows, generation, aliases, segment)
+    _discard_journal(album_dir)
+    if previous is not None and previous['segment'] != segment:
+        for path in _matrix_paths(album_dir, previous['segment']):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def save_album(encodings_dir, album):
+    """Write the whole album as a new segment, replacing any previous contents"""
+    album_dir = get_album_dir(encodings_dir, album.album_id)
+    os.makedirs(album_dir, exist_ok=True)
+    previous = _previous_state(album_dir)
+    segment = _new_segment(previous)
+    embeddings_path, bboxes_path = _matrix_paths(album_dir, segment)
+    _write_matrix(embeddings_path, album.embeddings)
+    _write_matrix(bboxes_path, album.bboxes)
+    _commit_segment(album_dir, previous, segment, album.dim, list(album.photo_ids), album.deleted_rows, album.aliases)
+
+def install_album(source_dir, encodings_dir, album_id):
+    """Make the album stored under ``source_dir`` (a job checkpoint) the album's
+    contents without reading it into memory: its matrix files become a new
+    segment by hard link (or copy) and its journal is folded into the new meta.
+    The source is left intact. Returns False if ``source_dir`` has no such album.
+    """
+    if not album_exists(source_dir, album_id):
+        return False
+    source_dir = get_album_dir(source_dir, album_id)
+    source = _read_state(source_dir)
+    album_dir = get_album_dir(encodings_dir, album_id)
+    os.makedirs(album_dir, exist_ok=True)
+    previous = _previous_state(album_dir)
+    segment = _new_segment(previous)
+    for source_path, path in zip(_matrix_paths(source_dir, source['segment']), _matrix_paths(album_dir, segment)):
+        _link_or_copy(source_path, path)
+    _commit_segment(album_dir, previous, segment, source['dim'], source['photo_ids'],
+                    sorted(source['deleted_rows']), source['aliases'])
+    return True
+
+def append_album(encodings_dir, album_id, new_album):
+    """Append the rows of ``new_album`` to the stored album; only the delta is written.
+
+    Returns the row number (face id) of the first appended row.
+    """
+    album_dir = get_album_dir(encodings_dir, album_id)
+    if not album_exists(encodings_dir, album_id):
+        new_album.album_id = album_id
+        save_album(encodings_dir, new_album)
+        return 0
+
+    state = _read_state(album_dir)
+    count = len(state['photo_ids'])
+    if len(new_album) == 0 and not new_album.aliases:
+        return count
+    if len(new_album) and state['dim'] != new_album.dim:
+        raise ValueError(f"Embedding dim mismatch: store has {state['dim']}, got {new_album.dim}")
+    if len(new_album):
+        embeddings_path, bboxes_path = _matrix_paths(album_dir, state['segment'])
+        _append_matrix(embeddings_path, new_album.embeddings, count, state['dim'])
+        _append_matrix(bboxes_path, new_album.bboxes, count, BBOX_DIM)
+    _append_journal(album_dir, state, {
+        'op': 'append',
+        'photo_ids': list(new_album.photo_ids),
+        'aliases': [[alias, photo_id] for alias, photo_id in new_album.aliases.items()]
+    })
+    return count
+
+def tombstone_rows(encodings_dir, album_id, rows):
+    """Mark rows as deleted (one journal entry, the matrix files are not touched)"""
+    album_dir = get_album_dir(encodings_dir, album_id)
+    state = _read_state(album_dir)
+    new_rows = sorted(set(int(r) for r in rows) - state['deleted_rows'])
+    if new_rows:
+        _append_journal(album_dir, state, {'op': 'tombstone', 'rows': new_rows})
+
+def unlink_photos(encodings_dir, album_id, photo_ids):
+    """Drop removed photos from the alias map before their rows are tombstoned.
+
+    Aliases being removed are simply forgotten. A removed canonical photo that
+    still has aliases hands its rows to the first of them (the rest point to
+    it), so those rows must not be tombstoned. Returns (promoted canonical
+    photo ids, whether anything changed).
+    """
+    album_dir = get_album_dir(encodings_dir, album_id)
+    state = _read_state(album_dir)
+    aliases = state['aliases']
+    removed = set(photo_ids)
+    kept = {alias: photo_id for alias, photo_id in aliases.items() if alias not in removed}
+    heirs = {}
+    for alias, photo_id in kept.items():
+        if photo_id in removed:
+            heirs.setdefault(photo_id, []).append(alias)
+    if len(kept) == len(aliases) and not heirs:
+        return set(), False
+
+    renamed = []
+    for photo_id, members in heirs.items():
+        heir = members[0]
+        renamed.append([photo_id, heir])
+        del kept[heir]
+        kept.update((alias, heir) for alias in members[1:])
+    _append_journal(album_dir, state, {
+        'op': 'unlink',
+        'renamed': renamed,
+        'aliases': [[alias, photo_id] for alias, photo_id in kept.items()]
+    })
+    return set(heirs), True
+
+def compact_album(encodings_dir, album_id):
+    """Rewrite the album without its tombstoned rows, streamed from the memory-mapped
+    segment into a new one. Row numbers are reassigned"""
+    album = load_album(encodings_dir, album_id)
+    if album is None or len(album.deleted_rows) == 0:
+        return album
+    album_dir = get_album_dir(encodings_dir, album_id)
+    previous = _previous_state(album_dir)
+    segment = _new_segment(previous)
+    live_rows = album.live_rows()
+    embeddings_path, bboxes_path = _matrix_paths(album_dir, segment)
+    _write_matrix(embeddings_path, album.embeddings, live_rows)
+    _write_matrix(bboxes_path, album.bboxes, live_rows)
+    _commit_segment(album_dir, previous, segment, album.dim, [album.photo_ids[i] for i in live_rows], (), album.aliases)
+    return load_album(encodings_dir, album_id)
+
+def compact_journal(encodings_dir, album_id, min_entries=1):
+    """Fold the journal into meta.json once it holds ``min_entries`` entries.
+    Contents and generation stay the same. Returns True if it was folded"""
+    album_dir = get_album_dir(encodings_dir, album_id)
+    if not album_exists(encodings_dir, album_id):
+        return False
+    state = _read_state(album_dir)
+    if state['journal_entries'] < min_entries:
+        return False
+    _write_meta(album_dir, state['dim'], state['photo_ids'], sorted(state['deleted_rows']),
+                state['generation'], state['aliases'], state['segment'])
+    _discard_journal(album_dir)
+    return True
+
+def load_album(encodings_dir, album_id, mmap=True):
+    """Load an album from the binary store, memory-mapped by default. Returns None if missing"""
+    album_dir = get_album_dir(encodings_dir, album_id)
+    for attempt in range(3):
+        if not album_exists(encodings_dir, album_id):
+            return None
+        state = _read_state(album_dir)
+        count, dim = len(state['photo_ids']), state['dim']
+        embeddings_path, bboxes_path = _matrix_paths(album_dir, state['segment'])
+        try:
+            embeddings = _map_matrix(embeddings_path, count, dim, mmap)
+            bboxes = _map_matrix(bboxes_path, count, BBOX_DIM, mmap)
+            break
+        except FileNotFoundError:
+            # A concurrent save swapped in a new segment after we read the meta
+            if attempt == 2:
+                raise
+    return AlbumEncodings(album_id, embeddings, bboxes, state['photo_ids'], sorted(state['deleted_rows']),
+                          state['generation'], state['aliases'], state['journal_entries'])
+
+def load_legacy_json(encodings_dir, album_id):
+    """AlbumEncodings of ``album_<id>.json`` read in memory (None if there is none)"""
+    json_path = get_legacy_json_path(encodings_dir, album_id)
+    if not os.path.exists(json_path):
+        return None
+    try:
+        with open(json_path, 'r') as f:
+            return build_album(album_id, json.load(f))
+    except FileNotFoundError:
+        return None  # Migrated meanwhile
+
+def migrate_legacy_json(encodings_dir, album_id, keep_json=True):
+    """Convert ``album_<id>.json`` into the binary store.
+
+    The JSON file is renamed to ``album_<id>.json.migrated`` (or deleted when
+    ``keep_json`` is False) so the migration only ever runs once.
+    Returns the number of faces migrated, or None if there was nothing to do.
+    """
+    json_path = get_legacy_json_path(encodings_dir, album_id)
+    encodings = load_legacy_json(encodings_dir, album_id)
+    if encodings is None:
+        return None
+    save_album(encodings_dir, encodings)
+
+    try:
+        if keep_json:
+            os.replace(json_path, json_path + '.migrated')
+        else:
+            os.remove(json_path)
+    except FileNotFoundError:
+        pass  # A concurrent migration already moved it: same contents, already migrated
+    return len(encodings)
+
+def list_albums(encodings_dir):
+    """Ids of every album in ``encodings_dir``, binary store or legacy JSON"""
+    album_ids = set(list_legacy_albums(encodings_dir))
+    for name in os.listdir(encodings_dir):
+        if name.startswith('album_') and os.path.exists(os.path.join(encodings_dir, name, META_FILE)):
+            album_ids.add(name[len('album_'):])
+    return sorted(album_ids)
+
+def list_legacy_albums(encodings_dir):
+    """Album ids that still only exist as legacy JSON files"""
+    album_ids = []
+    for name in sorted(os.listdir(encodings_dir)):
+        if name.startswith('album_') and name.endswith('.json'):
+            album_ids.append(name[len('album_'):-len('.json')])
+    return album_ids
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
-import json
 import requests
-import os
 import sys
+import time
 
-ENCODINGS_DIR = '/Users/nguyenhoang/Library/CloudStorage/GoogleDrive-hodamedia@c3hbttt.edu.vn/My Drive/ung-dung/face-app/data/encodings'
+FACE_API_URL = 'http://localhost:5001'
+POLL_SECONDS = 2
 
 def encode_album(album_id):
     response = requests.get(f'http://localhost:3000/api/albums/{album_id}/photos')
@@ -13,44 +13,42 @@ def encode_album(album_id):
     print(f"Total photos in album {album_id}: {len(photos)}")
 
     valid_photos = [{
-        'id': p['id'], 
+        'id': p['id'],
         'url': p['thumbnail_url'].replace('=s220', '=s800') if p['thumbnail_url'] else p['full_url']
     } for p in photos if p.get('thumbnail_url')]
 
     print(f"Valid photos with thumbnails: {len(valid_photos)}")
 
-    batch_size = 50
-    all_encodings = []
-
-    for i in range(0, len(valid_photos), batch_size):
-        batch = valid_photos[i:i+batch_size]
-        batch_num = i // batch_size + 1
-        print(f"Batch {batch_num}: photos {i+1} to {min(i+batch_size, len(valid_photos))}...", end=" ", flush=True)
-        
+    # The Face API encodes the album as one background job (checkpointed, so a
+    # restart of the API resumes it) and we just poll its progress
+    response = requests.post(
+        f'{FACE_API_URL}/encode-album',
+        json={'album_id': album_id, 'photos': valid_photos},
+        timeout=30
+    )
+    job = response.json()
+    if 'job_id' not in job:
+        print(f"Error: {job.get('error')}")
+        return
+    if response.status_code == 409:
+        print(f"Album is already encoding, following job {job['job_id']}")
+
+    while True:
+        time.sleep(POLL_SECONDS)
         try:
-            response = requests.post(
-                'http://localhost:5001/encode-album',
-                json={'album_id': f"{album_id}_batch_{batch_num}", 'photos': batch},
-                timeout=600
-            )
-            result = response.json()
-            faces = result.get('total_faces', 0)
-            print(f"Faces: {faces}")
-            
-            batch_file = f"{ENCODINGS_DIR}/album_{album_id}_batch_{batch_num}.json"
-            if os.path.exists(batch_file):
-                with open(batch_file, 'r') as f:
-                    all_encodings.extend(json.load(f))
-        except Exception as e:
-            print(f"Error: {e}")
-
-    # Save combined
-    final_file = f'{ENCODINGS_DIR}/album_{album_id}.json'
-    with open(final_file, 'w') as f:
-        json.dump(all_encodings, f)
-
-    print(f"\n✅ Done! Total faces encoded: {len(all_encodings)}")
-    print(f"Saved to: {final_file}")
+            job = requests.get(f"{FACE_API_URL}/jobs/{job['job_id']}", timeout=10).json()
+        except requests.RequestException as e:
+            print(f"\nFace API unavailable ({e}), retrying...")
+            continue
+        print(f"\r{job['status']}: {job['processed_photos']}/{job['total_photos']} photos, "
+              f"{job['total_faces']} faces ({job['progress_percent']}%)", end="", flush=True)
+        if job['status'] in ('completed', 'failed', 'cancelled'):
+            break
+
+    if job['status'] == 'completed':
+        print(f"\n✅ Done! Total faces encoded: {job['total_faces']} ({job['failed']} photos without faces)")
+    else:
+        print(f"\n❌ Job {job['status']}: {job.get('error')}")
 
 if __name__ == '__main__':
     album_id = sys.argv[1] if len(sys.argv) > 1 else 2
@@ -0,0 +1,168 @@
+"""Process-pool album encoding with one InsightFace model per worker process.
+
+Threads in the API process share one ``face_app`` and the GIL, so PIL decode,
+array conversion and InsightFace's Python post-processing serialize. Here each
+worker process loads its own model once at startup, with ONNX intra-op
+threads pinned so that processes x threads matches the core count.
+
+Data crosses the process boundary through shared memory rather than pickled
+lists: the parent packs a group's image bytes into one shared block, and the
+worker returns all face embeddings of the group as one float32 shared block.
+Only small metadata (photo ids, offsets, bboxes) is pickled.
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+ENCODE_PROCESSES = int(os.environ.get('ENCODE_PROCESSES', 0))  # 0 = encode in the API process
+ONNX_THREADS_PER_PROCESS = int(os.environ.get('ONNX_THREADS_PER_PROCESS', 0))  # 0 = cores / processes
+
+# Set in each worker process by _init_worker
+_worker_face_app = None
+
+_pool = None
+
+
+def threads_per_process(processes):
+    if ONNX_THREADS_PER_PROCESS > 0:
+        return ONNX_THREADS_PER_PROCESS
+    return max(1, (os.cpu_count() or 1) // max(1, processes))
+
+def _init_worker(intra_op_threads):
+    global _worker_face_app
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    from face_model import load_face_model, warm_up
+    _worker_face_app = load_face_model(intra_op_threads=intra_op_threads)
+    warm_up(_worker_face_app)
+
+def _encode_group(input_name, entries):
+    """Worker side: decode and encode one group of images.
+
+    ``entries`` = [(photo_id, offset, size)] into the input block. Returns
+    (output block name or None, dim, [(photo_id, num_faces, bboxes, error)]);
+    face rows in the output block follow the order of the returned list.
+    """
+    from batch_encoder import encode_images
+    from image_io import decode_for_detection
+
+    shm = shared_memory.SharedMemory(name=input_name)
+    try:
+        decoded, outcomes = [], []
+        for photo_id, offset, size in entries:
+            image = decode_for_detection(bytes(shm.buf[offset:offset + size]))
+            if image is None:
+                outcomes.append((photo_id, 0, [], "Failed to load image"))
+            else:
+                decoded.append((photo_id, image))
+    finally:
+        shm.close()
+
+    try:
+        faces_by_photo = encode_images(_worker_face_app, decoded)
+    except Exception as e:
+        return None, 0, outcomes + [(photo_id, 0, [], str(e)) for photo_id, _ in decoded]
+
+    embeddings = []
+    for photo_id, _ in decoded:
+        faces = faces_by_photo[photo_id]
+        outcomes.append((photo_id, len(faces), [bbox for _, bbox in faces], None))
+        embeddings.extend(emb for emb, _ in faces)
+    if not embeddings:
+        return None, 0, outcomes
+
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    out = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+    np.ndarray(matrix.shape, dtype=np.float32, buffer=out.buf)[:] = matrix
+    # Spawned workers share the parent's resource tracker, so the parent's unlink
+    # settles this block; the tracker only reclaims it if the parent dies first
+    out.close()
+    return out.name, matrix.shape[1], outcomes
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        threads = threads_per_process(ENCODE_PROCESSES)
+        print(f"🧵 Starting {ENCODE_PROCESSES} encoding processes x {threads} ONNX threads")
+        _pool = ProcessPoolExecutor(
+            max_workers=ENCODE_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(threads,)
+        )
+    return _pool
+
+def _pack_images(images):
+    """Copy image bytes into one shared block. Returns (block, [(photo_id, offset, size)])"""
+    total = sum(len(image_bytes) for _, image_bytes in images)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, total))
+    entries, offset = [], 0
+    for photo_id, image_bytes in images:
+        shm.buf[offset:offset + len(image_bytes)] = image_bytes
+        entries.append((photo_id, offset, len(image_bytes)))
+        offset += len(image_bytes)
+    return shm, entries
+
+def _collect(output_name, dim, outcomes):
+    """Parent side: turn a worker result into [(photo_id, [(embedding, bbox)], error)]"""
+    matrix = None
+    if output_name is not None:
+        shm = shared_memory.SharedMemory(name=output_name)
+        try:
+            num_faces = sum(n for _, n, _, _ in outcomes)
+            matrix = np.ndarray((num_faces, dim), dtype=np.float32, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    results, row = [], 0
+    for photo_id, num_faces, bboxes, error in outcomes:
+        faces = [(matrix[row + i], bboxes[i]) for i in range(num_faces)]
+        row += num_faces
+        results.append((photo_id, faces, error))
+    return results
+
+def encode_in_processes(images):
+    """Encode ``[(photo_id, image_bytes)]`` across the worker pool.
+
+    Images are split into one group per process. Returns
+    ``[(photo_id, [(embedding, bbox), ...], error)]``.
+    """
+    images = [(photo_id, image_bytes) for photo_id, image_bytes in images if image_bytes is not None]
+    if not images:
+        return []
+    pool = get_pool()
+    groups = [images[i::ENCODE_PROCESSES] for i in range(ENCODE_PROCESSES)]
+
+    submitted = []
+    try:
+        for group in groups:
+            if not group:
+                continue
+            shm, entries = _pack_images(group)
+            submitted.append((group, shm, pool.submit(_encode_group, shm.name, entries)))
+
+        results = []
+        for group, _, future in submitted:
+            try:
+                results.extend(_collect(*future.result()))
+            except BrokenProcessPool as e:
+                # A worker died (e.g. OOM-killed): fail this group and start a fresh pool next time
+                shutdown_pool()
+                results.extend((photo_id, [], f"Encoding worker crashed: {e}") for photo_id, _ in group)
+            except Exception as e:
+                results.extend((photo_id, [], str(e)) for photo_id, _ in group)
+        return results
+    finally:
+        for _, shm, _ in submitted:
+            shm.close()
+            shm.unlink()
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
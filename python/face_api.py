@@ -1,22 +1,44 @@
 import os
-import json
-import base64
-import asyncio
-import aiohttp
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from io import BytesIO
-from PIL import Image
-import insightface
-from insightface.app import FaceAnalysis
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import time
+from collections import OrderedDict, namedtuple
+
+from album_cache import ALBUM_CACHE_MAX_MB, HOT_ALBUMS_FILE, PREWARM_ALBUMS, AlbumCache
+from batch_encoder import SMALL_FACE_SIDE, encode_images
+from clustering import PEOPLE_MIN_PHOTOS, cluster_album, load_people, save_people, search_people
+from coalescer import Coalescer
+import replicas
+import downloader
+import encode_pool
+import metrics
+from embedding_store import (
+    JOURNAL_COMPACT_ENTRIES, album_exists, append_album, build_album, compact_album, compact_journal, empty_album,
+    get_legacy_json_path, list_albums, load_album, load_legacy_json, migrate_legacy_json, save_album, tombstone_rows,
+    unlink_photos
+)
+from dedup import DEDUP_ENABLED, NearDuplicates
+from face_cache import FACE_CACHE_DIR, FACE_CACHE_MAX_MB, FaceCache, content_key, source_key
+from face_model import FACE_MODULES, MODEL_NAME, load_face_model, warm_up
+from pipeline import DOWNLOAD_CONCURRENCY, run_pipeline
+from jobs import JOB_WORKERS, JOBS_DIR, JobManager
+from image_io import ENCODE_MAX_SIDE, decode_for_detection, load_image_from_bytes
+from rwlock import ReadWriteLock
+from quantization import configured_precision
+from scheduler import PoolBusy, Scheduler
+from uploads import QUERY_MAX_SIDE, UploadError, buffer_pool, field_flag, read_query_image, release_request_buffers
+from vector_search import (
+    build_combined_matrix, build_search_matrix, expand_aliases, search_combined_many, search_index_many,
+    search_matrix_many
+)
 
 # Try to import FAISS for fast vector search
 try:
     import faiss
+    import ann_index
     FAISS_AVAILABLE = True
     print("✅ FAISS available - fast vector search enabled")
 except ImportError:
@@ -28,148 +50,468 @@ CORS(app)
 
 PORT = int(os.environ.get('PORT', 5001))
 MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 4))
-BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 10))
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 10))  # max photos per encode step of the pipeline
+# 'batched' = staged detection + batched ArcFace (batch_encoder.py), 'single' = face_app.get per photo
+ENCODER_MODE = os.environ.get('ENCODER_MODE', 'batched')
+CPU_COUNT = os.cpu_count() or 1
 
-# Semaphore to limit concurrent face processing
-MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 5))
-request_semaphore = threading.Semaphore(MAX_CONCURRENT_REQUESTS)
+# Separate admission pools for interactive search and bulk encoding
+scheduler = Scheduler()
+# Bind the port immediately and load the model in the background
+FAST_BOOT = os.environ.get('FAST_BOOT', 'true').lower() == 'true'
+# How long an inference request waits for a model that is still loading before a 503
+MODEL_WAIT_SECONDS = float(os.environ.get('MODEL_WAIT_SECONDS', 10))
 
 ENCODINGS_DIR = os.environ.get('ENCODINGS_DIR', os.path.join(os.path.dirname(__file__), '..', 'data', 'encodings'))
-STATUS_DIR = os.environ.get('STATUS_DIR', os.path.join(os.path.dirname(__file__), '..', 'data', 'status'))
+# Multi-album search: albums below COMBINED_ALBUM_MAX_FACES are searched through one
+# combined matrix (as long as together they stay under COMBINED_SEARCH_MAX_FACES)
+COMBINED_ALBUM_MAX_FACES = int(os.environ.get('COMBINED_ALBUM_MAX_FACES', 50000))
+COMBINED_SEARCH_MAX_FACES = int(os.environ.get('COMBINED_SEARCH_MAX_FACES', 200000))
+COMBINED_CACHE_ENTRIES = int(os.environ.get('COMBINED_CACHE_ENTRIES', 4))
+# Compact the store and rebuild the index once this fraction of rows are tombstones
+INDEX_REBUILD_FRAGMENTATION = float(os.environ.get('INDEX_REBUILD_FRAGMENTATION', 0.25))
 os.makedirs(ENCODINGS_DIR, exist_ok=True)
-os.makedirs(STATUS_DIR, exist_ok=True)
 
-# Initialize InsightFace model
-print("Loading InsightFace model...")
-face_app = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-face_app.prepare(ctx_id=0, det_size=(640, 640))
-print("✅ InsightFace model loaded!")
+# Face results per photo content, shared by all albums. The key covers every
+# setting that changes the embeddings, so changing one just misses the cache.
+face_cache = FaceCache(
+    FACE_CACHE_DIR, FACE_CACHE_MAX_MB * 2 ** 20,
+    f"{MODEL_NAME}/{ENCODER_MODE}/{ENCODE_MAX_SIDE}/{SMALL_FACE_SIDE}"
+)
+
+# InsightFace model, loaded by load_model(). With FAST_BOOT the HTTP server
+# starts right away and the model loads in the background; /ready turns 200
+# once it is loaded and warmed up.
+face_app = None
+model_ready = threading.Event()
+model_state = {'status': 'not_loaded', 'error': None, 'load_seconds': None}
+
+def load_model():
+    """Load and warm up the model, then mark the service ready"""
+    global face_app
+    start_time = time.time()
+    try:
+        model_state['status'] = 'loading'
+        print(f"Loading InsightFace model ({', '.join(FACE_MODULES) or 'all modules'})...")
+        loaded = load_face_model()
+        model_state['status'] = 'warming_up'
+        warm_up(loaded)
+        face_app = loaded
+        model_state.update(status='ready', load_seconds=round(time.time() - start_time, 1))
+        model_ready.set()
+        print(f"✅ InsightFace model loaded and warmed up in {model_state['load_seconds']}s")
+    except Exception as e:
+        model_state.update(status='error', error=str(e))
+        print(f"❌ Failed to load InsightFace model: {e}")
+
+def wait_until_ready(timeout=None):
+    return model_ready.wait(timeout)
+
+def model_unavailable():
+    """503 for inference endpoints while the model is not ready"""
+    if model_state['status'] == 'error':
+        return jsonify({'error': f"Không tải được model: {model_state['error']}"}), 503
+    response = jsonify({'error': 'Model đang khởi động, vui lòng thử lại sau', 'model_status': model_state['status']})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+def server_busy(busy):
+    """503 with a Retry-After hint when a scheduler pool is full"""
+    response = jsonify({'error': 'Server đang bận, vui lòng thử lại sau', 'pool': busy.pool})
+    response.headers['Retry-After'] = str(busy.retry_after)
+    return response, 503
 
-# In-memory cache for encodings and FAISS indexes
-encodings_cache = {}
-faiss_indexes = {}
+# Spawned encoding processes re-import this script as __mp_main__; they load
+# their own model in encode_pool instead.
+if __name__ != '__mp_main__':
+    if FAST_BOOT:
+        threading.Thread(target=load_model, name='model-loader', daemon=True).start()
+    else:
+        load_model()
+
+def album_footprint(encodings, index, matrix):
+    """Resident bytes of one cached album (encodings + FAISS index or search matrix)"""
+    nbytes = encodings.nbytes if encodings is not None else 0
+    if index is not None:
+        nbytes += ann_index.index_nbytes(index)
+    if matrix is not None:
+        nbytes += matrix.nbytes
+    return nbytes
+
+# In-memory LRU cache per album: encodings (memory-mapped AlbumEncodings), FAISS
+# index, or without FAISS a RAM-resident normalized search matrix
+album_cache = AlbumCache(
+    ALBUM_CACHE_MAX_MB * 2 ** 20, album_footprint,
+    hot_path=replicas.local_path(os.path.join(ENCODINGS_DIR, HOT_ALBUMS_FILE))
+)
 cache_lock = threading.Lock()
+index_locks = {}
 
-def get_encoding_path(album_id):
-    return os.path.join(ENCODINGS_DIR, f'album_{album_id}.json')
+# Background training of approximate (HNSW / IVF-PQ) indexes for large albums
+index_build_executor = ThreadPoolExecutor(max_workers=1)
+# Background store maintenance: dropping tombstoned rows, folding long journals
+compaction_executor = ThreadPoolExecutor(max_workers=1)
+pending_compactions = set()
+# Image decoding for the encode pipeline (PIL releases the GIL while decoding)
+decode_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Per-album searches of a multi-album query (FAISS and numpy release the GIL)
+search_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Combined search matrices for multi-album queries over small albums, LRU
+combined_matrices = OrderedDict()
+pending_index_builds = set()
 
-def get_status_path(album_id):
-    return os.path.join(STATUS_DIR, f'album_{album_id}.json')
+# People (face clusters) per album, recomputed in the background after the album changes
+CLUSTER_AFTER_ENCODE = os.environ.get('CLUSTER_AFTER_ENCODE', 'true').lower() == 'true'
+cluster_executor = ThreadPoolExecutor(max_workers=1)
+album_people = {}
+pending_clusterings = set()
 
-def update_status(album_id, status, processed=0, total=0, faces=0, error=None, current_photo=None):
-    """Update encoding status"""
-    status_data = {
-        'album_id': album_id,
-        'status': status,
-        'processed_photos': processed,
-        'total_photos': total,
-        'total_faces': faces,
-        'current_photo': current_photo,
-        'progress_percent': round((processed / total * 100) if total > 0 else 0, 1),
-        'error': error,
-        'updated_at': __import__('datetime').datetime.now().isoformat()
-    }
-    with open(get_status_path(album_id), 'w') as f:
-        json.dump(status_data, f)
-    return status_data
+# Serializes writes (encode / append / remove) to the same album's store
+album_locks = {}
 
-def load_image_from_bytes(image_bytes):
-    """Convert image bytes to numpy array"""
-    try:
-        img = Image.open(BytesIO(image_bytes))
-        img = img.convert('RGB')
-        return np.array(img)
-    except Exception as e:
-        print(f"Error loading image: {e}")
-        return None
+def get_album_lock(album_id):
+    with cache_lock:
+        return album_locks.setdefault(str(album_id), threading.Lock())
 
-def load_image_from_base64(base64_string):
-    """Decode base64 image to numpy array"""
-    try:
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        image_data = base64.b64decode(base64_string)
-        return load_image_from_bytes(image_data)
-    except Exception as e:
-        print(f"Error decoding base64 image: {e}")
+# Several replicas: albums are routed by consistent hashing (only the owner writes
+# an album's store), and changes are published so the others drop stale copies
+ring = replicas.HashRing(replicas.REPLICAS)
+replica_bus = replicas.connect() if len(ring) > 1 else replicas.LocalBus()
+
+def misdirected(album_id):
+    """421 naming the owning replica when an album write reaches another replica, else None"""
+    if ring.owns(album_id):
         return None
+    return jsonify({
+        'error': 'Album được xử lý bởi replica khác',
+        'album_id': album_id,
+        'replica': ring.owner(album_id)
+    }), 421
 
 def get_face_embeddings(image):
     """Get all face embeddings from image"""
-    faces = face_app.get(image)
+    with metrics.timed('inference'):
+        faces = face_app.get(image)
     if not faces:
         return []
     return [(face.embedding, face.bbox.tolist()) for face in faces]
 
-def get_largest_face_embedding(image):
-    """Get embedding of largest face"""
-    faces = face_app.get(image)
-    if not faces:
-        return None, None
-    largest_face = max(faces, key=lambda x: (x.bbox[2] - x.bbox[0]) * (x.bbox[3] - x.bbox[1]))
-    return largest_face.embedding, largest_face.bbox.tolist()
+def largest_face(faces):
+    """The (embedding, bbox) pair with the largest bbox area"""
+    return max(faces, key=lambda face: (face[1][2] - face[1][0]) * (face[1][3] - face[1][1]))
 
-def cosine_similarity(emb1, emb2):
-    """Calculate cosine similarity"""
-    return float(np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2)))
+def build_faiss_index(album, index_type='flat'):
+    """Build FAISS index for fast similarity search.
 
-def build_faiss_index(embeddings):
-    """Build FAISS index for fast similarity search"""
-    if not FAISS_AVAILABLE or len(embeddings) == 0:
+    The index is ID-mapped with store row numbers as face ids, so later
+    appends and removals can be applied with add_with_ids / remove_ids.
+    Flat indexes are built inline; approximate ones (HNSW / IVF-PQ) are
+    trained by ``schedule_index_build`` in the background.
+    """
+    if not FAISS_AVAILABLE or len(album) == 0:
         return None
+    with metrics.timed('index_build'):
+        return ann_index.build_index(album, index_type)
+
+def build_album_matrix(album):
+    """NumPy search matrix of an album (the search structure without FAISS)"""
+    with metrics.timed('matrix_build'):
+        return build_search_matrix(album)
+
+def has_album_encodings(album_id):
+    """Check whether an album has been encoded (binary store or legacy JSON)"""
+    return album_exists(ENCODINGS_DIR, album_id) or os.path.exists(get_legacy_json_path(ENCODINGS_DIR, album_id))
+
+def get_index_lock(album_id):
+    """RW lock guarding an album's cached encodings + index: searches read, deltas write"""
+    with cache_lock:
+        return index_locks.setdefault(str(album_id), ReadWriteLock())
+
+def get_cached_album(album_id):
+    """Consistent (encodings, faiss index) pair from the cache; call under the read lock"""
+    cached = album_cache.peek(album_id)
+    return (cached[0], cached[1]) if cached is not None else (None, None)
+
+def load_album_encodings(album_id):
+    """Load encodings from cache or the binary store (migrating legacy JSON on first load)"""
+    cached = album_cache.get(album_id)
+    if cached is not None:
+        return cached[0]
+    
+    legacy = None
+    if not album_exists(ENCODINGS_DIR, album_id):
+        if ring.owns(album_id):
+            with get_album_lock(album_id):
+                # Another request may have migrated it while this one waited
+                if not album_exists(ENCODINGS_DIR, album_id):
+                    migrated = migrate_legacy_json(ENCODINGS_DIR, album_id)
+                    if migrated is not None:
+                        print(f"📦 Migrated album {album_id} from JSON to binary store ({migrated} faces)")
+                    elif not album_exists(ENCODINGS_DIR, album_id):
+                        return None  # No legacy JSON either
+        else:
+            # Only the owner writes the store; serve the legacy JSON from memory meanwhile
+            legacy = load_legacy_json(ENCODINGS_DIR, album_id)
+            if legacy is None:
+                return None
     
-    dimension = len(embeddings[0])
-    index = faiss.IndexFlatIP(dimension)  # Inner product (cosine similarity for normalized vectors)
+    with metrics.timed('album_load'):
+        encodings = legacy if legacy is not None else load_album(ENCODINGS_DIR, album_id)
+        
+        # Reuse a persisted ANN index if it matches the store; otherwise serve from a
+        # flat index right away and train the ANN tier in the background
+        index = matrix = None
+        if FAISS_AVAILABLE and len(encodings):
+            index = ann_index.load_saved_index(ENCODINGS_DIR, album_id, encodings.generation)
+            if index is None:
+                index = build_faiss_index(encodings)
+        elif not FAISS_AVAILABLE:
+            matrix = build_album_matrix(encodings)
     
-    # Normalize embeddings for cosine similarity
-    embeddings_array = np.array(embeddings).astype('float32')
-    faiss.normalize_L2(embeddings_array)
-    index.add(embeddings_array)
+    album_cache.put(album_id, encodings, index, matrix)
     
-    return index
+    schedule_index_build(album_id)
+    return encodings
 
-def load_album_encodings(album_id):
-    """Load encodings from cache or file"""
-    with cache_lock:
-        if album_id in encodings_cache:
-            return encodings_cache[album_id]
-    
-    encoding_path = get_encoding_path(album_id)
-    if not os.path.exists(encoding_path):
-        return None
+def set_album_encodings(album_id, encodings):
+    """Replace the cached encodings and search structures of an album"""
+    index = build_faiss_index(encodings) if FAISS_AVAILABLE else None
+    matrix = build_album_matrix(encodings) if not FAISS_AVAILABLE else None
+    with get_index_lock(album_id).write():
+        album_cache.put(album_id, encodings, index, matrix)
+    schedule_index_build(album_id)
+
+def update_album_index(album_id, encodings, previous_generation, added_start=None, removed_rows=None):
+    """Apply an append/remove delta to a cached album instead of rebuilding its index.
+
+    Call under the album lock, so deltas land in store order. ``previous_generation``
+    is the store generation the delta was made against; a cached album of any
+    other generation is dropped instead (the next search reloads it).
+    ``added_start`` is the first newly appended row (all rows from there on are
+    new); ``removed_rows`` are the tombstoned rows. Cost is O(delta). HNSW
+    cannot delete, so its removed rows are filtered out at search time until
+    the next rebuild.
+    """
+    if album_id not in album_cache:
+        return  # Not loaded: the next search loads it fresh from the store
     
-    with open(encoding_path, 'r') as f:
-        encodings = json.load(f)
+    with get_index_lock(album_id).write():
+        if not album_cache.update(album_id, generation=previous_generation, encodings=encodings):
+            album_cache.pop(album_id)  # Evicted meanwhile, or cached from another generation
+            return
+        if not FAISS_AVAILABLE:
+            return  # get_search_matrix notices the new generation and rebuilds lazily
+        
+        index = album_cache.peek(album_id)[1]
+        if index is None:
+            index = build_faiss_index(encodings)
+            album_cache.update(album_id, index=index)
+        else:
+            if removed_rows is not None and len(removed_rows) and ann_index.supports_remove(index):
+                index.remove_ids(np.asarray(removed_rows, dtype=np.int64))
+            if added_start is not None and added_start < encodings.num_rows:
+                new_rows = np.arange(added_start, encodings.num_rows, dtype=np.int64)
+                index.add_with_ids(np.ascontiguousarray(encodings.embeddings[added_start:]), new_rows)
+            album_cache.resize(album_id)
     
-    # Build FAISS index
-    if FAISS_AVAILABLE and encodings:
-        embeddings = [np.array(e['embedding']) for e in encodings]
-        index = build_faiss_index(embeddings)
+    if index is not None and ann_index.worth_saving(index):
+        index_build_executor.submit(persist_album_index, album_id)
+    schedule_index_build(album_id)
+
+def schedule_index_build(album_id):
+    """Train the ANN tier in the background when the cached index type no longer fits the album size"""
+    if not FAISS_AVAILABLE:
+        return
+    encodings, index = get_cached_album(album_id)
+    with cache_lock:
+        if encodings is None or index is None or album_id in pending_index_builds:
+            return
+        if ann_index.choose_index_type(len(encodings)) == ann_index.index_type_of(index):
+            return
+        pending_index_builds.add(album_id)
+    index_build_executor.submit(build_album_index_background, album_id)
+
+def build_album_index_background(album_id):
+    try:
+        for _ in range(3):
+            encodings, _ = get_cached_album(album_id)
+            if encodings is None:
+                return
+            index_type = ann_index.choose_index_type(len(encodings))
+            print(f"🏗️ Building {index_type} index for album {album_id} ({len(encodings)} faces)...")
+            scheduler.yield_to_interactive()
+            start_time = time.time()
+            index = build_faiss_index(encodings, index_type)
+            
+            with get_index_lock(album_id).write():
+                if album_id not in album_cache:
+                    return
+                swapped = album_cache.update(album_id, generation=encodings.generation, index=index)
+            if swapped:
+                print(f"✅ {index_type} index for album {album_id} ready in {time.time() - start_time:.1f}s")
+                persist_album_index(album_id)
+                return
+            # The album changed while training: retrain against the latest generation
+    except Exception as e:
+        print(f"❌ Index build failed for album {album_id}: {e}")
+    finally:
         with cache_lock:
-            faiss_indexes[album_id] = index
-    
+            pending_index_builds.discard(album_id)
+
+def persist_album_index(album_id):
+    """Write the cached ANN index next to the encodings so restarts skip training
+    (owner replica only: the store directory is shared)"""
+    if not ring.owns(album_id):
+        return
+    with get_index_lock(album_id).read():
+        encodings, index = get_cached_album(album_id)
+        if encodings is None or index is None:
+            return
+        try:
+            ann_index.save_index(ENCODINGS_DIR, album_id, index, encodings.generation)
+        except Exception as e:
+            print(f"⚠️ Could not persist index for album {album_id}: {e}")
+
+def schedule_compaction(album_id, encodings):
+    """Compact the album's store in the background once enough rows are tombstones
+    or its journal is long (once at a time per album)"""
+    if (encodings.fragmentation <= INDEX_REBUILD_FRAGMENTATION
+            and encodings.journal_entries < JOURNAL_COMPACT_ENTRIES):
+        return False
+    album_id = str(album_id)
     with cache_lock:
-        encodings_cache[album_id] = encodings
-    
-    return encodings
+        if album_id in pending_compactions:
+            return True
+        pending_compactions.add(album_id)
+    compaction_executor.submit(compact_album_background, album_id)
+    return True
+
+def compact_album_background(album_id):
+    try:
+        scheduler.yield_to_interactive()
+        with get_album_lock(album_id):
+            encodings = load_album(ENCODINGS_DIR, album_id)
+            if encodings is None:
+                return
+            if encodings.fragmentation <= INDEX_REBUILD_FRAGMENTATION:
+                # Same contents and generation: caches and indexes stay valid
+                compact_journal(ENCODINGS_DIR, album_id)
+                return
+            start_time = time.time()
+            with metrics.timed('compaction'):
+                compacted = compact_album(ENCODINGS_DIR, album_id)
+            # Rows are renumbered: rebuild the cached index before any other write lands
+            if album_id in album_cache:
+                set_album_encodings(album_id, compacted)
+        publish_album_changed(album_id, compacted.generation)
+        print(f"🧹 Compacted album {album_id}: {encodings.num_rows} -> {compacted.num_rows} rows "
+              f"in {time.time() - start_time:.1f}s")
+        if CLUSTER_AFTER_ENCODE:
+            schedule_clustering(album_id)
+    except Exception as e:
+        print(f"❌ Compaction failed for album {album_id}: {e}")
+    finally:
+        with cache_lock:
+            pending_compactions.discard(album_id)
+
+def get_album_people(album_id, encodings):
+    """People of the album's current generation (memory, then disk), or None if not clustered yet"""
+    album_id = str(album_id)
+    with cache_lock:
+        people = album_people.get(album_id)
+    if people is None or people.generation != encodings.generation:
+        people = load_people(ENCODINGS_DIR, album_id, encodings.generation)
+        if people is None:
+            return None
+        with cache_lock:
+            album_people[album_id] = people
+    return people
+
+def schedule_clustering(album_id):
+    """Recompute the album's people in the background (once at a time per album)"""
+    album_id = str(album_id)
+    with cache_lock:
+        if album_id in pending_clusterings:
+            return
+        pending_clusterings.add(album_id)
+    cluster_executor.submit(cluster_album_background, album_id)
 
-async def download_image_async(session, url, photo_id, timeout=15):
-    """Download image asynchronously"""
+def cluster_album_background(album_id):
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'}
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout), headers=headers) as response:
-            if response.status == 200:
-                image_bytes = await response.read()
-                return photo_id, image_bytes, None
-            return photo_id, None, f"HTTP {response.status}"
+        for _ in range(3):
+            encodings = load_album(ENCODINGS_DIR, album_id)
+            if encodings is None:
+                return
+            scheduler.yield_to_interactive()
+            start_time = time.time()
+            with metrics.timed('clustering'):
+                people = cluster_album(encodings)
+            with get_album_lock(album_id):
+                # Only keep results for the generation still on disk
+                current = load_album(ENCODINGS_DIR, album_id)
+                if current is None or current.generation != encodings.generation:
+                    continue
+                if ring.owns(album_id):
+                    save_people(ENCODINGS_DIR, album_id, people)
+            with cache_lock:
+                album_people[album_id] = people
+            print(f"👥 Clustered album {album_id}: {len(people.listed())} people "
+                  f"({len(people)} clusters, {len(encodings)} faces) in {time.time() - start_time:.1f}s")
+            return
     except Exception as e:
-        return photo_id, None, str(e)
+        print(f"❌ Clustering failed for album {album_id}: {e}")
+    finally:
+        with cache_lock:
+            pending_clusterings.discard(album_id)
 
-async def download_batch_async(photos):
-    """Download multiple images concurrently"""
-    async with aiohttp.ClientSession() as session:
-        tasks = [download_image_async(session, p['url'], p['id']) for p in photos]
-        return await asyncio.gather(*tasks)
+def get_search_matrix(album_id, encodings):
+    """Get the cached numpy search matrix of an album, building it on demand"""
+    cached = album_cache.peek(album_id)
+    matrix = cached[2] if cached is not None else None
+    if matrix is None or matrix.generation != encodings.generation:
+        matrix = build_album_matrix(encodings)
+        album_cache.update(album_id, generation=encodings.generation, matrix=matrix)
+    return matrix
+
+def publish_album_changed(album_id, generation=None):
+    """Tell the other replicas the album's encodings changed (None: drop whatever they cache)"""
+    replica_bus.publish({'type': 'invalidate', 'album_id': str(album_id), 'generation': generation})
+
+def drop_stale_album(album_id, generation=None):
+    """Forget a cached album older than ``generation``; the next search reloads it from the store"""
+    album_id = str(album_id)
+    with get_index_lock(album_id).write():
+        cached = album_cache.peek(album_id)
+        if cached is None or (generation is not None and cached[0].generation >= generation):
+            return False
+        album_cache.pop(album_id)
+    with cache_lock:
+        album_people.pop(album_id, None)
+    return True
+
+def on_replica_message(message):
+    if message.get('type') == 'invalidate':
+        if drop_stale_album(message['album_id'], message.get('generation')):
+            print(f"♻️ Album {message['album_id']} changed on {message.get('origin')}, dropped from cache")
+    elif message.get('type') == 'resync':
+        # Messages may have been missed: compare every cached album with the store
+        for album_id, encodings, _, _ in album_cache.items():
+            current = load_album(ENCODINGS_DIR, album_id) if album_exists(ENCODINGS_DIR, album_id) else None
+            if current is None or current.generation != encodings.generation:
+                drop_stale_album(album_id)
+
+def prewarm_album_cache():
+    """Load the most searched albums (from previous runs) until the cache is nearly full"""
+    for album_id in album_cache.hot_albums(PREWARM_ALBUMS):
+        if album_cache.nbytes >= album_cache.max_bytes * 0.9:
+            break
+        if not ring.owns(album_id) or not has_album_encodings(album_id):
+            continue
+        try:
+            encodings = load_album_encodings(album_id)
+            print(f"🔥 Pre-warmed album {album_id} ({len(encodings)} faces)")
+        except Exception as e:
+            print(f"⚠️ Could not pre-warm album {album_id}: {e}")
 
 def process_image_for_encoding(args):
     """Process single image and extract face embeddings"""
@@ -177,7 +519,8 @@ def process_image_for_encoding(args):
     if image_bytes is None:
         return photo_id, [], "No image data"
     
-    image = load_image_from_bytes(image_bytes)
+    with metrics.timed('decode'):
+        image = load_image_from_bytes(image_bytes)
     if image is None:
         return photo_id, [], "Failed to load image"
     
@@ -187,34 +530,511 @@ def process_image_for_encoding(args):
         for emb, bbox in embeddings_with_bbox:
             results.append({
                 'photo_id': photo_id,
-                'embedding': emb.tolist(),
+                'embedding': emb,
                 'bbox': bbox
             })
         return photo_id, results, None
     except Exception as e:
         return photo_id, [], str(e)
 
+@metrics.timed('decode')
+def decode_photo(image_bytes):
+    return decode_for_detection(image_bytes)
+
+def decode_for_encoding(args):
+    photo_id, image_bytes = args
+    return photo_id, (decode_photo(image_bytes) if image_bytes is not None else None)
+
+def encode_decoded_images(decoded):
+    """Batched detection + recognition of already decoded ``[(photo_id, DecodedImage)]``"""
+    try:
+        faces_by_photo = encode_images(face_app, decoded)
+    except Exception as e:
+        return [(photo_id, [], str(e)) for photo_id, _ in decoded]
+    
+    outcomes = []
+    for photo_id, _ in decoded:
+        results = [{
+            'photo_id': photo_id,
+            'embedding': emb,
+            'bbox': bbox
+        } for emb, bbox in faces_by_photo[photo_id]]
+        outcomes.append((photo_id, results, None))
+    return outcomes
+
+def encode_downloaded_images(images_to_process):
+    """Decode and encode a batch of downloaded images.
+
+    Returns ``[(photo_id, results, error)]`` like ``process_image_for_encoding``.
+    In 'batched' mode images are decoded in parallel, then detection and
+    recognition each run batched across the whole group. With
+    ENCODE_PROCESSES > 0 the group is spread over the encoding process pool.
+    """
+    if encode_pool.ENCODE_PROCESSES > 0:
+        missing = [(photo_id, [], "No image data") for photo_id, image_bytes in images_to_process if image_bytes is None]
+        return missing + [
+            (photo_id, [{'photo_id': photo_id, 'embedding': emb, 'bbox': bbox} for emb, bbox in faces], error)
+            for photo_id, faces, error in encode_pool.encode_in_processes(images_to_process)
+        ]
+    
+    if ENCODER_MODE != 'batched':
+        return list(decode_executor.map(process_image_for_encoding, images_to_process))
+    
+    # Decode in parallel (PIL releases the GIL while decoding)
+    decoded_images = list(decode_executor.map(decode_for_encoding, images_to_process))
+    
+    outcomes = []
+    decoded = []
+    for photo_id, image in decoded_images:
+        if image is None:
+            outcomes.append((photo_id, [], "Failed to load image"))
+        else:
+            decoded.append((photo_id, image))
+    return outcomes + encode_decoded_images(decoded)
+
+def encode_photos(photos, on_photo=None):
+    """Stream ``photos`` through download -> decode -> encode, using the face cache.
+
+    Returns a dict with 'encodings', 'processed', 'failed_photos' (photos
+    that produced no faces, [{'photo_id', 'error'}], so callers can retry them
+    instead of losing them silently), 'cache_hits', 'encoded_faces' (faces
+    that went through the model), 'encode_seconds', and with DEDUP_ENABLED
+    'aliases' ({photo_id: canonical photo_id} of near-duplicates, see
+    dedup.py), 'inferences_avoided' and 'duplicates_collapsed'.
+    ``on_photo(photo_id, results, error, duplicate_of)`` is called after every
+    photo; near-duplicates come with no results and their canonical photo id.
+    """
+    encodings = []
+    failed_photos = []
+    counts = {'processed': 0, 'cached_faces': 0, 'collapsed_faces': 0}
+    cache_keys = {}  # photo_id -> keys to store fresh results under
+    cached_ids = set()
+    near_duplicates = NearDuplicates() if DEDUP_ENABLED else None
+    duplicate_of = {}  # photo_id -> representative, for photos that skipped inference
+    aliases = {}       # photo_id -> canonical photo_id
+    resolved = {}      # photo_id -> (canonical photo_id or None, error) of finished photos
+    waiting = {}       # representative -> duplicates waiting for it to finish
+    
+    def lookup(photo, image_bytes):
+        keys, faces = [], None
+        if face_cache.enabled:
+            keys = [key for key in (source_key(photo),) if key]
+            if image_bytes is None:
+                # Before download: only a Drive revision key can skip the download
+                faces = face_cache.get(keys[0], record_miss=False) if keys else None
+            else:
+                keys.append(content_key(image_bytes))
+                faces = face_cache.get(keys[-1])
+        if faces is None:
+            if image_bytes is not None and near_duplicates is not None:
+                representative = near_duplicates.representative(photo['id'], image_bytes)
+                if representative is not None:
+                    # Skips inference like a cache hit; resolved once the representative is done
+                    duplicate_of[photo['id']] = representative
+                    return []
+            cache_keys[photo['id']] = keys
+            return None
+        cached_ids.add(photo['id'])
+        return [{'photo_id': photo['id'], 'embedding': emb, 'bbox': bbox} for emb, bbox in faces]
+    
+    def finish(photo_id, results, error, canonical=None):
+        """Record a photo's outcome (``canonical``: it is an alias), then resolve its waiting duplicates"""
+        if canonical is not None:
+            aliases[photo_id] = canonical
+            counts['processed'] += 1
+            results = []
+        elif error or not results:
+            failed_photos.append({'photo_id': photo_id, 'error': error or 'No faces detected'})
+        else:
+            encodings.extend(results)
+            counts['processed'] += 1
+        resolved[photo_id] = (photo_id, None) if canonical is None and results else (canonical, error)
+        if on_photo:
+            on_photo(photo_id, results, error, canonical)
+        for duplicate in waiting.pop(photo_id, ()):
+            finish_duplicate(duplicate, photo_id)
+    
+    def finish_duplicate(photo_id, representative):
+        # Same outcome as the representative: an alias of its canonical photo, or the same failure
+        canonical, error = resolved[representative]
+        finish(photo_id, [], error, canonical)
+    
+    def on_result(photo_id, results, error):
+        representative = duplicate_of.pop(photo_id, None)
+        if representative is not None:
+            if representative in resolved:
+                finish_duplicate(photo_id, representative)
+            else:
+                waiting.setdefault(representative, []).append(photo_id)
+            return
+        keys = cache_keys.pop(photo_id, None)
+        if keys and not error:
+            face_cache.put(keys, [(r['embedding'], r['bbox']) for r in results])
+        if photo_id in cached_ids:
+            counts['cached_faces'] += len(results)
+        anchor = near_duplicates.collapse(photo_id, results) if near_duplicates is not None and not error else None
+        if anchor is not None:
+            counts['collapsed_faces'] += len(results)
+        finish(photo_id, results, error, anchor)
+    
+    def yielding(encode):
+        # Let running searches have the CPU before each encode step
+        def encode_batch(batch):
+            scheduler.yield_to_interactive()
+            return encode(batch)
+        return encode_batch
+    
+    lookup = lookup if face_cache.enabled or near_duplicates is not None else None
+    if encode_pool.ENCODE_PROCESSES == 0 and ENCODER_MODE == 'batched':
+        # Decode right after download so decoding overlaps inference
+        encode_seconds = run_pipeline(photos, yielding(encode_decoded_images), on_result, BATCH_SIZE, lookup=lookup,
+                                      prepare=decode_photo, prepare_executor=decode_executor)
+    else:
+        encode_seconds = run_pipeline(photos, yielding(encode_downloaded_images), on_result, BATCH_SIZE, lookup=lookup,
+                                      prepare_executor=decode_executor)
+    return {
+        'encodings': encodings,
+        'processed': counts['processed'],
+        'failed_photos': failed_photos,
+        'cache_hits': len(cached_ids),
+        'encoded_faces': len(encodings) - counts['cached_faces'] + counts['collapsed_faces'],
+        'encode_seconds': encode_seconds,
+        'aliases': aliases,
+        **(near_duplicates.stats() if near_duplicates is not None else {})
+    }
+
+def cache_summary(result, total_photos):
+    return {
+        'cache_hits': result['cache_hits'],
+        'cache_hit_rate': round(result['cache_hits'] / total_photos, 3) if total_photos else 0.0
+    }
+
+def dedup_summary(result, previous=None):
+    """Near-duplicate counts of an encode, added to those of earlier runs of the same job"""
+    previous = previous or {}
+    return {key: previous.get(key, 0) + result.get(key, 0)
+            for key in ('inferences_avoided', 'duplicates_collapsed')}
+
+def encoding_throughput(faces, encode_seconds):
+    """Faces/second overall and per CPU core for the inference part of an encode"""
+    faces_per_second = faces / encode_seconds if encode_seconds > 0 else 0.0
+    return {
+        'encode_seconds': round(encode_seconds, 2),
+        'faces_per_second': round(faces_per_second, 1),
+        'faces_per_second_per_core': round(faces_per_second / CPU_COUNT, 2)
+    }
+
+# albums: {album_id (str): AlbumEncodings} to search, loaded by the endpoint;
+# image: DecodedImage of the query (possibly reduced to QUERY_MAX_SIDE)
+SearchQuery = namedtuple('SearchQuery', ['albums', 'image', 'threshold', 'search_all_faces', 'search_mode'])
+
+def original_bbox(bbox, scale):
+    """Bbox detected on a reduced image, in original image coordinates"""
+    return (np.asarray(bbox) / np.tile(scale, 2)).tolist()
+
+def embed_query_images(images):
+    """Faces [(embedding, bbox)] of each query DecodedImage, bboxes in original
+    coordinates; detection and recognition run as one batch"""
+    if ENCODER_MODE == 'batched':
+        faces = encode_images(face_app, list(enumerate(images)))
+        return [faces[i] for i in range(len(images))]
+    return [[(emb, original_bbox(bbox, image.scale)) for emb, bbox in get_face_embeddings(image.pixels)]
+            for image in images]
+
+def search_units(query):
+    """Split a query's albums into search units (tuples of album ids): one per
+    large album, plus a single combined unit for the small ones"""
+    small = sorted(album_id for album_id, encodings in query.albums.items()
+                   if len(encodings) < COMBINED_ALBUM_MAX_FACES) if query.search_mode != 'people' else []
+    if len(small) < 2 or sum(len(query.albums[album_id]) for album_id in small) > COMBINED_SEARCH_MAX_FACES:
+        small = []
+    units = [(album_id,) for album_id in query.albums if album_id not in small]
+    if small:
+        units.append(tuple(small))
+    return units
+
+def get_combined_matrix(albums):
+    """Cached CombinedMatrix over ``albums`` = {album_id: encodings}; rebuilt when any album changes"""
+    key = tuple(sorted((album_id, encodings.generation) for album_id, encodings in albums.items()))
+    with cache_lock:
+        combined = combined_matrices.get(key)
+        if combined is not None:
+            combined_matrices.move_to_end(key)
+            return combined
+    combined = build_combined_matrix(sorted(albums.items()))
+    with cache_lock:
+        combined_matrices[key] = combined
+        while len(combined_matrices) > COMBINED_CACHE_ENTRIES:
+            combined_matrices.popitem(last=False)
+    return combined
+
+def search_unit(unit, search_mode, query_sets, thresholds, albums):
+    """Search one unit for several query sets. Returns one {album_id: result} per set"""
+    if len(unit) > 1:
+        # Current encodings of every small album, one matrix multiply over all of them
+        current = {}
+        for album_id in unit:
+            cached_encodings, _ = get_cached_album(album_id)
+            current[album_id] = cached_encodings if cached_encodings is not None else albums[album_id]
+        combined = get_combined_matrix(current)
+        outcomes = search_combined_many(combined, query_sets, thresholds)
+        return [{album_id: {'matches': expand_aliases(matches, current[album_id]), 'max_similarity': max_similarity,
+                            'search_method': 'combined', 'index_type': 'matrix'}
+                 for album_id, (matches, max_similarity) in per_album.items()} for per_album in outcomes]
+    
+    album_id = unit[0]
+    if search_mode == 'people':
+        # Centroids of the album's people, then every photo of the matching people
+        encodings, _ = get_cached_album(album_id)
+        encodings = encodings if encodings is not None else albums[album_id]
+        people = get_album_people(album_id, encodings)
+        if people is not None:
+            outcomes = [search_people(people, query_set, threshold) for query_set, threshold in zip(query_sets, thresholds)]
+            return [{album_id: {'matches': expand_aliases(matches, encodings), 'max_similarity': max_similarity,
+                                'search_method': 'people', 'index_type': 'centroids'}}
+                    for matches, max_similarity in outcomes]
+        schedule_clustering(album_id)
+        search_mode = 'range'  # not clustered yet: exact search meanwhile
+    
+    # Encodings and index are read together under the album's read lock so a
+    # concurrent append/remove never pairs new row ids with old photo ids
+    with get_index_lock(album_id).read():
+        album_encodings, index = get_cached_album(album_id)
+        if album_encodings is None:
+            album_encodings = albums[album_id]
+        
+        # Use FAISS for fast search if available
+        if FAISS_AVAILABLE and index is not None:
+            search_method, index_type = 'faiss', ann_index.index_type_of(index)
+            outcomes = search_index_many(index, album_encodings, query_sets, thresholds, mode=search_mode,
+                                         margin=ann_index.rerank_margin(index))
+        else:
+            # Fallback to numpy search: all query faces in one matrix multiply
+            search_method, index_type = 'numpy', 'matrix'
+            matrix = get_search_matrix(album_id, album_encodings)
+            outcomes = search_matrix_many(matrix, query_sets, thresholds)
+    return [{album_id: {'matches': expand_aliases(matches, album_encodings), 'max_similarity': max_similarity,
+                        'search_method': search_method, 'index_type': index_type}}
+            for matches, max_similarity in outcomes]
+
+def run_search_batch(queries):
+    """Coalesced search work: one inference pass over every selfie, then one
+    search per album (or combined group of small albums) for all the query
+    faces that target it, units running in parallel"""
+    with scheduler.search.slot() as queue_wait:
+        with metrics.timed('query_inference'):
+            found_faces = embed_query_images([query.image for query in queries])
+        faces = [
+            (found if query.search_all_faces else [largest_face(found)]) if found else []
+            for query, found in zip(queries, found_faces)
+        ]
+        results = [{'faces': found, 'albums': {}, 'search_time': 0.0, 'queue_wait': queue_wait,
+                    'batch_size': len(queries)} for found in faces]
+        
+        groups = {}
+        for i, query in enumerate(queries):
+            if faces[i]:
+                for unit in search_units(query):
+                    groups.setdefault((unit, query.search_mode), []).append(i)
+        
+        def run_group(group):
+            (unit, search_mode), members = group
+            query_sets = [[embedding for embedding, _ in faces[i]] for i in members]
+            thresholds = [queries[i].threshold for i in members]
+            with metrics.timed('index_search'):
+                return members, search_unit(unit, search_mode, query_sets, thresholds, queries[members[0]].albums)
+        
+        start_time = time.time()
+        if len(groups) > 1:
+            outcomes = list(search_executor.map(run_group, groups.items()))
+        else:
+            outcomes = [run_group(group) for group in groups.items()]
+        elapsed = time.time() - start_time
+        for members, per_member in outcomes:
+            for i, album_results in zip(members, per_member):
+                results[i]['albums'].update(album_results)
+                results[i]['search_time'] = elapsed
+    return results
+
+search_coalescer = Coalescer(run_search_batch)
+
+def run_encode_job(job):
+    """Encode the photos of ``job`` not yet in its checkpoint, then save the album"""
+    while not wait_until_ready(MODEL_WAIT_SECONDS):
+        if model_state['status'] == 'error':
+            raise RuntimeError(f"Model failed to load: {model_state['error']}")
+    
+    album_id = job.album_id
+    photos = job.photos()
+    done = job.done_photo_ids()
+    remaining = [photo for photo in photos if str(photo['id']) not in done]
+    checkpoint = job.checkpoint_album()
+    counts = {'processed': len(photos) - len(remaining), 'faces': len(checkpoint) if checkpoint is not None else 0}
+    # Photos that failed to download before a restart are retried, so only keep "no faces" entries
+    failed_photos = [failed for failed in job.state['failed_photos'] if str(failed['photo_id']) in done]
+    job.update(processed_photos=counts['processed'], total_faces=counts['faces'], failed_photos=failed_photos)
+    
+    print(f"🚀 Encoding album {album_id} (job {job.job_id}): {len(remaining)} photos"
+          f"{f' ({len(done)} already checkpointed)' if done else ''} (workers: {MAX_WORKERS})...")
+    start_time = time.time()
+    
+    def on_photo(photo_id, results, error, duplicate_of):
+        job.raise_if_cancelled()
+        counts['processed'] += 1
+        counts['faces'] += len(results)
+        if error:
+            failed_photos.append({'photo_id': photo_id, 'error': error})
+        elif not results and duplicate_of is None:
+            failed_photos.append({'photo_id': photo_id, 'error': 'No faces detected'})
+        job.update(save=False, processed_photos=counts['processed'], total_faces=counts['faces'], current_photo=photo_id)
+        if not error:
+            job.record(photo_id, results, duplicate_of)
+    
+    with scheduler.encode.slot(bounded=False):
+        result = encode_photos(remaining, on_photo)
+    job.raise_if_cancelled()
+    job.checkpoint()
+    
+    # Swap the checkpoint in as the album's encodings (linked, not copied through memory)
+    with get_album_lock(album_id), metrics.timed('store_write'):
+        if not job.install_checkpoint(ENCODINGS_DIR):
+            save_album(ENCODINGS_DIR, empty_album(album_id))
+        album = load_album(ENCODINGS_DIR, album_id)
+    
+    # Update cache
+    set_album_encodings(album_id, album)
+    publish_album_changed(album_id, album.generation)
+    job.discard_checkpoint()
+    if CLUSTER_AFTER_ENCODE:
+        schedule_clustering(album_id)
+    
+    elapsed = time.time() - start_time
+    job.complete(
+        total_faces=len(album), elapsed_seconds=round(elapsed, 1),
+        cache_hits=job.state['cache_hits'] + result['cache_hits'],
+        **dedup_summary(result, job.state),
+        **encoding_throughput(result['encoded_faces'], result['encode_seconds'])
+    )
+    print(f"✅ Album {album_id} complete: {len(photos) - len(failed_photos)} photos, {len(album)} faces in {elapsed:.1f}s "
+          f"({len(failed_photos)} failed, {result['cache_hits']} from cache, {len(album.aliases)} near-duplicates)")
+
+# Album encodes run as background jobs, resumed from their checkpoints after a restart
+job_manager = JobManager(JOBS_DIR, run_encode_job, owns=ring.owns)
+if __name__ != '__mp_main__':
+    job_manager.start()
+    replica_bus.subscribe(on_replica_message)
+
+def request_endpoint():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request(request_endpoint())
+
+# Upload buffers return to the pool once the response is done
+app.teardown_request(release_request_buffers)
+
+@app.after_request
+def finish_request_metrics(response):
+    metrics.finish_request(request_endpoint(), request.method, response.status_code)
+    return response
+
+def service_metrics():
+    """Counters kept by the caches, downloader, scheduler and jobs, for /metrics"""
+    albums, faces = album_cache.stats(), face_cache.stats()
+    yield 'face_api_model_ready', 'gauge', 'Model loaded and warmed up', [({}, int(model_ready.is_set()))]
+    yield 'face_api_album_cache_hits_total', 'counter', 'Album cache lookups served from memory', [({}, albums['hits'])]
+    yield 'face_api_album_cache_misses_total', 'counter', 'Album cache lookups loaded from disk', [({}, albums['misses'])]
+    yield 'face_api_album_cache_evictions_total', 'counter', 'Albums evicted from the cache', [({}, albums['evictions'])]
+    yield 'face_api_album_cache_bytes', 'gauge', 'Bytes held by cached albums', [({}, album_cache.nbytes)]
+    yield 'face_api_album_cache_albums', 'gauge', 'Albums in the cache', [({}, albums['albums'])]
+    yield 'face_api_face_cache_hits_total', 'counter', 'Photos served from the face cache', [({}, faces['hits'])]
+    yield 'face_api_face_cache_misses_total', 'counter', 'Photos missing from the face cache', [({}, faces['misses'])]
+    yield 'face_api_face_cache_evictions_total', 'counter', 'Face cache entries evicted', [({}, faces['evictions'])]
+    downloads = downloader.get_stats()
+    for key in ('downloads', 'bytes', 'retries', 'failures'):
+        yield f'face_api_download_{key}_total', 'counter', f'Image download {key}', [({}, downloads.get(key, 0))]
+    pools = (scheduler.search, scheduler.encode)
+    for key, kind in (('admitted', 'counter'), ('rejected', 'counter'), ('timeouts', 'counter'),
+                      ('in_flight', 'gauge'), ('queued', 'gauge')):
+        name = f'face_api_pool_{key}_total' if kind == 'counter' else f'face_api_pool_{key}'
+        yield name, kind, f'Admission pool {key}', [({'pool': pool.name}, getattr(pool, key)) for pool in pools]
+    coalescer = search_coalescer.stats()
+    yield 'face_api_search_batches_total', 'counter', 'Coalesced search batches', [({}, coalescer['batches'])]
+    yield 'face_api_search_batched_requests_total', 'counter', 'Searches run in coalesced batches', [({}, coalescer['requests'])]
+    yield 'face_api_jobs', 'gauge', 'Encode jobs by status', [({'status': status}, count) for status, count in job_manager.stats().items()]
+    yield 'face_api_pending_index_builds', 'gauge', 'ANN indexes being trained', [({}, len(pending_index_builds))]
+    bus = replica_bus.stats()
+    yield 'face_api_replica_messages_total', 'counter', 'Cache invalidation messages by direction', [
+        ({'direction': 'published'}, bus['published']), ({'direction': 'received'}, bus['received'])]
+
+metrics.add_collector(service_metrics)
+
+@app.route('/live', methods=['GET'])
+def live():
+    """Liveness: the process is up and serving HTTP (the model may still be loading)"""
+    return jsonify({'status': 'alive'})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: the model is loaded and warmed up, inference requests can be routed here"""
+    body = {'ready': model_ready.is_set(), **model_state}
+    return jsonify(body), 200 if model_ready.is_set() else 503
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({
         'status': 'ok',
         'service': 'face-recognition-insightface',
-        'model': 'buffalo_l (ArcFace)',
+        'model': f'{MODEL_NAME} (ArcFace)',
+        'model_status': model_state['status'],
         'faiss_enabled': FAISS_AVAILABLE,
+        'embedding_precision': configured_precision(),
         'max_workers': MAX_WORKERS,
-        'cached_albums': list(encodings_cache.keys())
+        'encode_processes': encode_pool.ENCODE_PROCESSES,
+        'cached_albums': [album_id for album_id, _, _, _ in album_cache.items()],
+        'index_types': {album_id: ann_index.index_type_of(index)
+                        for album_id, _, index, _ in album_cache.items() if index is not None} if FAISS_AVAILABLE else {},
+        'album_cache': album_cache.stats(),
+        'pending_index_builds': list(pending_index_builds),
+        'pending_compactions': list(pending_compactions),
+        'downloader': downloader.get_stats(),
+        'face_cache': face_cache.stats(),
+        'jobs': job_manager.stats(),
+        'scheduler': scheduler.stats(),
+        'search_coalescer': search_coalescer.stats(),
+        'upload_buffers': buffer_pool.stats(),
+        'replicas': {'replica': replicas.REPLICA_NAME, 'replicas': ring.replicas, **replica_bus.stats()}
+    })
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage/request latency histograms and service counters in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/route/<album_id>', methods=['GET'])
+def route_album(album_id):
+    """Replica that serves the album (encodes, searches and keeps it cached)"""
+    return jsonify({
+        'album_id': album_id,
+        'replica': ring.owner(album_id) or replicas.REPLICA_URL or None,
+        'local': ring.owns(album_id),
+        'replicas': ring.replicas
     })
 
 @app.route('/encoding-status/<album_id>', methods=['GET'])
 def get_encoding_status(album_id):
-    """Get encoding status"""
-    status_path = get_status_path(album_id)
-    if os.path.exists(status_path):
-        with open(status_path, 'r') as f:
-            return jsonify(json.load(f))
-    
-    encoding_path = get_encoding_path(album_id)
-    if os.path.exists(encoding_path):
+    """Get encoding status (state of the album's latest encode job)"""
+    job = job_manager.latest_for_album(album_id)
+    if job is not None:
+        status = job.snapshot()
+        if status['status'] == 'completed' and has_album_encodings(album_id):
+            # Later incremental encodes / removals change the face count
+            encodings = load_album_encodings(album_id)
+            status['total_faces'] = len(encodings) if encodings else 0
+        return jsonify(status)
+    
+    if has_album_encodings(album_id):
         encodings = load_album_encodings(album_id)
         return jsonify({
             'album_id': album_id,
@@ -232,175 +1052,96 @@ def get_encoding_status(album_id):
 
 @app.route('/encode-album', methods=['POST'])
 def encode_album():
-    """Encode album with parallel processing"""
-    # Acquire semaphore with timeout
-    acquired = request_semaphore.acquire(timeout=30)
-    if not acquired:
-        return jsonify({'error': 'Server đang bận, vui lòng thử lại sau'}), 503
+    """Queue an album encode job; poll /jobs/<job_id> or /encoding-status/<album_id> for progress"""
+    data = request.json
+    album_id = data.get('album_id')
+    photos = data.get('photos', [])
     
-    try:
-        data = request.json
-        album_id = data.get('album_id')
-        photos = data.get('photos', [])
-        
-        if not album_id or not photos:
-            return jsonify({'error': 'Missing album_id or photos'}), 400
-        
-        print(f"🚀 Encoding album {album_id} with {len(photos)} photos (workers: {MAX_WORKERS})...")
-        start_time = time.time()
-        
-        all_encodings = []
-        processed = 0
-        failed = 0
-        
-        update_status(album_id, 'encoding', 0, len(photos), 0)
-        
-        # Process in batches
-        for batch_start in range(0, len(photos), BATCH_SIZE):
-            batch = photos[batch_start:batch_start + BATCH_SIZE]
-            batch_num = batch_start // BATCH_SIZE + 1
-            total_batches = (len(photos) + BATCH_SIZE - 1) // BATCH_SIZE
-            
-            print(f"  Batch {batch_num}/{total_batches}: Downloading {len(batch)} images...")
-            
-            # Download batch asynchronously
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            download_results = loop.run_until_complete(download_batch_async(batch))
-            loop.close()
-            
-            # Prepare for parallel encoding
-            images_to_process = []
-            for photo_id, image_bytes, error in download_results:
-                if error:
-                    failed += 1
-                else:
-                    images_to_process.append((photo_id, image_bytes))
-            
-            # Process images in parallel using ThreadPool
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = [executor.submit(process_image_for_encoding, args) for args in images_to_process]
-                
-                for future in as_completed(futures):
-                    photo_id, results, error = future.result()
-                    if error:
-                        failed += 1
-                    elif results:
-                        all_encodings.extend(results)
-                        processed += 1
-                    else:
-                        failed += 1
-            
-            # Update status
-            current_processed = batch_start + len(batch)
-            update_status(
-                album_id, 'encoding', 
-                current_processed, len(photos), 
-                len(all_encodings),
-                current_photo=f"Batch {batch_num}/{total_batches}"
-            )
-            
-            print(f"  Batch {batch_num} done: {len(all_encodings)} faces found")
-        
-        # Save encodings
-        encoding_path = get_encoding_path(album_id)
-        with open(encoding_path, 'w') as f:
-            json.dump(all_encodings, f)
-        
-        # Update cache
-        with cache_lock:
-            encodings_cache[album_id] = all_encodings
-            if FAISS_AVAILABLE and all_encodings:
-                embeddings = [np.array(e['embedding']) for e in all_encodings]
-                faiss_indexes[album_id] = build_faiss_index(embeddings)
-        
-        # Final status
-        elapsed = time.time() - start_time
-        update_status(album_id, 'completed', len(photos), len(photos), len(all_encodings))
-        
-        print(f"✅ Album {album_id} complete: {processed} photos, {len(all_encodings)} faces in {elapsed:.1f}s")
-        
+    if not album_id or not photos:
+        return jsonify({'error': 'Missing album_id or photos'}), 400
+    wrong_replica = misdirected(album_id)
+    if wrong_replica is not None:
+        return wrong_replica
+    
+    job, active = job_manager.submit(album_id, photos)
+    if job is None:
         return jsonify({
-            'success': True,
-            'album_id': album_id,
-            'processed': processed,
-            'failed': failed,
-            'total_faces': len(all_encodings),
-            'elapsed_seconds': round(elapsed, 1)
-        })
-    finally:
-        request_semaphore.release()
+            'error': 'Album đang được encode',
+            'job_id': active.job_id,
+            'album_id': active.album_id,
+            'status': active.status
+        }), 409
+    
+    print(f"📥 Queued encoding job {job.job_id} for album {album_id} ({len(photos)} photos)")
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id,
+        'album_id': job.album_id,
+        'status': job.status,
+        'total_photos': len(photos)
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
 
 @app.route('/encode-incremental', methods=['POST'])
 def encode_incremental():
     """Encode only new photos and merge with existing encodings"""
+    if not wait_until_ready(MODEL_WAIT_SECONDS):
+        return model_unavailable()
+    
     data = request.json
     album_id = data.get('album_id')
     photos = data.get('photos', [])
     
     if not album_id or not photos:
         return jsonify({'error': 'Missing album_id or photos'}), 400
+    wrong_replica = misdirected(album_id)
+    if wrong_replica is not None:
+        return wrong_replica
     
-    print(f"🔄 Incremental encoding for album {album_id}: {len(photos)} new photos...")
-    start_time = time.time()
-    
-    # Load existing encodings
-    existing_encodings = load_album_encodings(album_id) or []
-    existing_photo_ids = set(e['photo_id'] for e in existing_encodings)
-    
-    new_encodings = []
-    processed = 0
-    failed = 0
-    
-    # Process new photos in batches
-    for batch_start in range(0, len(photos), BATCH_SIZE):
-        batch = photos[batch_start:batch_start + BATCH_SIZE]
-        
-        # Download batch asynchronously
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        download_results = loop.run_until_complete(download_batch_async(batch))
-        loop.close()
-        
-        # Prepare for parallel encoding
-        images_to_process = []
-        for photo_id, image_bytes, error in download_results:
-            if error:
-                failed += 1
-            else:
-                images_to_process.append((photo_id, image_bytes))
-        
-        # Process images in parallel
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(process_image_for_encoding, args) for args in images_to_process]
+    try:
+        with scheduler.encode.slot() as queue_wait:
+            print(f"🔄 Incremental encoding for album {album_id}: {len(photos)} new photos...")
+            start_time = time.time()
             
-            for future in as_completed(futures):
-                photo_id, results, error = future.result()
-                if error:
-                    failed += 1
-                elif results:
-                    new_encodings.extend(results)
-                    processed += 1
-                else:
-                    failed += 1
-    
-    # Merge with existing encodings
-    all_encodings = existing_encodings + new_encodings
-    
-    # Save merged encodings
-    encoding_path = get_encoding_path(album_id)
-    with open(encoding_path, 'w') as f:
-        json.dump(all_encodings, f)
-    
-    # Update cache and FAISS index
-    with cache_lock:
-        encodings_cache[album_id] = all_encodings
-        if FAISS_AVAILABLE and all_encodings:
-            embeddings = [np.array(e['embedding']) for e in all_encodings]
-            faiss_indexes[album_id] = build_faiss_index(embeddings)
+            # Load existing encodings
+            existing_encodings = load_album_encodings(album_id)
+            existing_count = len(existing_encodings) if existing_encodings is not None else 0
+            metrics.set_album_size(existing_count)
+            
+            result = encode_photos(photos)
+    except PoolBusy as e:
+        return server_busy(e)
+    new_encodings, processed, failed_photos = result['encodings'], result['processed'], result['failed_photos']
+    
+    # Append new encodings to the store (only the delta is written)
+    with get_album_lock(album_id):
+        with metrics.timed('store_write'):
+            previous = load_album(ENCODINGS_DIR, album_id)
+            added_start = append_album(ENCODINGS_DIR, album_id, build_album(album_id, new_encodings, result['aliases']))
+            all_encodings = load_album(ENCODINGS_DIR, album_id)
+        # Update cache and append the new faces to the FAISS index (before the next write lands)
+        update_album_index(album_id, all_encodings, previous.generation if previous is not None else None,
+                           added_start=added_start)
+    publish_album_changed(album_id, all_encodings.generation)
+    schedule_compaction(album_id, all_encodings)
+    if CLUSTER_AFTER_ENCODE:
+        schedule_clustering(album_id)
     
     elapsed = time.time() - start_time
-    print(f"✅ Incremental encoding complete: +{len(new_encodings)} faces, total: {len(all_encodings)} in {elapsed:.1f}s")
+    print(f"✅ Incremental encoding complete: +{len(new_encodings)} faces, total: {len(all_encodings)} (was {existing_count}) in {elapsed:.1f}s")
     
     return jsonify({
         'success': True,
@@ -408,8 +1149,14 @@ def encode_incremental():
         'new_photos_processed': processed,
         'new_faces_added': len(new_encodings),
         'total_faces': len(all_encodings),
-        'failed': failed,
-        'elapsed_seconds': round(elapsed, 1)
+        'failed': len(failed_photos),
+        'failed_photos': failed_photos,
+        'elapsed_seconds': round(elapsed, 1),
+        'queue_wait_ms': round(queue_wait * 1000, 1),
+        'near_duplicates': len(result['aliases']),
+        **dedup_summary(result),
+        **cache_summary(result, len(photos)),
+        **encoding_throughput(result['encoded_faces'], result['encode_seconds'])
     })
 
 @app.route('/remove-photos', methods=['POST'])
@@ -421,163 +1168,202 @@ def remove_photos_from_encodings():
     
     if not album_id or not photo_ids_to_remove:
         return jsonify({'error': 'Missing album_id or photo_ids'}), 400
+    wrong_replica = misdirected(album_id)
+    if wrong_replica is not None:
+        return wrong_replica
     
-    # Load existing encodings
-    existing_encodings = load_album_encodings(album_id) or []
+    # Make sure legacy JSON is migrated before touching the store
+    current = load_album_encodings(album_id)
+    if current is None:
+        return jsonify({'success': True, 'removed_encodings': 0, 'remaining_faces': 0})
+    metrics.set_album_size(len(current))
     
-    # Filter out removed photos
-    filtered_encodings = [e for e in existing_encodings if e['photo_id'] not in photo_ids_to_remove]
-    removed_count = len(existing_encodings) - len(filtered_encodings)
-    
-    # Save filtered encodings
-    encoding_path = get_encoding_path(album_id)
-    with open(encoding_path, 'w') as f:
-        json.dump(filtered_encodings, f)
-    
-    # Update cache
-    with cache_lock:
-        encodings_cache[album_id] = filtered_encodings
-        if FAISS_AVAILABLE and filtered_encodings:
-            embeddings = [np.array(e['embedding']) for e in filtered_encodings]
-            faiss_indexes[album_id] = build_faiss_index(embeddings)
-        elif album_id in faiss_indexes:
-            del faiss_indexes[album_id]
+    with get_album_lock(album_id):
+        with metrics.timed('store_write'):
+            # Tombstone the faces of removed photos (photo_id -> face id map)
+            existing_encodings = load_album(ENCODINGS_DIR, album_id)
+            # Near-duplicate aliases go first: a removed photo's surviving alias inherits its faces
+            promoted, aliases_changed = set(), False
+            if existing_encodings.aliases:
+                promoted, aliases_changed = unlink_photos(ENCODINGS_DIR, album_id, photo_ids_to_remove)
+            removed_rows = existing_encodings.rows_for_photos(photo_ids_to_remove - promoted)
+            removed_count = len(removed_rows)
+            if removed_count:
+                tombstone_rows(ENCODINGS_DIR, album_id, removed_rows)
+            filtered_encodings = load_album(ENCODINGS_DIR, album_id)
+        # Update cache: remove_ids on the live index; once enough rows are dead the
+        # store is compacted (and the index rebuilt) in the background
+        update_album_index(album_id, filtered_encodings, existing_encodings.generation, removed_rows=removed_rows)
+    publish_album_changed(album_id, filtered_encodings.generation)
+    compaction_scheduled = schedule_compaction(album_id, filtered_encodings)
+    if CLUSTER_AFTER_ENCODE and (removed_count or aliases_changed):
+        schedule_clustering(album_id)
     
     print(f"🗑️ Removed {removed_count} face encodings for {len(photo_ids_to_remove)} photos")
     
     return jsonify({
         'success': True,
         'removed_encodings': removed_count,
-        'remaining_faces': len(filtered_encodings)
+        'remaining_faces': len(filtered_encodings),
+        'compaction_scheduled': compaction_scheduled
     })
 
 @app.route('/search', methods=['POST'])
 def search_faces():
-    """Search for matching faces with adjustable threshold"""
-    # Acquire semaphore with timeout
-    acquired = request_semaphore.acquire(timeout=30)
-    if not acquired:
-        return jsonify({'error': 'Server đang bận, vui lòng thử lại sau'}), 503
+    """Search for matching faces with adjustable threshold (image as base64 JSON, raw body or multipart)"""
+    if not wait_until_ready(MODEL_WAIT_SECONDS):
+        return model_unavailable()
     
     try:
-        data = request.json
-        album_id = data.get('album_id')
-        image_base64 = data.get('image')
-        threshold = float(data.get('threshold', 0.4))
-        search_all_faces = data.get('search_all_faces', False)
-        
-        if not album_id or not image_base64:
-            return jsonify({'error': 'Missing album_id or image'}), 400
-        
-        # Load encodings
-        album_encodings = load_album_encodings(album_id)
-        if not album_encodings:
-            return jsonify({'error': 'Album chưa được xử lý. Vui lòng sync album trước.'}), 400
-        
-        # Load user image
-        user_image = load_image_from_base64(image_base64)
-        if user_image is None:
-            return jsonify({'error': 'Không thể đọc ảnh'}), 400
-        
-        # Get face embedding(s) from user image
-        try:
-            if search_all_faces:
-                user_faces = get_face_embeddings(user_image)
-                if not user_faces:
-                    return jsonify({'error': 'Không tìm thấy khuôn mặt trong ảnh'}), 400
-                user_embeddings = [emb for emb, bbox in user_faces]
-                face_bboxes = [bbox for emb, bbox in user_faces]
-            else:
-                user_embedding, bbox = get_largest_face_embedding(user_image)
-                if user_embedding is None:
-                    return jsonify({'error': 'Không tìm thấy khuôn mặt trong ảnh'}), 400
-                user_embeddings = [user_embedding]
-                face_bboxes = [bbox] if bbox else []
-            
-            print(f"🔍 Searching {len(user_embeddings)} face(s) in {len(album_encodings)} encodings...")
-        except Exception as e:
-            return jsonify({'error': f'Lỗi nhận diện: {str(e)}'}), 500
-        
-        matched_photo_ids = set()
-        match_details = []
-        max_similarity = 0.0
-        
-        start_time = time.time()
-        
-        # Use FAISS for fast search if available
-        if FAISS_AVAILABLE and album_id in faiss_indexes:
-            index = faiss_indexes[album_id]
-            
-            for user_emb in user_embeddings:
-                # Normalize query vector
-                query = np.array([user_emb]).astype('float32')
-                faiss.normalize_L2(query)
-                
-                # Search top-k matches
-                k = min(100, len(album_encodings))
-                similarities, indices = index.search(query, k)
-                
-                for sim, idx in zip(similarities[0], indices[0]):
-                    if sim > threshold:
-                        photo_id = album_encodings[idx]['photo_id']
-                        matched_photo_ids.add(photo_id)
-                        match_details.append({
-                            'photo_id': photo_id,
-                            'similarity': round(float(sim), 3)
-                        })
-                    max_similarity = max(max_similarity, sim)
+        data, user_image = read_query_image()
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    album_id = data.get('album_id')
+    threshold = float(data.get('threshold', 0.4))
+    search_all_faces = field_flag(data.get('search_all_faces', False))
+    # 'range' returns every match above threshold, 'topk' keeps the legacy top-100 cut-off,
+    # 'people' matches the album's face clusters and returns all photos of matching people
+    search_mode = data.get('search_mode', 'range')
+    
+    if not album_id or user_image is None:
+        return jsonify({'error': 'Missing album_id or image'}), 400
+    
+    # Load encodings
+    album_encodings = load_album_encodings(album_id)
+    if not album_encodings:
+        return jsonify({'error': 'Album chưa được xử lý. Vui lòng sync album trước.'}), 400
+    album_cache.record_search(album_id)
+    metrics.set_album_size(len(album_encodings))
+    
+    # Detection, recognition and the index search run batched with concurrent searches
+    try:
+        result = search_coalescer.submit(
+            SearchQuery({str(album_id): album_encodings}, user_image, threshold, search_all_faces, search_mode))
+    except PoolBusy as e:
+        return server_busy(e)
+    except Exception as e:
+        return jsonify({'error': f'Lỗi nhận diện: {str(e)}'}), 500
+    
+    if not result['faces']:
+        return jsonify({'error': 'Không tìm thấy khuôn mặt trong ảnh'}), 400
+    
+    album_result = result['albums'][str(album_id)]
+    matched_photo_ids = [m['photo_id'] for m in album_result['matches']]
+    max_similarity = album_result['max_similarity']
+    batch_note = f" (batch of {result['batch_size']})" if result['batch_size'] > 1 else ''
+    print(f"✅ Search complete: {len(result['faces'])} face(s) in {len(album_encodings)} encodings, "
+          f"{len(matched_photo_ids)} matches, max_sim: {max_similarity:.3f}, time: {result['search_time']:.3f}s{batch_note}")
+    
+    return jsonify({
+        'success': True,
+        'matched_photo_ids': matched_photo_ids,
+        'total_matches': len(matched_photo_ids),
+        'max_similarity': round(float(max_similarity), 3),
+        'threshold_used': threshold,
+        'faces_detected': len(result['faces']),
+        'face_bboxes': [bbox for _, bbox in result['faces']],
+        'search_time_ms': round(result['search_time'] * 1000, 1),
+        'queue_wait_ms': round(result['queue_wait'] * 1000, 1),
+        'batch_size': result['batch_size'],
+        'search_method': album_result['search_method'],
+        'search_mode': search_mode,
+        'index_type': album_result['index_type']
+    })
+
+@app.route('/search-multi', methods=['POST'])
+def search_multi():
+    """Search several albums (list of ids, or "all") with one selfie: the face
+    is embedded once and the albums are searched in parallel"""
+    if not wait_until_ready(MODEL_WAIT_SECONDS):
+        return model_unavailable()
+    
+    try:
+        data, user_image = read_query_image()
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    album_ids = data.get('album_ids')
+    threshold = float(data.get('threshold', 0.4))
+    search_all_faces = field_flag(data.get('search_all_faces', False))
+    search_mode = data.get('search_mode', 'range')
+    
+    if isinstance(album_ids, str) and album_ids != 'all':
+        album_ids = [album_id.strip() for album_id in album_ids.split(',') if album_id.strip()]
+    if album_ids == 'all':
+        album_ids = list_albums(ENCODINGS_DIR)
+    if not album_ids or not isinstance(album_ids, list) or user_image is None:
+        return jsonify({'error': 'Missing album_ids or image'}), 400
+    
+    # Load encodings (cold albums in parallel)
+    albums, not_encoded = {}, []
+    for album_id, encodings in zip(album_ids, search_executor.map(load_album_encodings, album_ids)):
+        if encodings is None:
+            not_encoded.append(album_id)
         else:
-            # Fallback to numpy search
-            for user_emb in user_embeddings:
-                for item in album_encodings:
-                    photo_id = item['photo_id']
-                    embedding = np.array(item['embedding'])
-                    
-                    similarity = cosine_similarity(user_emb, embedding)
-                    max_similarity = max(max_similarity, similarity)
-                    
-                    if similarity > threshold:
-                        matched_photo_ids.add(photo_id)
-                        match_details.append({
-                            'photo_id': photo_id,
-                            'similarity': round(similarity, 3)
-                        })
-        
-        elapsed = time.time() - start_time
-        print(f"✅ Search complete: {len(matched_photo_ids)} matches, max_sim: {max_similarity:.3f}, time: {elapsed:.3f}s")
-        
-        return jsonify({
-            'success': True,
-            'matched_photo_ids': list(matched_photo_ids),
-            'total_matches': len(matched_photo_ids),
-            'max_similarity': round(float(max_similarity), 3),
-            'threshold_used': threshold,
-            'faces_detected': len(user_embeddings),
-            'face_bboxes': face_bboxes,
-            'search_time_ms': round(elapsed * 1000, 1),
-            'search_method': 'faiss' if (FAISS_AVAILABLE and album_id in faiss_indexes) else 'numpy'
-        })
-    finally:
-        request_semaphore.release()
+            albums[str(album_id)] = encodings
+            album_cache.record_search(album_id)
+    if not albums:
+        return jsonify({'error': 'Album chưa được xử lý. Vui lòng sync album trước.'}), 400
+    metrics.set_album_size(sum(len(encodings) for encodings in albums.values()))
+    
+    try:
+        result = search_coalescer.submit(SearchQuery(albums, user_image, threshold, search_all_faces, search_mode))
+    except PoolBusy as e:
+        return server_busy(e)
+    except Exception as e:
+        return jsonify({'error': f'Lỗi nhận diện: {str(e)}'}), 500
+    
+    if not result['faces']:
+        return jsonify({'error': 'Không tìm thấy khuôn mặt trong ảnh'}), 400
+    
+    # Only albums with matches are listed
+    matches_by_album = {}
+    for album_id, album_result in result['albums'].items():
+        if album_result['matches']:
+            matches_by_album[album_id] = {
+                'matched_photo_ids': [m['photo_id'] for m in album_result['matches']],
+                'max_similarity': round(float(album_result['max_similarity']), 3),
+                'search_method': album_result['search_method']
+            }
+    total_matches = sum(len(m['matched_photo_ids']) for m in matches_by_album.values())
+    max_similarity = max((r['max_similarity'] for r in result['albums'].values()), default=0.0)
+    print(f"✅ Multi-album search: {len(albums)} albums, {total_matches} matches in {len(matches_by_album)} albums, "
+          f"max_sim: {max_similarity:.3f}, time: {result['search_time']:.3f}s")
+    
+    return jsonify({
+        'success': True,
+        'albums': matches_by_album,
+        'total_matches': total_matches,
+        'albums_searched': len(albums),
+        'albums_not_encoded': not_encoded,
+        'max_similarity': round(float(max_similarity), 3),
+        'threshold_used': threshold,
+        'faces_detected': len(result['faces']),
+        'face_bboxes': [bbox for _, bbox in result['faces']],
+        'search_time_ms': round(result['search_time'] * 1000, 1),
+        'queue_wait_ms': round(result['queue_wait'] * 1000, 1),
+        'batch_size': result['batch_size'],
+        'search_mode': search_mode
+    })
 
 @app.route('/detect', methods=['POST'])
 def detect_face():
-    """Detect faces in image and return bounding boxes"""
-    data = request.json
-    image_base64 = data.get('image')
-    
-    if not image_base64:
-        return jsonify({'error': 'Missing image'}), 400
+    """Detect faces in image and return bounding boxes (image as base64 JSON, raw body or multipart)"""
+    if not wait_until_ready(MODEL_WAIT_SECONDS):
+        return model_unavailable()
     
-    image = load_image_from_base64(image_base64)
+    try:
+        _, image = read_query_image()
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     if image is None:
-        return jsonify({'error': 'Không thể đọc ảnh'}), 400
+        return jsonify({'error': 'Missing image'}), 400
     
     try:
-        faces = face_app.get(image)
+        with scheduler.search.slot(), metrics.timed('inference'):
+            faces = face_app.get(image.pixels)
         face_data = []
         for face in faces:
-            bbox = face.bbox.tolist()
+            bbox = original_bbox(face.bbox, image.scale)
             face_data.append({
                 'bbox': bbox,
                 'confidence': float(face.det_score),
@@ -592,31 +1378,84 @@ def detect_face():
             'face_count': len(faces),
             'has_face': len(faces) > 0,
             'faces': face_data,
-            'image_size': {'width': image.shape[1], 'height': image.shape[0]}
+            'image_size': {'width': round(image.pixels.shape[1] / image.scale[0]),
+                           'height': round(image.pixels.shape[0] / image.scale[1])}
         })
+    except PoolBusy as e:
+        return server_busy(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/people/<album_id>', methods=['GET'])
+def get_people(album_id):
+    """People in the album (face clusters with at least PEOPLE_MIN_PHOTOS photos)"""
+    encodings = load_album_encodings(album_id)
+    if encodings is None:
+        return jsonify({'error': 'Album chưa được xử lý. Vui lòng sync album trước.'}), 400
+    metrics.set_album_size(len(encodings))
+    
+    people = get_album_people(album_id, encodings)
+    if people is None:
+        schedule_clustering(album_id)
+        return jsonify({'album_id': album_id, 'status': 'clustering', 'people': []}), 202
+    
+    min_photos = int(request.args.get('min_photos', PEOPLE_MIN_PHOTOS))
+    listed = people.listed(min_photos)
+    # Near-duplicate photos are listed after the photo they were folded into
+    alias_groups = encodings.alias_groups()
+    listed_people = []
+    for person in listed:
+        photo_ids = [p for photo_id in person['photo_ids'] for p in [photo_id, *alias_groups.get(photo_id, ())]]
+        listed_people.append({**person, 'photo_ids': photo_ids, 'photo_count': len(photo_ids)})
+    return jsonify({
+        'album_id': album_id,
+        'status': 'ready',
+        'total_people': len(listed),
+        'total_faces': len(encodings),
+        'people': listed_people
+    })
+
 @app.route('/clear-cache/<album_id>', methods=['DELETE'])
 def clear_cache(album_id):
     """Clear cached encodings for an album"""
+    album_cache.pop(album_id)
     with cache_lock:
-        if album_id in encodings_cache:
-            del encodings_cache[album_id]
-        if album_id in faiss_indexes:
-            del faiss_indexes[album_id]
+        album_people.pop(str(album_id), None)
+    publish_album_changed(album_id)
     return jsonify({'success': True, 'message': f'Cache cleared for album {album_id}'})
 
 if __name__ == '__main__':
     print("🔍 Face Recognition API (InsightFace/ArcFace) starting...")
     print(f"📍 Port: {PORT}")
     print(f"⚡ Max Workers: {MAX_WORKERS}")
+    print(f"🚦 Search slots: {scheduler.search.capacity} (queue {scheduler.search.max_queue}), "
+          f"encode slots: {scheduler.encode.capacity} (queue {scheduler.encode.max_queue})")
     print(f"📦 Batch Size: {BATCH_SIZE}")
+    print(f"🌐 Download Concurrency: {DOWNLOAD_CONCURRENCY}")
+    if encode_pool.ENCODE_PROCESSES > 0:
+        print(f"🧵 Encode Processes: {encode_pool.ENCODE_PROCESSES} x {encode_pool.threads_per_process(encode_pool.ENCODE_PROCESSES)} ONNX threads")
     print(f"🚀 FAISS: {'Enabled' if FAISS_AVAILABLE else 'Disabled'}")
+    print(f"🗄️ Album cache: {ALBUM_CACHE_MAX_MB} MB")
+    if QUERY_MAX_SIDE > 0:
+        print(f"📐 Query images reduced to {QUERY_MAX_SIDE}px before detection")
+    if len(ring) > 1:
+        print(f"🧭 Replica {replicas.REPLICA_URL or '(REPLICA_URL not set)'} of {len(ring)}, cache invalidation via {replica_bus.kind} bus")
+        if replicas.REPLICA_URL not in ring.replicas:
+            print("⚠️ REPLICA_URL is not one of REPLICAS: album writes will be refused (421)")
+    print(f"📋 Encode jobs: {JOB_WORKERS} worker(s), checkpoints in {JOBS_DIR}")
+    if PREWARM_ALBUMS > 0:
+        threading.Thread(target=prewarm_album_cache, name='prewarm', daemon=True).start()
+    print(f"⏱️ Fast boot: {'on (model loads in background, see /ready)' if FAST_BOOT else 'off'}")
     print("📍 Endpoints:")
-    print("   POST /encode-album - Encode album faces (parallel)")
-    print("   POST /search - Search for matching faces (FAISS accelerated)")
+    print("   POST /encode-album - Queue an album encode job (returns job_id)")
+    print("   GET  /jobs/<job_id>, POST /jobs/<job_id>/cancel - Job progress / cancel")
+    print("   POST /search - Search for matching faces (base64 JSON, image/* body or multipart)")
+    print("   POST /search-multi - Search several albums (or all) with one selfie")
+    print("   GET  /people/<album_id> - People in the album (face clusters)")
     print("   POST /detect - Detect faces with bounding boxes")
     print("   GET  /encoding-status/<album_id> - Get encoding progress")
     print("   DELETE /clear-cache/<album_id> - Clear album cache")
+    print("   GET  /route/<album_id> - Replica serving the album")
+    print("   GET  /live, /ready - Liveness / readiness (model loaded and warm)")
+    print("   GET  /metrics - Prometheus metrics (stage latencies, cache hit/miss, queue waits)")
     app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
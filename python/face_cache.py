@@ -0,0 +1,157 @@
+"""Persistent cache of per-photo face results, shared by all albums.
+
+Entries are keyed by the model/encoder settings plus either the image content
+(SHA-256 of the downloaded bytes) or, when the caller knows it, the Drive file
+id and revision, which allows skipping the download as well. Re-syncing an
+unchanged folder, or a photo shared across albums, then costs no inference.
+
+Each entry is one .npy file holding an (n, 4 + dim) float32 array: bbox
+followed by embedding for every face (n = 0 for photos without faces).
+The cache is bounded to FACE_CACHE_MAX_MB on disk with LRU eviction; file
+mtimes carry recency across restarts.
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_store import temp_path
+
+FACE_CACHE_DIR = os.environ.get('FACE_CACHE_DIR', os.path.join(os.path.dirname(__file__), '..', 'data', 'face_cache'))
+FACE_CACHE_MAX_MB = int(os.environ.get('FACE_CACHE_MAX_MB', 1024))  # 0 = disabled
+
+BBOX_DIM = 4
+
+
+def content_key(image_bytes):
+    return 'sha256:' + hashlib.sha256(image_bytes).hexdigest()
+
+def source_key(photo):
+    """Key from the photo's Drive file id and revision, or None if the caller didn't send both"""
+    file_id, revision = photo.get('drive_file_id'), photo.get('revision')
+    if file_id and revision:
+        return f'drive:{file_id}:{revision}'
+    return None
+
+
+class FaceCache:
+    def __init__(self, cache_dir, max_bytes, model_key):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.model_key = model_key
+        self._lock = threading.Lock()
+        self._entries = None  # OrderedDict name -> size, least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _name(self, key):
+        return hashlib.sha1(f'{self.model_key}|{key}'.encode()).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name[:2], name + '.npy')
+
+    def _load_entries(self):
+        """Scan the cache directory once (oldest first by mtime)"""
+        if self._entries is not None:
+            return
+        found = []
+        if os.path.isdir(self.cache_dir):
+            for root, _, files in os.walk(self.cache_dir):
+                for filename in files:
+                    if filename.endswith('.npy'):
+                        stat = os.stat(os.path.join(root, filename))
+                        found.append((stat.st_mtime, filename[:-4], stat.st_size))
+        found.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in found)
+        self._bytes = sum(size for _, _, size in found)
+
+    def get(self, key, record_miss=True):
+        """Cached faces for ``key`` as [(embedding, bbox)], or None on a miss.
+
+        ``record_miss=False`` for a lookup that will be retried under another
+        key, so that hit_rate stays per photo.
+        """
+        if not self.enabled:
+            return None
+        name = self._name(key)
+        with self._lock:
+            self._load_entries()
+            present = name in self._entries
+            if present:
+                self._entries.move_to_end(name)
+        if present:
+            try:
+                rows = np.load(self._path(name))
+                os.utime(self._path(name))
+                with self._lock:
+                    self.hits += 1
+                return [(row[BBOX_DIM:].copy(), row[:BBOX_DIM].tolist()) for row in rows]
+            except (OSError, ValueError):
+                with self._lock:
+                    self._bytes -= self._entries.pop(name, 0)
+        if record_miss:
+            with self._lock:
+                self.misses += 1
+        return None
+
+    def put(self, keys, faces):
+        """Store ``faces`` = [(embedding, bbox)] under every key in ``keys``"""
+        if not self.enabled or not keys:
+            return
+        if faces:
+            rows = np.hstack([
+                np.asarray([bbox for _, bbox in faces], dtype=np.float32).reshape(-1, BBOX_DIM),
+                np.asarray([embedding for embedding, _ in faces], dtype=np.float32)
+            ])
+        else:
+            rows = np.zeros((0, BBOX_DIM), dtype=np.float32)
+
+        for key in keys:
+            name = self._name(key)
+            path = self._path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = temp_path(path)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, rows)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            with self._lock:
+                self._load_entries()
+                self._bytes += size - self._entries.pop(name, 0)
+                self._entries[name] = size
+        self._evict()
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._bytes <= self.max_bytes or not self._entries:
+                    return
+                name, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries) if self._entries is not None else None,
+                'size_mb': round(self._bytes / 2 ** 20, 1),
+                'max_mb': round(self.max_bytes / 2 ** 20, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,46 @@
+"""InsightFace model loading shared by the API process and encoding worker processes"""
+import os
+import numpy as np
+import onnxruntime
+from insightface.app import FaceAnalysis
+
+MODEL_NAME = os.environ.get('FACE_MODEL', 'buffalo_l')
+DET_SIZE = int(os.environ.get('DET_SIZE', 640))
+PROVIDERS = ['CPUExecutionProvider']
+# buffalo_l also ships 2d/3d landmark and gender/age heads we never use; skipping
+# them saves load time, memory and per-face inference. Empty = load everything.
+FACE_MODULES = [m for m in os.environ.get('FACE_MODULES', 'detection,recognition').split(',') if m]
+
+
+def pin_session_threads(model, intra_op_threads):
+    """Recreate a model's ONNX session with a fixed intra-op thread count.
+
+    By default every session sizes its thread pool to all cores, so several
+    processes each running their own sessions oversubscribe the CPU.
+    """
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    model.session = onnxruntime.InferenceSession(
+        model.model_file, sess_options=options, providers=model.session.get_providers())
+
+def load_face_model(intra_op_threads=None):
+    """Load and prepare FaceAnalysis; ``intra_op_threads`` pins every ONNX session's thread pool"""
+    face_app = FaceAnalysis(name=MODEL_NAME, providers=PROVIDERS, allowed_modules=FACE_MODULES or None)
+    if intra_op_threads:
+        for model in face_app.models.values():
+            pin_session_threads(model, intra_op_threads)
+    face_app.prepare(ctx_id=0, det_size=(DET_SIZE, DET_SIZE))
+    return face_app
+
+def warm_up(face_app):
+    """Run detection and recognition once so the first real request doesn't pay for
+    ONNX session initialisation (memory arenas, kernel selection)"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (DET_SIZE, DET_SIZE, 3), dtype=np.uint8)
+    face_app.get(image)
+    recognition = face_app.models.get('recognition')
+    if recognition is not None:
+        size = recognition.input_size[0]
+        recognition.get_feat([rng.integers(0, 255, (size, size, 3), dtype=np.uint8)])
@@ -0,0 +1,91 @@
+"""Image decoding shared by the API process and encoding worker processes"""
+import os
+import io
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+# Longest side photos are decoded to for encoding (0 = full resolution). Detection
+# runs at 640x640 anyway, so pixels beyond this are only decoded to be thrown away.
+ENCODE_MAX_SIDE = int(os.environ.get('ENCODE_MAX_SIDE', 1280))
+
+# pixels: RGB array; scale: [sx, sy] = decoded size / original size;
+# data: the original bytes, for re-decoding at full resolution
+DecodedImage = namedtuple('DecodedImage', ['pixels', 'scale', 'data'])
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only file over a bytes-like object, read in place
+    (BytesIO copies anything but ``bytes``)"""
+
+    def __init__(self, data):
+        self._view = memoryview(data).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, start + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _image_file(image_bytes):
+    return io.BytesIO(image_bytes) if isinstance(image_bytes, bytes) else BufferReader(image_bytes)
+
+
+def load_image_from_bytes(image_bytes):
+    """Convert image bytes to numpy array"""
+    try:
+        with _image_file(image_bytes) as f:
+            return np.array(Image.open(f).convert('RGB'))
+    except Exception as e:
+        print(f"Error loading image: {e}")
+        return None
+
+def decode_for_detection(image_bytes, max_side=None):
+    """Decode an image with its longest side reduced to ``max_side``.
+
+    JPEGs are decoded directly at 1/2, 1/4 or 1/8 scale (draft mode), so a
+    24 MP photo never exists at full size in memory; the remainder is a cheap
+    resize. Returns a DecodedImage, or None if the bytes can't be decoded.
+    """
+    max_side = ENCODE_MAX_SIDE if max_side is None else max_side
+    try:
+        with _image_file(image_bytes) as f:
+            img = Image.open(f)
+            width, height = img.size
+            if max_side and max(width, height) > max_side:
+                ratio = max_side / max(width, height)
+                target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+                img.draft('RGB', target)
+                img = img.convert('RGB')
+                if img.size != target:
+                    img = img.resize(target, Image.BILINEAR, reducing_gap=3.0)
+            else:
+                img = img.convert('RGB')
+            pixels = np.array(img)
+        scale = np.array([pixels.shape[1] / width, pixels.shape[0] / height], dtype=np.float32)
+        return DecodedImage(pixels, scale, image_bytes)
+    except Exception as e:
+        print(f"Error loading image: {e}")
+        return None
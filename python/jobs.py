@@ -0,0 +1,336 @@
+"""Background album encoding jobs with checkpoints and cancellation.
+
+``POST /encode-album`` only creates a job; JOB_WORKERS threads run jobs one
+album at a time, outside the request semaphore, so long encodes don't hold
+search capacity. Each job lives in its own directory under JOBS_DIR:
+
+    <job_id>/job.json       job state (status, progress, failed photos, ...)
+    <job_id>/photos.json    the photo list to encode
+    <job_id>/done.jsonl     ids of finished photos, one JSON value per line
+    <job_id>/album_<id>/    faces found so far, in the binary embedding store
+
+Finished photos are checkpointed every CHECKPOINT_PHOTOS photos or
+CHECKPOINT_SECONDS: faces are appended to the job's store first, then their
+photo ids to done.jsonl. After a crash or restart, queued and running jobs
+are picked up again and only photos missing from the checkpoint are encoded.
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import threading
+from datetime import datetime
+
+import metrics
+from embedding_store import (
+    JOURNAL_COMPACT_ENTRIES, append_album, build_album, compact_journal, install_album, load_album, write_json_atomic
+)
+
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(os.path.dirname(__file__), '..', 'data', 'jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+CHECKPOINT_PHOTOS = int(os.environ.get('CHECKPOINT_PHOTOS', 50))
+CHECKPOINT_SECONDS = float(os.environ.get('CHECKPOINT_SECONDS', 10))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', 24))  # finished jobs kept for status
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+JOB_FILE = 'job.json'
+PHOTOS_FILE = 'photos.json'
+DONE_FILE = 'done.jsonl'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now():
+    return datetime.now().isoformat()
+
+def _write_json(path, data):
+    write_json_atomic(path, data)
+
+
+class Job:
+    """One album encode. State changes go through ``update`` so readers get consistent snapshots"""
+
+    def __init__(self, job_dir, state):
+        self.job_dir = job_dir
+        self.state = state
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._pending_records = []
+        self._pending_aliases = {}
+        self._pending_ids = []
+        self._checkpointed_at = time.time()
+
+    @property
+    def job_id(self):
+        return self.state['job_id']
+
+    @property
+    def album_id(self):
+        return self.state['album_id']
+
+    @property
+    def status(self):
+        return self.state['status']
+
+    def snapshot(self):
+        with self._lock:
+            state = dict(self.state, failed_photos=list(self.state['failed_photos']))
+        total = state['total_photos']
+        state['progress_percent'] = round(state['processed_photos'] / total * 100 if total else 0, 1)
+        state['failed'] = len(state['failed_photos'])
+        return state
+
+    def update(self, save=True, **fields):
+        with self._lock:
+            self.state.update(fields, updated_at=_now())
+            state = dict(self.state)
+        if save:
+            _write_json(os.path.join(self.job_dir, JOB_FILE), state)
+
+    def save(self):
+        self.update()
+
+    def complete(self, **fields):
+        self.update(status='completed', current_photo=None, finished_at=_now(), **fields)
+
+    # Cancellation
+
+    def cancel(self):
+        """Request cancellation. Returns True if the job had not started (it is cancelled right away)"""
+        with self._lock:
+            self._cancel.set()
+            if self.state['status'] != 'queued':
+                return False
+            self.state.update(status='cancelled', finished_at=_now(), updated_at=_now())
+        self.discard_checkpoint()
+        self.save()
+        return True
+
+    def start(self):
+        """Mark the job running unless it was cancelled while queued"""
+        with self._lock:
+            if self._cancel.is_set():
+                return False
+            self.state.update(status='running', started_at=self.state['started_at'] or _now())
+        self.save()
+        return True
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def raise_if_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.job_id)
+
+    # Photos and checkpoints
+
+    def photos(self):
+        with open(os.path.join(self.job_dir, PHOTOS_FILE), 'r') as f:
+            return json.load(f)
+
+    def done_photo_ids(self):
+        """Ids (as strings) of photos already in the checkpoint"""
+        done = set()
+        done_path = os.path.join(self.job_dir, DONE_FILE)
+        if os.path.exists(done_path):
+            with open(done_path, 'r') as f:
+                for line in f:
+                    try:
+                        done.add(str(json.loads(line)))
+                    except ValueError:
+                        pass  # torn last line from a crash: that photo is simply redone
+        album = self.checkpoint_album()
+        if album is not None:
+            # Faces (or near-duplicate aliases) appended but ids not yet recorded when the process died
+            done.update(str(photo_id) for photo_id in album.photo_ids)
+            done.update(str(photo_id) for photo_id in album.aliases)
+        return done
+
+    def checkpoint_album(self, mmap=True):
+        return load_album(self.job_dir, self.album_id, mmap=mmap)
+
+    def record(self, photo_id, results, alias_of=None):
+        """Buffer one finished photo's faces (or the photo it is a near-duplicate of);
+        checkpoints when enough are pending"""
+        self._pending_records.extend(results)
+        if alias_of is not None:
+            self._pending_aliases[photo_id] = alias_of
+        self._pending_ids.append(photo_id)
+        if (len(self._pending_ids) >= CHECKPOINT_PHOTOS
+                or time.time() - self._checkpointed_at >= CHECKPOINT_SECONDS):
+            self.checkpoint()
+
+    @metrics.timed('checkpoint')
+    def checkpoint(self):
+        """Persist buffered faces, then the ids of their photos"""
+        if self._pending_ids:
+            if self._pending_records or self._pending_aliases:
+                append_album(self.job_dir, self.album_id,
+                             build_album(self.album_id, self._pending_records, self._pending_aliases))
+                compact_journal(self.job_dir, self.album_id, JOURNAL_COMPACT_ENTRIES)
+            with open(os.path.join(self.job_dir, DONE_FILE), 'a') as f:
+                f.write(''.join(json.dumps(photo_id) + '\n' for photo_id in self._pending_ids))
+            self._pending_records, self._pending_aliases, self._pending_ids = [], {}, []
+        self._checkpointed_at = time.time()
+        self.save()
+
+    def install_checkpoint(self, encodings_dir):
+        """Make the checkpointed faces the album's encodings (no copy through memory).
+        Returns False if nothing was checkpointed"""
+        return install_album(self.job_dir, encodings_dir, self.album_id)
+
+    def discard_checkpoint(self):
+        shutil.rmtree(os.path.join(self.job_dir, f'album_{self.album_id}'), ignore_errors=True)
+        for filename in (PHOTOS_FILE, DONE_FILE):
+            try:
+                os.remove(os.path.join(self.job_dir, filename))
+            except OSError:
+                pass
+
+
+class JobManager:
+    """Queue of encode jobs run by ``run_job(job)`` on JOB_WORKERS threads.
+
+    With several replicas sharing JOBS_DIR, ``owns(album_id)`` tells which saved
+    jobs are this replica's to resume; the others are left to their owners."""
+
+    def __init__(self, jobs_dir, run_job, workers=JOB_WORKERS, owns=None):
+        self.jobs_dir = jobs_dir
+        self._run_job = run_job
+        self._workers = workers
+        self._owns = owns or (lambda album_id: True)
+        self._lock = threading.Lock()
+        self._jobs = {}           # job_id -> Job
+        self._album_jobs = {}     # album_id -> latest job_id
+        self._queue = queue.Queue()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def start(self):
+        """Load saved jobs, re-queue unfinished ones and start the workers"""
+        resumed = 0
+        for job in sorted(self._load_jobs(), key=lambda j: j.state['created_at']):
+            if not self._owns(job.album_id):
+                continue
+            self._register(job)
+            if job.status in ACTIVE_STATUSES:
+                job.update(status='queued', resumed=True)
+                self._queue.put(job)
+                resumed += 1
+        if resumed:
+            print(f"🔁 Resuming {resumed} unfinished encoding job(s)")
+        for i in range(self._workers):
+            threading.Thread(target=self._work, name=f'encode-job-{i}', daemon=True).start()
+
+    def submit(self, album_id, photos):
+        """Create and queue a job. Returns (job, None), or (None, active job) if the album is already encoding"""
+        album_id = str(album_id)
+        with self._lock:
+            active = self._active_job(album_id)
+            if active is not None:
+                return None, active
+            job_id = uuid.uuid4().hex[:12]
+            job_dir = os.path.join(self.jobs_dir, job_id)
+            os.makedirs(job_dir)
+            _write_json(os.path.join(job_dir, PHOTOS_FILE), photos)
+            now = _now()
+            job = Job(job_dir, {
+                'job_id': job_id,
+                'album_id': album_id,
+                'status': 'queued',
+                'total_photos': len(photos),
+                'processed_photos': 0,
+                'total_faces': 0,
+                'failed_photos': [],
+                'cache_hits': 0,
+                'inferences_avoided': 0,
+                'duplicates_collapsed': 0,
+                'current_photo': None,
+                'error': None,
+                'resumed': False,
+                'created_at': now,
+                'started_at': None,
+                'finished_at': None,
+                'updated_at': now
+            })
+            job.save()
+            self._register(job)
+        self._prune()
+        self._queue.put(job)
+        return job, None
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def latest_for_album(self, album_id):
+        with self._lock:
+            return self._jobs.get(self._album_jobs.get(str(album_id)))
+
+    def cancel(self, job_id):
+        """Request cancellation. Returns the job, or None if unknown"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        # A running job stops at its next photo; a queued one is skipped when dequeued
+        job.cancel()
+        return job
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ACTIVE_STATUSES + FINISHED_STATUSES}
+
+    def _active_job(self, album_id):
+        job = self._jobs.get(self._album_jobs.get(album_id))
+        return job if job is not None and job.status in ACTIVE_STATUSES and not job.cancelled else None
+
+    def _register(self, job):
+        self._jobs[job.job_id] = job
+        self._album_jobs[job.album_id] = job.job_id
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if not job.start():
+                continue
+            try:
+                self._run_job(job)
+            except JobCancelled:
+                job.discard_checkpoint()
+                job.update(status='cancelled', finished_at=_now())
+                print(f"🛑 Encoding job {job.job_id} (album {job.album_id}) cancelled")
+            except Exception as e:
+                job.discard_checkpoint()
+                job.update(status='failed', error=str(e), finished_at=_now())
+                print(f"❌ Encoding job {job.job_id} (album {job.album_id}) failed: {e}")
+
+    def _load_jobs(self):
+        jobs = []
+        for job_id in os.listdir(self.jobs_dir):
+            job_path = os.path.join(self.jobs_dir, job_id, JOB_FILE)
+            try:
+                with open(job_path, 'r') as f:
+                    jobs.append(Job(os.path.join(self.jobs_dir, job_id), json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return jobs
+
+    def _prune(self):
+        """Forget finished jobs older than JOB_RETENTION_HOURS (the latest job per album is kept)"""
+        cutoff = datetime.fromtimestamp(time.time() - JOB_RETENTION_HOURS * 3600).isoformat()
+        with self._lock:
+            latest = set(self._album_jobs.values())
+            expired = [job for job in self._jobs.values()
+                       if job.status in FINISHED_STATUSES and job.job_id not in latest
+                       and (job.state['finished_at'] or '') < cutoff]
+            for job in expired:
+                del self._jobs[job.job_id]
+        for job in expired:
+            shutil.rmtree(job.job_dir, ignore_errors=True)
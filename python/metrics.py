@@ -0,0 +1,248 @@
+"""Latency histograms, counters and slow-request profiles, exposed as Prometheus text on /metrics.
+
+Stages of the encode and search paths (download, decode, detection,
+recognition, store writes, index builds, base64 decode, index search, queue
+waits, ...) are timed with ``timed(stage)`` / ``observe(stage, seconds)`` into
+``face_api_stage_seconds{stage, endpoint, album_size}``, labelled with the
+request running on the thread (``background`` / ``none`` outside requests).
+Every HTTP request lands in ``face_api_request_seconds{endpoint, album_size}``,
+the album size bucketed by SIZE_BUCKETS. Counters kept elsewhere (cache hits/misses, downloads, admission
+control) are exported at scrape time by collectors (``add_collector``).
+
+With SLOW_REQUEST_MS, every slower request writes its stage timeline to
+PROFILE_DIR as JSON. A PROFILE_SAMPLE_RATE fraction of requests also runs
+under cProfile, whose stats are written next to the timeline (``.prof``, open
+with pstats or snakeviz) when such a request turns out slow. Stages that run
+on other threads (downloads, decode pool, the leader of a coalesced search
+batch) count in the histograms but only show in that thread's own timeline.
+"""
+import os
+import json
+import time
+import random
+import bisect
+import cProfile
+import threading
+from contextlib import contextmanager
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))  # 0 = no slow-request profiles
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(__file__), '..', 'data', 'profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 200))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = ((1000, '1k'), (10000, '10k'), (100000, '100k'), (1000000, '1m'))
+
+_registry = {}
+_collectors = []
+_registry_lock = threading.Lock()
+_local = threading.local()
+
+
+def _label_text(labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sample(name, labels, value):
+    return f'{name}{{{_label_text(labels)}}} {value}' if labels else f'{name} {value}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # sorted label pairs -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[position] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(_sample(f'{self.name}_bucket', key + (('le', bound),), cumulative))
+            lines.append(_sample(f'{self.name}_sum', key, round(values[-1], 6)))
+            lines.append(_sample(f'{self.name}_count', key, cumulative))
+        return lines
+
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter'] + [
+            _sample(self.name, key, value) for key, value in series]
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    with _registry_lock:
+        return _registry.setdefault(name, Histogram(name, help_text, buckets))
+
+def counter(name, help_text):
+    with _registry_lock:
+        return _registry.setdefault(name, Counter(name, help_text))
+
+def add_collector(collect):
+    """Register ``collect()`` -> iterable of (name, type, help, [(labels dict, value)]), called on every scrape"""
+    with _registry_lock:
+        _collectors.append(collect)
+
+
+STAGE_SECONDS = histogram('face_api_stage_seconds', 'Time spent in one processing stage')
+QUEUE_WAIT_SECONDS = histogram('face_api_queue_wait_seconds', 'Time spent waiting for an admission slot')
+REQUEST_SECONDS = histogram('face_api_request_seconds', 'HTTP request latency by endpoint and album size')
+RESPONSES = counter('face_api_responses_total', 'HTTP responses by endpoint and status code')
+SLOW_REQUESTS = counter('face_api_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS')
+
+
+def observe(stage, seconds):
+    """Record one stage duration (also into the current request's timeline)"""
+    STAGE_SECONDS.observe(seconds, stage=stage, endpoint=getattr(_local, 'endpoint', None) or 'background',
+                          album_size=size_bucket(getattr(_local, 'album_size', None)))
+    timeline = getattr(_local, 'timeline', None)
+    if timeline is not None:
+        timeline.append((stage, seconds))
+
+@contextmanager
+def timed(stage):
+    """Time a block as ``stage``; also usable as a decorator"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def observe_queue_wait(pool, seconds):
+    QUEUE_WAIT_SECONDS.observe(seconds, pool=pool)
+    timeline = getattr(_local, 'timeline', None)
+    if timeline is not None:
+        timeline.append((f'queue_wait_{pool}', seconds))
+
+def size_bucket(num_faces):
+    """Album size label: the smallest SIZE_BUCKETS bound holding ``num_faces``"""
+    if num_faces is None:
+        return 'none'
+    for bound, label in SIZE_BUCKETS:
+        if num_faces <= bound:
+            return label
+    return f'>{SIZE_BUCKETS[-1][1]}'
+
+
+def start_request(endpoint=None):
+    """Begin timing the request handled on this thread (sampled into cProfile)"""
+    _local.start = time.perf_counter()
+    _local.endpoint = endpoint
+    _local.timeline = []
+    _local.album_size = None
+    _local.profiler = None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            _local.profiler = profiler
+        except ValueError:
+            pass  # another profiler is active (Python 3.12+ allows one at a time)
+
+def set_album_size(num_faces):
+    """Faces of the album the current request works on (for the album_size label)"""
+    _local.album_size = num_faces
+
+def finish_request(endpoint, method, status):
+    """Record the request into the histograms; write a profile if it was slow"""
+    start = getattr(_local, 'start', None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    profiler, timeline, album_size = _local.profiler, _local.timeline, _local.album_size
+    _local.start = _local.timeline = _local.profiler = _local.endpoint = _local.album_size = None
+    if profiler is not None:
+        profiler.disable()
+
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, album_size=size_bucket(album_size))
+    RESPONSES.inc(endpoint=endpoint, status=status)
+    if SLOW_REQUEST_MS > 0 and seconds * 1000 >= SLOW_REQUEST_MS:
+        SLOW_REQUESTS.inc(endpoint=endpoint)
+        try:
+            write_profile(endpoint, method, status, seconds, album_size, timeline, profiler)
+        except OSError as e:
+            print(f"⚠️ Could not write slow request profile: {e}")
+
+def write_profile(endpoint, method, status, seconds, album_size, timeline, profiler=None):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(seconds * 1000)}ms-{endpoint.strip('/').replace('/', '_') or 'root'}"
+    name = f'{name}-{threading.get_ident()}'
+    profile = {
+        'endpoint': endpoint,
+        'method': method,
+        'status': status,
+        'duration_ms': round(seconds * 1000, 1),
+        'album_size': album_size,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': [{'stage': stage, 'ms': round(stage_seconds * 1000, 2)} for stage, stage_seconds in timeline],
+        'cprofile': f'{name}.prof' if profiler is not None else None
+    }
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}.prof'))
+    with open(os.path.join(PROFILE_DIR, f'{name}.json'), 'w') as f:
+        json.dump(profile, f, indent=2)
+    prune_profiles()
+
+def prune_profiles():
+    """Keep the newest PROFILE_MAX_FILES timelines (and their cProfile stats)"""
+    timelines = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+    for name in timelines[:max(0, len(timelines) - PROFILE_MAX_FILES)]:
+        for path in (name, name[:-len('.json')] + '.prof'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, path))
+            except FileNotFoundError:
+                pass
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics, collectors = list(_registry.values()), list(_collectors)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for collect in collectors:
+        try:
+            families = list(collect())
+        except Exception as e:
+            print(f"⚠️ Metrics collector failed: {e}")
+            continue
+        for name, kind, help_text, samples in families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(_sample(name, tuple(sorted(labels.items())), value) for labels, value in samples)
+    return '\n'.join(lines) + '\n'
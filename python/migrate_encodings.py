@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""One-shot migration of legacy album_<id>.json encodings to the binary store.
+
+Usage:
+    python python/migrate_encodings.py [--encodings-dir DIR] [--delete-json]
+"""
+import os
+import sys
+import time
+import argparse
+
+from embedding_store import list_legacy_albums, migrate_legacy_json
+
+DEFAULT_ENCODINGS_DIR = os.environ.get(
+    'ENCODINGS_DIR', os.path.join(os.path.dirname(__file__), '..', 'data', 'encodings'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate JSON face encodings to the binary store')
+    parser.add_argument('--encodings-dir', default=DEFAULT_ENCODINGS_DIR)
+    parser.add_argument('--delete-json', action='store_true',
+                        help='Delete the JSON files instead of renaming them to *.json.migrated')
+    args = parser.parse_args()
+
+    album_ids = list_legacy_albums(args.encodings_dir)
+    if not album_ids:
+        print("Nothing to migrate")
+        return 0
+
+    print(f"Migrating {len(album_ids)} album(s) in {args.encodings_dir}...")
+    failed = 0
+    for album_id in album_ids:
+        start_time = time.time()
+        try:
+            faces = migrate_legacy_json(args.encodings_dir, album_id, keep_json=not args.delete_json)
+            print(f"  ✅ album {album_id}: {faces} faces in {time.time() - start_time:.2f}s")
+        except Exception as e:
+            failed += 1
+            print(f"  ❌ album {album_id}: {e}")
+
+    print(f"\nDone: {len(album_ids) - failed} migrated, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""Streaming download -> decode -> encode pipeline for album encoding.
+
+Downloads run on the downloader's persistent asyncio loop and shared
+session (downloader.py), at most DOWNLOAD_CONCURRENCY in flight. Finished
+downloads are optionally decoded in a thread pool and pushed into a bounded
+queue; the calling thread pulls whatever is ready (up to ``batch_size``) and
+encodes it while the next downloads are still running. A full queue holds
+back new downloads, so at most in-flight + PIPELINE_QUEUE_SIZE images are in
+memory at any time, and a slow URL only delays its own photo. Photos with
+cached face results (face_cache.py) skip decode and encode, and skip the
+download too when the cache key doesn't need the image bytes.
+"""
+import os
+import time
+import asyncio
+
+import metrics
+from downloader import download_image_async, get_loop, get_session, run_async
+
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 16))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 16))
+
+_END = object()
+
+
+async def _produce(photos, queue, max_in_flight, prepare, prepare_executor, lookup):
+    """Download (and prepare) every photo into ``queue``, then put _END.
+
+    _END is queued even when a hook raises, so the consumer never waits for
+    it forever; it gets the error from the producer's future."""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    errors = []  # From fetches already done (and dropped from ``tasks``) by the time we gather
+
+    async def fetch_one(photo):
+        """Returns (photo_id, payload, error, cached results or None)"""
+        if lookup is not None:
+            cached = await loop.run_in_executor(prepare_executor, lookup, photo, None)
+            if cached is not None:
+                return photo['id'], None, None, cached
+        photo_id, payload, error = await download_image_async(session, photo['url'], photo['id'])
+        if error is not None:
+            return photo_id, None, error, None
+        if lookup is not None:
+            cached = await loop.run_in_executor(prepare_executor, lookup, photo, payload)
+            if cached is not None:
+                return photo_id, None, None, cached
+        if prepare is not None:
+            payload = await loop.run_in_executor(prepare_executor, prepare, payload)
+            if payload is None:
+                return photo_id, None, "Failed to load image", None
+        return photo_id, payload, None, None
+
+    async def fetch(photo):
+        try:
+            item = await fetch_one(photo)
+            # Blocks while the queue is full; the slot stays taken so no new download starts
+            await queue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    try:
+        session = await get_session()
+        for photo in photos:
+            await slots.acquire()
+            if errors:
+                raise errors[0]
+            task = asyncio.create_task(fetch(photo))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        if errors:
+            raise errors[0]
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        await queue.put(_END)
+        raise
+    await queue.put(_END)
+
+async def _take(queue, batch_size, producer):
+    """Wait for one item, then take whatever else is already queued (up to batch_size).
+    Raises the producer's error if it died without queueing _END"""
+    getter = asyncio.ensure_future(queue.get())
+    produced = asyncio.wrap_future(producer)
+    # Mark the error as retrieved on this wrapper; run_pipeline raises it from ``producer``
+    produced.add_done_callback(lambda future: future.cancelled() or future.exception())
+    await asyncio.wait({getter, produced}, return_when=asyncio.FIRST_COMPLETED)
+    if getter.done():
+        items = [getter.result()]
+    else:
+        getter.cancel()
+        produced.result()
+        items = [await queue.get()]  # Finished normally: _END is queued
+    while len(items) < batch_size and items[-1] is not _END and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+async def _new_queue(maxsize):
+    return asyncio.Queue(maxsize=maxsize)
+
+def run_pipeline(photos, encode, on_result, batch_size, prepare=None, prepare_executor=None,
+                 lookup=None, max_in_flight=None, queue_size=None):
+    """Stream ``photos`` ([{'id', 'url'}]) through download -> prepare -> encode.
+
+    ``lookup(photo, image_bytes)`` (optional) returns cached results for a
+    photo or None; it is tried before downloading (``image_bytes`` None) and
+    again before preparing. ``prepare(image_bytes)`` runs in
+    ``prepare_executor`` right after each download (None = pass bytes through). ``encode([(photo_id, payload)])``
+    runs on the calling thread and returns ``[(photo_id, results, error)]``.
+    ``on_result(photo_id, results, error)`` is called once per photo as soon
+    as it is done (or failed). Returns the seconds spent inside ``encode``.
+    An exception from a hook (``lookup``, ``prepare``) or the downloads stops
+    the pipeline and is raised here.
+    """
+    loop = get_loop()
+    queue = run_async(_new_queue(queue_size or PIPELINE_QUEUE_SIZE))
+    producer = asyncio.run_coroutine_threadsafe(
+        _produce(photos, queue, max_in_flight or DOWNLOAD_CONCURRENCY, prepare, prepare_executor, lookup), loop)
+
+    encode_seconds = 0.0
+    finished = False
+    try:
+        while not finished:
+            with metrics.timed('pipeline_wait'):
+                items = run_async(_take(queue, batch_size, producer))
+            if items[-1] is _END:
+                finished = True
+                items.pop()
+
+            ready = []
+            for photo_id, payload, error, cached in items:
+                if error:
+                    on_result(photo_id, [], error)
+                elif cached is not None:
+                    on_result(photo_id, cached, None)
+                else:
+                    ready.append((photo_id, payload))
+            if not ready:
+                continue
+
+            encode_start = time.time()
+            outcomes = encode(ready)
+            encode_seconds += time.time() - encode_start
+            for photo_id, results, error in outcomes:
+                on_result(photo_id, results, error)
+    finally:
+        if not finished:
+            producer.cancel()
+        else:
+            producer.result()
+    return encode_seconds
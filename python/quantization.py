@@ -0,0 +1,68 @@
+"""Compressed in-memory storage of face embeddings for search.
+
+EMBEDDING_PRECISION selects how search structures (FAISS indexes and the
+NumPy search matrices) hold an album's normalized 512-d faces:
+
+    float32   exact, 2048 bytes per face
+    float16   1024 bytes, error well below the 3 decimals similarities are reported with
+    int8      512 bytes (+4 for the row scale), symmetric per-row scalar quantization
+    pq        PQ_M bytes (ann_index), product quantization; FAISS only, NumPy
+              matrices use int8 instead
+
+The float32 store on disk stays the source of truth. Scores from compressed
+vectors are approximate, so hits within the precision's re-rank margin of the
+threshold are re-scored exactly against the memory-mapped store rows. Hits
+clearly above or below it keep their approximate score, so only a handful of
+rows per query are read back. The default margins cover the float16 and int8
+score errors measured by bench/quantization.py; PQ errors depend much more on
+the data, so check its recall with the benchmark before enabling it.
+RERANK_MARGIN overrides every margin.
+"""
+import os
+import numpy as np
+
+PRECISIONS = ('float32', 'float16', 'int8', 'pq')
+EMBEDDING_PRECISION = os.environ.get('EMBEDDING_PRECISION', 'float32')
+RERANK_MARGINS = {'float32': 0.0, 'float16': 0.001, 'int8': 0.01, 'pq': 0.1}
+if os.environ.get('RERANK_MARGIN'):
+    RERANK_MARGINS.update((precision, float(os.environ['RERANK_MARGIN'])) for precision in PRECISIONS[1:])
+
+SCORE_BLOCK = 16384  # compressed rows widened to float32 at a time while scoring
+
+
+def configured_precision():
+    return EMBEDDING_PRECISION if EMBEDDING_PRECISION in PRECISIONS else 'float32'
+
+def matrix_precision(precision=None):
+    """Precision of NumPy search matrices: PQ codebooks need FAISS, so 'pq' falls back to int8"""
+    precision = precision or configured_precision()
+    return 'int8' if precision == 'pq' else precision
+
+def quantize(vectors, precision):
+    """Compress normalized float32 rows. Returns (codes, scale), ``scale`` is per row for int8 else None"""
+    if precision == 'float16':
+        return np.asarray(vectors, dtype=np.float16), None
+    if precision == 'int8':
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scale = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.empty(0, dtype=np.float32)
+        scale[scale == 0] = 1.0
+        codes = np.rint(vectors / scale[:, None]).astype(np.int8)
+        return codes, scale.astype(np.float32)
+    return np.array(vectors, dtype=np.float32), None  # a RAM copy, also of memory-mapped rows
+
+def scores(queries, codes, scale=None):
+    """(num_queries, num_rows) inner products of float32 queries with (possibly compressed) rows"""
+    if codes.dtype == np.float32:
+        return queries @ codes.T
+    # Widen blockwise so a search never holds a float32 copy of the whole matrix
+    out = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_BLOCK):
+        out[:, start:start + SCORE_BLOCK] = queries @ codes[start:start + SCORE_BLOCK].astype(np.float32).T
+    if scale is not None:
+        out *= scale
+    return out
+
+def rerank_margin(precision):
+    """How far from the threshold scores of vectors stored at ``precision`` get re-scored (0 = exact).
+    A NumPy dtype works too (float32 / float16 / int8 matrices)"""
+    return RERANK_MARGINS.get(str(precision), 0.0)
@@ -0,0 +1,193 @@
+"""Running several face-api replicas: album-affinity routing and cache invalidation.
+
+Replicas share ENCODINGS_DIR (the binary store and persisted ANN indexes), but
+each keeps its own album cache. Two pieces keep that working:
+
+- ``HashRing`` maps every album id to one replica of REPLICAS by consistent
+  hashing, so an album is searched (and kept hot) on one node and writes to
+  its store come from a single process. Adding a replica only moves about
+  1/N of the albums. A replica that serves an album it doesn't own (a
+  stale Node ring) reads the shared files but never writes them; its own
+  files there (hot albums) get a per-replica name via ``local_path``. ``server/faceApi.js`` builds the same ring from
+  FACE_API_REPLICAS to pick the replica for each request.
+- A bus publishes ``{'type': 'invalidate', 'album_id', 'generation'}`` when an
+  album's encodings change; the other replicas drop their cached copy if it
+  is older. With REDIS_URL set this is Redis pub/sub (the ``redis`` package),
+  otherwise ``LocalBus`` delivers in-process, which is all a single replica
+  needs and what tests can share between simulated replicas.
+
+Pub/sub drops messages while a subscriber is disconnected, so after every
+(re)subscribe the handlers get ``{'type': 'resync'}`` and re-check what they cache.
+"""
+import os
+import json
+import time
+import bisect
+import socket
+import hashlib
+import threading
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+REDIS_URL = os.environ.get('REDIS_URL', '')
+REDIS_ENABLED = os.environ.get('REDIS_ENABLED', 'true').lower() != 'false'
+REPLICA_CHANNEL = os.environ.get('REPLICA_CHANNEL', 'face-api:albums')
+# Base URLs of all replicas, comma-separated and identical on every replica and in Node's FACE_API_REPLICAS
+REPLICAS = [url.strip().rstrip('/') for url in os.environ.get('REPLICAS', '').split(',') if url.strip()]
+# This replica's own entry in REPLICAS
+REPLICA_URL = os.environ.get('REPLICA_URL', '').rstrip('/')
+RING_VNODES = int(os.environ.get('RING_VNODES', 64))
+RECONNECT_SECONDS = 5
+
+REPLICA_NAME = REPLICA_URL or f'{socket.gethostname()}:{os.getpid()}'
+
+
+def ring_hash(key):
+    """32-bit ring position of ``key`` (first 8 hex digits of its MD5, same as server/faceApi.js)"""
+    return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def local_path(path):
+    """``path`` made private to this replica when several share its directory"""
+    if len(REPLICAS) < 2:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{ring_hash(REPLICA_NAME):08x}{ext}'
+
+
+class HashRing:
+    """Consistent-hash ring of replicas, ``vnodes`` points per replica"""
+
+    def __init__(self, replicas, vnodes=RING_VNODES):
+        self.replicas = list(replicas)
+        points = sorted((ring_hash(f'{replica}#{i}'), replica) for replica in self.replicas for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [replica for _, replica in points]
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def owner(self, album_id):
+        """Replica serving ``album_id`` (None with an empty ring)"""
+        if not self._hashes:
+            return None
+        position = bisect.bisect_right(self._hashes, ring_hash(album_id)) % len(self._hashes)
+        return self._owners[position]
+
+    def owns(self, album_id, replica=REPLICA_URL):
+        """Whether ``replica`` serves the album; every album is local without a ring"""
+        return len(self.replicas) < 2 or self.owner(album_id) == replica
+
+
+class LocalBus:
+    """In-process bus: ``publish`` calls the subscribers of other origins right away"""
+
+    def __init__(self, origin=REPLICA_NAME):
+        self.origin = origin
+        self._handlers = []
+        self._lock = threading.Lock()
+        self.published = 0
+        self.received = 0
+
+    @property
+    def kind(self):
+        return 'local'
+
+    def subscribe(self, handler, origin=None):
+        """Call ``handler(message)`` for messages published by anyone but ``origin``"""
+        with self._lock:
+            self._handlers.append((handler, origin or self.origin))
+
+    def publish(self, message, origin=None):
+        message = dict(message, origin=origin or self.origin)
+        self.published += 1
+        self._dispatch(message)
+        return True
+
+    def _dispatch(self, message):
+        with self._lock:
+            handlers = list(self._handlers)
+        for handler, origin in handlers:
+            if message.get('origin') == origin:
+                continue
+            self.received += 1
+            try:
+                handler(message)
+            except Exception as e:
+                print(f"⚠️ Replica message handler failed: {e}")
+
+    def stats(self):
+        return {'bus': self.kind, 'origin': self.origin, 'published': self.published, 'received': self.received}
+
+
+class RedisBus(LocalBus):
+    """Redis pub/sub on one channel; a daemon thread listens and reconnects"""
+
+    def __init__(self, url, channel=REPLICA_CHANNEL, origin=REPLICA_NAME):
+        super().__init__(origin)
+        self.channel = channel
+        self.connected = False
+        self.errors = 0
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=5, health_check_interval=30)
+        self._listener = None
+
+    @property
+    def kind(self):
+        return 'redis'
+
+    def subscribe(self, handler, origin=None):
+        super().subscribe(handler, origin)
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='replica-bus', daemon=True)
+                self._listener.start()
+
+    def publish(self, message, origin=None):
+        message = dict(message, origin=origin or self.origin)
+        try:
+            self._client.publish(self.channel, json.dumps(message))
+        except redis.RedisError as e:
+            self.errors += 1
+            print(f"⚠️ Could not publish {message.get('type')} for album {message.get('album_id')}: {e}")
+            return False
+        self.published += 1
+        return True
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.connected = True
+                print(f"✅ Replica bus subscribed to {self.channel}")
+                # Anything published while we were not listening is lost: re-check caches
+                self._dispatch({'type': 'resync'})
+                for item in pubsub.listen():
+                    try:
+                        message = json.loads(item['data'])
+                    except (TypeError, ValueError):
+                        continue
+                    self._dispatch(message)
+            except redis.RedisError as e:
+                if self.connected:
+                    print(f"⚠️ Replica bus disconnected: {e}")
+                self.connected = False
+                self.errors += 1
+                time.sleep(RECONNECT_SECONDS)
+
+    def stats(self):
+        return {**super().stats(), 'channel': self.channel, 'connected': self.connected, 'errors': self.errors}
+
+
+def connect(url=REDIS_URL, channel=REPLICA_CHANNEL, origin=REPLICA_NAME):
+    """Redis bus when configured and installed, otherwise the in-process bus"""
+    if not url or not REDIS_ENABLED:
+        return LocalBus(origin)
+    if not REDIS_AVAILABLE:
+        print("⚠️ REDIS_URL is set but the redis package is not installed; cache invalidation stays local")
+        return LocalBus(origin)
+    return RedisBus(url, channel, origin)
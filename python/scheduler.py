@@ -0,0 +1,150 @@
+"""Admission control with separate capacity pools per request class.
+
+Interactive searches and bulk encoding each get their own pool, so a few
+large encodes can no longer use up the slots searches need. A pool runs at
+most ``capacity`` requests and queues up to ``max_queue`` more; beyond that,
+or after waiting ``queue_timeout`` seconds, a request is rejected with
+PoolBusy, whose ``retry_after`` estimates when a slot frees up.
+
+Bulk work also calls ``yield_to_interactive`` between batches: while
+searches are running it pauses (up to BULK_YIELD_MS) so the CPU goes to the
+request a user is waiting on.
+
+Queue wait and run time are kept for the last LATENCY_WINDOW requests of each
+pool and reported as percentiles by ``stats()``.
+"""
+import os
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+import metrics
+
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 5))
+SEARCH_CONCURRENCY = int(os.environ.get('SEARCH_CONCURRENCY', MAX_CONCURRENT_REQUESTS))
+SEARCH_QUEUE_DEPTH = int(os.environ.get('SEARCH_QUEUE_DEPTH', 64))
+SEARCH_QUEUE_TIMEOUT = float(os.environ.get('SEARCH_QUEUE_TIMEOUT', 10))
+ENCODE_CONCURRENCY = int(os.environ.get('ENCODE_CONCURRENCY', 2))
+ENCODE_QUEUE_DEPTH = int(os.environ.get('ENCODE_QUEUE_DEPTH', 8))
+ENCODE_QUEUE_TIMEOUT = float(os.environ.get('ENCODE_QUEUE_TIMEOUT', 60))
+BULK_YIELD_MS = float(os.environ.get('BULK_YIELD_MS', 100))  # max pause per encode batch while searches run
+
+LATENCY_WINDOW = 1000
+
+
+class PoolBusy(Exception):
+    def __init__(self, pool, retry_after):
+        super().__init__(f"{pool} pool is full")
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class Pool:
+    def __init__(self, name, capacity, max_queue, queue_timeout):
+        self.name = name
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._waits = deque(maxlen=LATENCY_WINDOW)
+        self._runs = deque(maxlen=LATENCY_WINDOW)
+
+    @contextmanager
+    def slot(self, bounded=True):
+        """Hold one slot of the pool; yields the seconds spent queued.
+
+        ``bounded=False`` waits as long as it takes and ignores the queue depth
+        limit (background jobs that have nobody to send a 503 to).
+        """
+        queued_at = time.time()
+        with self._cond:
+            if self.in_flight >= self.capacity:
+                if bounded and self.queued >= self.max_queue:
+                    self.rejected += 1
+                    raise PoolBusy(self.name, self._retry_after())
+                self.queued += 1
+                try:
+                    deadline = queued_at + self.queue_timeout if bounded else None
+                    while self.in_flight >= self.capacity:
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolBusy(self.name, self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+        started_at = time.time()
+        wait = started_at - queued_at
+        metrics.observe_queue_wait(self.name, wait)
+        try:
+            yield wait
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._waits.append(wait)
+                self._runs.append(time.time() - started_at)
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout):
+        """Wait until nothing is running in this pool, for at most ``timeout`` seconds"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.in_flight > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _retry_after(self):
+        """Whole seconds until the queue ahead is likely drained (at least 1)"""
+        run_time = float(np.mean(self._runs)) if self._runs else 1.0
+        return max(1, math.ceil((self.queued + 1) * run_time / max(1, self.capacity)))
+
+    def stats(self):
+        with self._cond:
+            waits, runs = list(self._waits), list(self._runs)
+            stats = {
+                'capacity': self.capacity,
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts
+            }
+        stats['queue_wait_ms'] = _percentiles(waits)
+        stats['run_ms'] = _percentiles(runs)
+        return stats
+
+
+def _percentiles(samples):
+    if not samples:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    p50, p95, p99 = (float(p) for p in np.percentile(samples, [50, 95, 99]) * 1000)
+    return {'p50': round(p50, 1), 'p95': round(p95, 1), 'p99': round(p99, 1), 'max': round(max(samples) * 1000, 1)}
+
+
+class Scheduler:
+    def __init__(self):
+        self.search = Pool('search', SEARCH_CONCURRENCY, SEARCH_QUEUE_DEPTH, SEARCH_QUEUE_TIMEOUT)
+        self.encode = Pool('encode', ENCODE_CONCURRENCY, ENCODE_QUEUE_DEPTH, ENCODE_QUEUE_TIMEOUT)
+
+    def yield_to_interactive(self):
+        """Called by bulk work between batches: let running searches finish first"""
+        if self.search.in_flight > 0:
+            self.search.wait_idle(BULK_YIELD_MS / 1000)
+
+    def stats(self):
+        return {'search': self.search.stats(), 'encode': self.encode.stats()}
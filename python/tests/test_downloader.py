@@ -0,0 +1,108 @@
+"""Downloader retries against the stub image server (bench/stub_image_server.py).
+
+Run from python/: python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bench'))
+
+import downloader  # noqa: E402
+from stub_image_server import start_server  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    """Start a stub server: ``stub(error_rate=..., retry_after=...)`` -> (base url, counters)"""
+    servers = []
+
+    def start(error_rate=0.0, retry_after=0, latency_ms=1, seed=0):
+        server, counters = start_server(SimpleNamespace(
+            port=0, latency_ms=latency_ms, error_rate=error_rate, retry_after=retry_after,
+            width=64, height=48, seed=seed))
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_port}', counters
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Retry-After value of every retry; the retries themselves don't wait"""
+    seen = []
+
+    def record(attempt, retry_after=None):
+        seen.append(retry_after)
+        return 0.0
+
+    monkeypatch.setattr(downloader, 'retry_delay', record)
+    return seen
+
+
+def download(base, count, retries):
+    async def fetch_all():
+        session = await downloader.get_session()
+        return await asyncio.gather(*[
+            downloader.download_image_async(session, f'{base}/{i}.jpg', i, timeout=5, retries=retries)
+            for i in range(count)
+        ])
+    return downloader.run_async(fetch_all())
+
+
+def test_retries_until_success(stub, delays):
+    base, counters = stub(error_rate=0.3, retry_after=1, seed=1)
+    before = downloader.get_stats()
+    results = download(base, 40, retries=10)
+    after = downloader.get_stats()
+
+    assert all(image_bytes for _, image_bytes, _ in results)
+    assert after['failures'] == before['failures']
+    assert after['downloads'] - before['downloads'] == 40
+    retries = after['retries'] - before['retries']
+    assert retries == len(delays) > 0
+    # aiohttp itself resends once when a reused connection was reset, so the server may see more
+    assert counters['requests'] >= 40 + retries
+    # 429s carry the stub's Retry-After; 503s and resets fall back to backoff
+    assert '1' in delays and set(delays) <= {'1', None}
+
+
+def test_gives_up_after_retries(stub, delays):
+    base, counters = stub(error_rate=1.0)
+    before = downloader.get_stats()
+    results = download(base, 10, retries=2)
+    after = downloader.get_stats()
+
+    assert [image_bytes for _, image_bytes, _ in results] == [None] * 10
+    assert all(error for _, _, error in results)
+    assert after['failures'] - before['failures'] == 10
+    assert after['retries'] - before['retries'] == 20
+    assert counters['requests'] >= 30
+
+
+def test_no_retry_on_client_error(stub, delays):
+    base, counters = stub()
+    photo_id, image_bytes, error = download(base + '/missing', 1, retries=3)[0]
+
+    assert image_bytes is None and error == 'HTTP 404'
+    assert counters['requests'] == 1 and not delays
+
+
+def test_retry_delay(monkeypatch):
+    monkeypatch.setattr(downloader, 'RETRY_BASE_SECONDS', 0.5)
+    monkeypatch.setattr(downloader, 'RETRY_MAX_SECONDS', 10)
+
+    assert downloader.retry_delay(0, '3') == 3.0
+    assert downloader.retry_delay(0, '120') == 10
+    assert downloader.retry_delay(0, '-1') == 0.0
+    for attempt in range(6):
+        assert 0 <= downloader.retry_delay(attempt) <= min(10, 0.5 * 2 ** attempt)
+    # HTTP-date Retry-After falls back to backoff
+    assert 0 <= downloader.retry_delay(1, 'Wed, 21 Oct 2015 07:28:00 GMT') <= 1.0
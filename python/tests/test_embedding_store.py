@@ -0,0 +1,171 @@
+"""Binary store round trips and crash recovery (embedding_store.py).
+
+Run from python/: python -m pytest tests
+"""
+import os
+import sys
+import json
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import embedding_store  # noqa: E402
+from embedding_store import (  # noqa: E402
+    JOURNAL_FILE, album_exists, append_album, build_album, compact_album, compact_journal, get_album_dir,
+    get_legacy_json_path, install_album, load_album, migrate_legacy_json, save_album, tombstone_rows
+)
+
+DIM = 8
+
+
+def records(photo_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{'photo_id': photo_id, 'embedding': rng.standard_normal(DIM).tolist(), 'bbox': [1, 2, 3, 4]}
+            for photo_id in photo_ids]
+
+
+def album(album_id, photo_ids, seed=0):
+    return build_album(album_id, records(photo_ids, seed))
+
+
+def journal_path(encodings_dir, album_id):
+    return os.path.join(get_album_dir(encodings_dir, album_id), JOURNAL_FILE)
+
+
+def test_append_then_load(tmp_path):
+    first, second = album('a', ['p1', 'p2', 'p2']), album('a', ['p3', 'p4'], seed=1)
+    save_album(tmp_path, first)
+    assert append_album(tmp_path, 'a', second) == 3
+
+    loaded = load_album(tmp_path, 'a')
+    assert loaded.photo_ids == ['p1', 'p2', 'p2', 'p3', 'p4']
+    assert np.allclose(loaded.embeddings, np.vstack([first.embeddings, second.embeddings]))
+    assert np.allclose(np.linalg.norm(loaded.embeddings, axis=1), 1)
+    assert loaded.generation == 2 and loaded.journal_entries == 1
+    assert append_album(tmp_path, 'a', build_album('a', [])) == 5
+    assert load_album(tmp_path, 'a').generation == 2
+
+
+def test_append_creates_missing_album(tmp_path):
+    assert append_album(tmp_path, 'new', album('other', ['p1'])) == 0
+    assert load_album(tmp_path, 'new').photo_ids == ['p1']
+
+
+def test_tombstone_then_compact(tmp_path):
+    original = album('a', ['p1', 'p2', 'p3', 'p4'])
+    save_album(tmp_path, original)
+    tombstone_rows(tmp_path, 'a', [1, 3])
+    tombstone_rows(tmp_path, 'a', [1])  # already dead: no new journal entry
+
+    tombstoned = load_album(tmp_path, 'a')
+    assert tombstoned.deleted_rows.tolist() == [1, 3]
+    assert len(tombstoned) == 2 and tombstoned.num_rows == 4
+    assert tombstoned.generation == 2 and tombstoned.journal_entries == 1
+    assert tombstoned.rows_for_photos({'p2', 'p3'}).tolist() == [2]
+
+    compacted = compact_album(tmp_path, 'a')
+    assert compacted.photo_ids == ['p1', 'p3'] and len(compacted.deleted_rows) == 0
+    assert np.allclose(compacted.embeddings, original.embeddings[[0, 2]])
+    assert compacted.generation == 3 and compacted.journal_entries == 0
+    assert not os.path.exists(journal_path(tmp_path, 'a'))
+    assert sorted(name for name in os.listdir(get_album_dir(tmp_path, 'a')) if name.endswith('.f32')) == [
+        'bboxes.1.f32', 'embeddings.1.f32']
+
+
+def test_compact_journal_keeps_contents(tmp_path):
+    save_album(tmp_path, album('a', ['p1', 'p2']))
+    append_album(tmp_path, 'a', album('a', ['p3'], seed=1))
+    tombstone_rows(tmp_path, 'a', [0])
+    before = load_album(tmp_path, 'a', mmap=False)
+
+    assert not compact_journal(tmp_path, 'a', min_entries=3)
+    assert compact_journal(tmp_path, 'a')
+    after = load_album(tmp_path, 'a', mmap=False)
+    assert not os.path.exists(journal_path(tmp_path, 'a'))
+    assert after.generation == before.generation and after.journal_entries == 0
+    assert after.photo_ids == before.photo_ids and after.deleted_rows.tolist() == [0]
+    assert np.array_equal(after.embeddings, before.embeddings)
+
+
+def test_replay_ignores_torn_journal_line(tmp_path):
+    save_album(tmp_path, album('a', ['p1']))
+    append_album(tmp_path, 'a', album('a', ['p2'], seed=1))
+    append_album(tmp_path, 'a', album('a', ['p3'], seed=2))
+    path = journal_path(tmp_path, 'a')
+    with open(path, 'rb+') as f:
+        f.truncate(os.path.getsize(path) - 5)  # crash while committing the last append
+
+    loaded = load_album(tmp_path, 'a')
+    assert loaded.photo_ids == ['p1', 'p2'] and loaded.generation == 2
+
+    # The next write cuts off the torn line and the uncommitted matrix rows
+    assert append_album(tmp_path, 'a', album('a', ['p4'], seed=3)) == 2
+    loaded = load_album(tmp_path, 'a', mmap=False)
+    assert loaded.photo_ids == ['p1', 'p2', 'p4'] and loaded.generation == 3
+    assert np.allclose(loaded.embeddings[2], album('a', ['p4'], seed=3).embeddings[0])
+    with open(path) as f:
+        assert [json.loads(line)['generation'] for line in f] == [2, 3]
+
+
+def test_load_retries_when_segment_swapped(tmp_path, monkeypatch):
+    save_album(tmp_path, album('a', ['p1', 'p2']))
+    map_matrix = embedding_store._map_matrix
+    calls = []
+
+    def swapped_once(*args):
+        calls.append(args[0])
+        if len(calls) == 1:
+            raise FileNotFoundError(args[0])
+        return map_matrix(*args)
+
+    monkeypatch.setattr(embedding_store, '_map_matrix', swapped_once)
+    assert load_album(tmp_path, 'a').photo_ids == ['p1', 'p2']
+    assert len(calls) == 3
+
+
+def test_install_checkpoint(tmp_path):
+    checkpoint, store = tmp_path / 'job', tmp_path / 'store'
+    save_album(store, album('a', ['old']))
+    save_album(checkpoint, album('a', ['p1', 'p2']))
+    append_album(checkpoint, 'a', album('a', ['p3'], seed=1))
+
+    assert install_album(checkpoint, store, 'a')
+    installed = load_album(store, 'a')
+    assert installed.photo_ids == ['p1', 'p2', 'p3']
+    assert installed.generation == 2 and installed.journal_entries == 0
+    assert load_album(checkpoint, 'a').photo_ids == ['p1', 'p2', 'p3']
+    assert not install_album(tmp_path / 'missing', store, 'a')
+
+
+def test_migrate_legacy_json(tmp_path):
+    with open(get_legacy_json_path(tmp_path, 'a'), 'w') as f:
+        json.dump(records(['p1', 'p2']), f)
+
+    assert migrate_legacy_json(tmp_path, 'a') == 2
+    assert load_album(tmp_path, 'a').photo_ids == ['p1', 'p2']
+    assert os.path.exists(get_legacy_json_path(tmp_path, 'a') + '.migrated')
+    assert migrate_legacy_json(tmp_path, 'a') is None
+
+
+def test_migrate_legacy_json_already_moved(tmp_path, monkeypatch):
+    """A JSON file renamed by a concurrent migration counts as migrated"""
+    json_path = get_legacy_json_path(tmp_path, 'a')
+    with open(json_path, 'w') as f:
+        json.dump(records(['p1']), f)
+
+    def save_then_lose_json(encodings_dir, encodings):
+        save_album(encodings_dir, encodings)
+        os.replace(json_path, json_path + '.migrated')
+
+    monkeypatch.setattr(embedding_store, 'save_album', save_then_lose_json)
+    assert migrate_legacy_json(tmp_path, 'a') == 1
+    assert album_exists(tmp_path, 'a')
+
+
+@pytest.mark.parametrize('missing', ['meta', 'album'])
+def test_load_missing_album(tmp_path, missing):
+    if missing == 'meta':
+        os.makedirs(get_album_dir(tmp_path, 'a'))
+    assert load_album(tmp_path, 'a') is None
@@ -0,0 +1,56 @@
+"""Service-level store behaviour, against face_api with the benchmark's stub model (bench/hot_paths.py).
+
+Run from python/: python -m pytest tests
+"""
+import os
+import sys
+import json
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bench'))
+
+
+@pytest.fixture(scope='module')
+def face_api(tmp_path_factory):
+    import hot_paths
+    args = SimpleNamespace(real_model=False, det_ms=0, rec_ms=0, noise=0.3, verbose=False)
+    service, _ = hot_paths.load_service(args, str(tmp_path_factory.mktemp('face_api')))
+    return service
+
+
+def write_legacy_album(face_api, album_id, count):
+    rng = np.random.default_rng(0)
+    records = [{'photo_id': i, 'embedding': rng.standard_normal(512).tolist(), 'bbox': [1, 2, 3, 4]}
+               for i in range(count)]
+    with open(os.path.join(face_api.ENCODINGS_DIR, f'album_{album_id}.json'), 'w') as f:
+        json.dump(records, f)
+
+
+def test_concurrent_first_loads_migrate_once(face_api):
+    for trial in range(20):
+        album_id = f'legacy{trial}'
+        write_legacy_album(face_api, album_id, 10)
+        barrier = threading.Barrier(4)
+        loaded, errors = [], []
+
+        def load():
+            barrier.wait()
+            try:
+                loaded.append(face_api.load_album_encodings(album_id))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert [len(encodings) for encodings in loaded] == [10] * 4
+        assert face_api.load_album(face_api.ENCODINGS_DIR, album_id).generation == 1
@@ -0,0 +1,37 @@
+"""Replica ring parity: python/replicas.py and server/faceApi.js must pick the same owner.
+
+tests/ring_vectors.json holds fixed replica lists and the expected owner of
+each album id; server/test/faceApi.test.js asserts the same vectors.
+Run from python/: python -m pytest tests
+"""
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from replicas import HashRing  # noqa: E402
+
+with open(os.path.join(os.path.dirname(__file__), 'ring_vectors.json')) as f:
+    VECTORS = json.load(f)
+
+
+@pytest.mark.parametrize('case', VECTORS, ids=lambda case: f"{len(case['replicas'])}x{case['vnodes']}")
+def test_ring_owners(case):
+    ring = HashRing(case['replicas'], case['vnodes'])
+    assert {album_id: ring.owner(album_id) for album_id in case['owners']} == case['owners']
+    # Replica order doesn't matter
+    assert HashRing(case['replicas'][::-1], case['vnodes']).owner('42') == case['owners']['42']
+
+
+def test_numeric_album_ids_hash_like_strings():
+    ring = HashRing(VECTORS[0]['replicas'], VECTORS[0]['vnodes'])
+    assert ring.owner(7) == ring.owner('7') == VECTORS[0]['owners']['7']
+
+
+def test_single_replica_owns_everything():
+    assert HashRing([]).owner('7') is None
+    assert HashRing(['http://a']).owns('7', replica='http://b')
+    assert not HashRing(['http://a', 'http://b']).owns('7', replica='http://c')
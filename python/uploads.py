@@ -0,0 +1,217 @@
+"""Query images sent as base64 JSON, raw bodies or multipart uploads.
+
+/search, /search-multi and /detect take the image in any of three forms:
+
+    application/json       {"image": "data:image/jpeg;base64,...", ...} (the original API)
+    image/* or application/octet-stream
+                           the image itself; other fields in the query string
+    multipart/form-data    an "image" file part; other fields as form fields
+
+Raw and multipart bodies are streamed in UPLOAD_CHUNK_BYTES chunks into a
+bytearray taken from a small pool, so a 5 MB selfie is held once (no JSON
+text, no base64 string) and the buffer's capacity is reused by the next
+request. PIL decodes straight from the buffer, which goes back to the pool
+when the request ends. With QUERY_MAX_SIDE, JPEGs are decoded reduced (draft
+mode) before detection; face boxes are mapped back to original coordinates.
+"""
+import os
+import base64
+from io import BytesIO
+import threading
+
+from flask import g, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+import metrics
+from image_io import decode_for_detection
+
+QUERY_MAX_SIDE = int(os.environ.get('QUERY_MAX_SIDE', 0))  # 0 = detect on the full-resolution image
+MAX_UPLOAD_MB = float(os.environ.get('MAX_UPLOAD_MB', 20))
+UPLOAD_BUFFERS = int(os.environ.get('UPLOAD_BUFFERS', 8))  # idle buffers kept for reuse
+UPLOAD_BUFFER_KEEP_MB = float(os.environ.get('UPLOAD_BUFFER_KEEP_MB', 8))  # larger ones are not kept
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+RAW_TYPES = ('application/octet-stream',)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadBuffer:
+    """Growable byte buffer; ``view()`` is the filled part, without a copy"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.size = 0
+        self._views = []
+
+    def write(self, chunk):
+        end = self.size + len(chunk)
+        if end > MAX_UPLOAD_MB * 2 ** 20:
+            raise UploadError(f'Ảnh quá lớn (tối đa {MAX_UPLOAD_MB:g} MB)', 413)
+        if end > len(self.data):
+            self.data.extend(bytes(max(end, 2 * len(self.data)) - len(self.data)))
+        self.data[self.size:end] = chunk
+        self.size = end
+
+    def view(self):
+        view = memoryview(self.data)[:self.size]
+        self._views.append(view)
+        return view
+
+    def reset(self):
+        """Empty the buffer; views handed out stop working (raises BufferError if one is still exported)"""
+        while self._views:
+            self._views.pop().release()
+        self.size = 0
+
+
+class BufferPool:
+    """Idle UploadBuffers, at most ``keep`` of them and none above ``keep_bytes``"""
+
+    def __init__(self, keep=UPLOAD_BUFFERS, keep_bytes=UPLOAD_BUFFER_KEEP_MB * 2 ** 20):
+        self.keep = keep
+        self.keep_bytes = keep_bytes
+        self._idle = []
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.allocated = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.allocated += 1
+        return UploadBuffer()
+
+    def release(self, buffer):
+        try:
+            buffer.reset()
+        except BufferError:
+            return  # Something still reads from it: leave it to the garbage collector
+        with self._lock:
+            if len(self._idle) < self.keep and len(buffer.data) <= self.keep_bytes:
+                self._idle.append(buffer)
+
+    def stats(self):
+        with self._lock:
+            idle_bytes = sum(len(buffer.data) for buffer in self._idle)
+            return {'idle': len(self._idle), 'idle_mb': round(idle_bytes / 2 ** 20, 1),
+                    'reused': self.reused, 'allocated': self.allocated}
+
+
+buffer_pool = BufferPool()
+
+
+def read_query_image(max_side=QUERY_MAX_SIDE):
+    """Fields and image of the current request, in whichever form it was sent.
+
+    Returns (fields, image): ``fields`` is a dict of the non-image fields (values
+    are strings for raw and multipart requests), ``image`` a DecodedImage or None
+    if no image was sent. Raises UploadError for bodies that can't be read or decoded.
+    """
+    mimetype = request.mimetype
+    if mimetype == 'multipart/form-data':
+        fields, buffer = _read_multipart()
+        if buffer is None:
+            return fields, _decode_base64(fields.get('image'), max_side)
+    elif mimetype.startswith('image/') or mimetype in RAW_TYPES:
+        fields, buffer = request.args.to_dict(), _read_raw()
+    else:
+        fields = request.get_json(silent=True)
+        if not isinstance(fields, dict):
+            raise UploadError('Body không hợp lệ: cần JSON, ảnh hoặc multipart/form-data')
+        return fields, _decode_base64(fields.get('image'), max_side)
+
+    if not buffer.size:
+        return fields, None
+    with metrics.timed('decode'):
+        image = decode_for_detection(buffer.view(), max_side)
+    if image is None:
+        raise UploadError('Không thể đọc ảnh')
+    return fields, image
+
+def release_request_buffers(exc=None):
+    """Give the request's upload buffers back to the pool (``teardown_request`` hook)"""
+    for buffer in g.pop('upload_buffers', ()):
+        buffer_pool.release(buffer)
+
+def field_flag(value):
+    """Boolean field from JSON (true) or a query string / form ('true', '1')"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
+
+def _acquire():
+    buffer = buffer_pool.acquire()
+    g.setdefault('upload_buffers', []).append(buffer)
+    return buffer
+
+def _check_length():
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_MB * 2 ** 20:
+        raise UploadError(f'Ảnh quá lớn (tối đa {MAX_UPLOAD_MB:g} MB)', 413)
+
+def _read_raw():
+    _check_length()
+    buffer = _acquire()
+    stream = request.stream
+    with metrics.timed('upload_read'):
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                return buffer
+            buffer.write(chunk)
+
+def _read_multipart():
+    """Stream a multipart body: the "image" file part into a pooled buffer, other parts into fields"""
+    _check_length()
+    boundary = request.mimetype_params.get('boundary')
+    if not boundary:
+        raise UploadError('Thiếu boundary của multipart/form-data')
+    decoder = MultipartDecoder(boundary.encode('latin-1'), int(MAX_UPLOAD_MB * 2 ** 20))
+    stream = request.stream
+    parts, buffer, sink = {}, None, None
+    with metrics.timed('upload_read'):
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_BYTES)
+            try:
+                decoder.receive_data(chunk or None)
+                event = decoder.next_event()
+                while not isinstance(event, (NeedData, Epilogue)):
+                    if isinstance(event, File) and event.name == 'image' and buffer is None:
+                        sink = buffer = _acquire()
+                    elif isinstance(event, (Field, File)):
+                        sink = parts[event.name] = BytesIO()
+                    elif isinstance(event, Data):
+                        sink.write(event.data)
+                    event = decoder.next_event()
+            except RequestEntityTooLarge:
+                raise UploadError('Trường form quá lớn', 413)
+            except ValueError as e:
+                raise UploadError(f'Multipart không hợp lệ: {e}')
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    fields = {name: part.getvalue().decode('utf-8', 'replace') for name, part in parts.items()}
+    return {**request.args.to_dict(), **fields}, buffer
+
+def _decode_base64(image_base64, max_side):
+    """DecodedImage of a base64 string or data URL (None if empty)"""
+    if not image_base64:
+        return None
+    if not isinstance(image_base64, str):
+        raise UploadError('Không thể đọc ảnh')
+    with metrics.timed('base64_decode'):
+        try:
+            image_bytes = base64.b64decode(image_base64[image_base64.find(',') + 1:])
+        except (ValueError, TypeError):
+            raise UploadError('Không thể đọc ảnh')
+    with metrics.timed('decode'):
+        image = decode_for_detection(image_bytes, max_side)
+    if image is None:
+        raise UploadError('Không thể đọc ảnh')
+    return image
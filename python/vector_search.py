@@ -0,0 +1,302 @@
+"""Vectorized similarity search over an album's embeddings.
+
+Two back ends share the same per-photo aggregation, and both take the query
+faces of several coalesced requests (coalescer.py), search them in one call
+and split the hits per request:
+- ``search_matrix_many``: used when FAISS is not installed; every query face
+  is scored against the whole album with a single matrix multiply.
+- ``search_index_many``: FAISS path; returns every hit above the threshold
+  using range search, or an adaptive-k loop for index types without range search.
+
+``search_combined_many`` does the same over a CombinedMatrix of many small
+albums for multi-album search.
+
+Search matrices and indexes may hold compressed vectors (quantization.py);
+their hits near the threshold are re-scored against the exact float32 store.
+"""
+import os
+import numpy as np
+
+from embedding_store import normalize_rows
+from quantization import matrix_precision, quantize, rerank_margin, scores
+
+# Adaptive-k search starts at this k and widens while the k-th hit still passes the threshold
+ADAPTIVE_K_START = int(os.environ.get('ADAPTIVE_K_START', 64))
+ADAPTIVE_K_GROWTH = 4
+# Legacy fixed top-k search (search_mode='topk')
+TOPK_LIMIT = 100
+
+
+class SearchMatrix:
+    """Normalized, RAM-resident matrix of an album's live faces plus row -> photo mapping.
+
+    ``matrix`` is float32, float16 or int8 (with a per-row ``scale``); ``exact``
+    is the album's float32 store (usually memory-mapped) and ``rows`` the store
+    row of each matrix row (None when they are the same), used for re-ranking.
+    """
+    __slots__ = ('matrix', 'photo_codes', 'photo_ids', 'generation', 'scale', 'rows', 'exact')
+
+    def __init__(self, matrix, photo_codes, photo_ids, generation=0, scale=None, rows=None, exact=None):
+        self.matrix = matrix
+        self.photo_codes = photo_codes
+        self.photo_ids = photo_ids
+        self.generation = generation
+        self.scale = scale
+        self.rows = rows
+        self.exact = exact
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.matrix, self.photo_codes, self.scale, self.rows) if array is not None)
+
+
+def build_search_matrix(album, precision=None):
+    """Copy an album's (already normalized) live embeddings into a contiguous search
+    matrix stored at ``precision`` (default: the configured one)"""
+    photo_codes, photo_ids = album.photo_index()
+    rows = None
+    if len(album.deleted_rows):
+        rows = album.live_rows()
+        vectors = album.embeddings[rows]
+        photo_codes = photo_codes[rows]
+    else:
+        vectors = album.embeddings
+    matrix, scale = quantize(vectors, matrix_precision(precision))
+    return SearchMatrix(matrix, photo_codes, photo_ids, album.generation, scale, rows, album.embeddings)
+
+class CombinedMatrix:
+    """Live faces of several small albums stacked into one matrix, so a
+    multi-album search is one matrix multiply instead of one call per album.
+    Columns bounds[i]:bounds[i + 1] belong to album_ids[i]."""
+    __slots__ = ('matrix', 'scale', 'album_ids', 'bounds', 'photo_maps', 'exact_maps')
+
+    def __init__(self, matrix, scale, album_ids, bounds, photo_maps, exact_maps):
+        self.matrix = matrix
+        self.scale = scale
+        self.album_ids = album_ids
+        self.bounds = bounds
+        self.photo_maps = photo_maps  # [(photo_codes, photo_ids)] per album
+        self.exact_maps = exact_maps  # [(rows, exact)] per album, see SearchMatrix
+
+    @property
+    def nbytes(self):
+        nbytes = self.matrix.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+        nbytes += sum(codes.nbytes for codes, _ in self.photo_maps)
+        return nbytes + sum(rows.nbytes for rows, _ in self.exact_maps if rows is not None)
+
+
+def build_combined_matrix(albums):
+    """CombinedMatrix over ``albums`` = [(album_id, AlbumEncodings)]"""
+    parts = [(album_id, build_search_matrix(album)) for album_id, album in albums]
+    if not parts:
+        return CombinedMatrix(np.empty((0, 0), dtype=np.float32), None, [], np.zeros(1, dtype=np.int64), [], [])
+    scales = [part.scale for _, part in parts]
+    return CombinedMatrix(
+        np.concatenate([part.matrix for _, part in parts]),
+        np.concatenate(scales) if scales[0] is not None else None,
+        [album_id for album_id, _ in parts],
+        np.concatenate([[0], np.cumsum([len(part) for _, part in parts])]),
+        [(part.photo_codes, part.photo_ids) for _, part in parts],
+        [(part.rows, part.exact) for _, part in parts]
+    )
+
+def best_similarity_per_photo(rows, similarities, photo_codes, num_photos):
+    """Reduce (row, similarity) hits to the best similarity of each photo.
+
+    Returns (photo_codes, similarities) of the photos that had at least one hit.
+    """
+    best = np.full(num_photos, -np.inf, dtype=np.float32)
+    np.maximum.at(best, photo_codes[rows], similarities)
+    hit_codes = np.flatnonzero(best > -np.inf)
+    return hit_codes, best[hit_codes]
+
+def aggregate_matches(rows, similarities, photo_codes, photo_ids):
+    """Turn raw (row, similarity) hits into one ``{'photo_id', 'similarity'}`` per photo,
+    best similarity kept, sorted by similarity descending"""
+    if len(rows) == 0:
+        return []
+    codes, best = best_similarity_per_photo(rows, similarities, photo_codes, len(photo_ids))
+    order = np.argsort(-best)
+    return [{
+        'photo_id': photo_ids[codes[i]],
+        'similarity': round(float(best[i]), 3)
+    } for i in order]
+
+def expand_aliases(matches, album):
+    """Add the near-duplicate photos folded into each matched photo (embedding_store
+    ``aliases``) right after it, with the same similarity"""
+    if not album.aliases:
+        return matches
+    groups = album.alias_groups()
+    expanded = []
+    for match in matches:
+        expanded.append(match)
+        expanded.extend(dict(match, photo_id=alias) for alias in groups.get(match['photo_id'], ()))
+    return expanded
+
+def _stack_queries(query_sets):
+    """Normalize the query faces of several requests into one matrix.
+
+    Returns (queries, bounds) where rows bounds[i]:bounds[i + 1] belong to set i.
+    """
+    bounds = np.concatenate([[0], np.cumsum([len(query_set) for query_set in query_sets])])
+    queries = normalize_rows([embedding for query_set in query_sets for embedding in query_set])
+    return queries, bounds
+
+def _hits_above(similarities, queries, threshold, margin, rows, exact):
+    """(columns, similarities) of the scores above ``threshold`` in a (num_queries, n) block.
+
+    With ``margin`` > 0 the scores are approximate: those within ``margin`` of
+    the threshold are re-scored against the float32 store rows ``exact[rows[columns]]``.
+    """
+    if margin <= 0:
+        hit_mask = similarities > threshold
+        _, columns = np.nonzero(hit_mask)
+        return columns, similarities[hit_mask]
+    query_rows, columns = np.nonzero(similarities > threshold - margin)
+    hit_similarities = similarities[query_rows, columns]
+    near = hit_similarities <= threshold + margin
+    if near.any():
+        store_rows = columns[near] if rows is None else rows[columns[near]]
+        hit_similarities[near] = np.einsum('ij,ij->i', queries[query_rows[near]], exact[store_rows])
+    keep = hit_similarities > threshold
+    return columns[keep], hit_similarities[keep]
+
+def _rescore_near(hits, queries, query_thresholds, margin, exact):
+    """Re-score FAISS hits within ``margin`` of their query's threshold against the float32 store"""
+    rescored = []
+    for query, threshold, (rows, similarities) in zip(queries, query_thresholds, hits):
+        near = np.abs(similarities - threshold) <= margin
+        if near.any():
+            similarities = similarities.copy()
+            similarities[near] = exact[rows[near]] @ query
+        rescored.append((rows, similarities))
+    return rescored
+
+def search_matrix_many(search_mat, query_sets, thresholds):
+    """Score the query faces of several requests against the album in one matrix multiply.
+
+    Returns one (matches, max_similarity) per set, where ``matches`` is a list
+    of ``{'photo_id', 'similarity'}`` with one entry per photo (best similarity
+    kept), sorted by similarity descending.
+    """
+    if len(search_mat) == 0:
+        return [([], 0.0) for _ in query_sets]
+
+    queries, bounds = _stack_queries(query_sets)
+    all_similarities = scores(queries, search_mat.matrix, search_mat.scale)  # (num_queries, num_faces)
+    margin = rerank_margin(search_mat.matrix.dtype)
+    results = []
+    for i, threshold in enumerate(thresholds):
+        similarities = all_similarities[bounds[i]:bounds[i + 1]]
+        rows, hit_similarities = _hits_above(similarities, queries[bounds[i]:bounds[i + 1]], threshold, margin,
+                                             search_mat.rows, search_mat.exact)
+        matches = aggregate_matches(rows, hit_similarities, search_mat.photo_codes, search_mat.photo_ids)
+        results.append((matches, float(similarities.max())))
+    return results
+
+def adaptive_knn_search_per_query(index, queries, threshold, k_start=None):
+    """Top-k search that widens k only while some query's k-th neighbour is still above threshold.
+
+    Returns [(rows, similarities)], the hits above threshold of each query.
+    """
+    ntotal = index.ntotal
+    k = min(k_start or ADAPTIVE_K_START, ntotal)
+    while True:
+        similarities, rows = index.search(queries, k)
+        if k >= ntotal or not (similarities[:, -1] > threshold).any():
+            break
+        k = min(k * ADAPTIVE_K_GROWTH, ntotal)
+    hit_mask = (similarities > threshold) & (rows >= 0)
+    return [(rows[i][hit_mask[i]], similarities[i][hit_mask[i]]) for i in range(len(queries))]
+
+def range_search_per_query(index, queries, threshold):
+    """Every indexed vector with inner product above threshold, per query.
+
+    Falls back to adaptive k-NN for index types that do not implement range
+    search (e.g. HNSW). Returns [(rows, similarities)], one per query.
+    """
+    try:
+        lims, similarities, rows = index.range_search(queries, threshold)
+    except RuntimeError:
+        return adaptive_knn_search_per_query(index, queries, threshold)
+    return [(rows[lims[i]:lims[i + 1]], similarities[lims[i]:lims[i + 1]]) for i in range(len(queries))]
+
+def range_search(index, queries, threshold):
+    """Returns (rows, similarities) of every hit above threshold, for any of the queries"""
+    return _concat_hits(range_search_per_query(index, queries, threshold))
+
+def _concat_hits(hits):
+    return np.concatenate([rows for rows, _ in hits]), np.concatenate([similarities for _, similarities in hits])
+
+def search_index_many(index, album, query_sets, thresholds, mode='range', margin=0.0):
+    """Search a FAISS index built over ``album``'s rows for several requests at once.
+
+    One FAISS call covers all their query faces at the lowest threshold; hits
+    are then split per request and filtered by its own threshold. ``mode`` is
+    ``'range'`` (every hit above threshold) or ``'topk'`` (legacy fixed
+    top-100 per query). ``margin`` > 0 marks the index scores as approximate
+    (compressed vectors): hits that close to the threshold are re-scored
+    exactly. Returns one (matches, max_similarity) per set like ``search_matrix_many``.
+    """
+    if index is None or index.ntotal == 0:
+        return [([], 0.0) for _ in query_sets]
+
+    queries, bounds = _stack_queries(query_sets)
+    floor = min(thresholds) - margin
+    top_similarities = None
+    if mode == 'topk':
+        similarities, rows = index.search(queries, min(TOPK_LIMIT, index.ntotal))
+        top_similarities = similarities[:, 0]
+        hit_mask = (similarities > floor) & (rows >= 0)
+        hits = [(rows[i][hit_mask[i]], similarities[i][hit_mask[i]]) for i in range(len(queries))]
+    else:
+        hits = range_search_per_query(index, queries, floor)
+    if margin > 0:
+        hits = _rescore_near(hits, queries, np.repeat(thresholds, np.diff(bounds)), margin, album.embeddings)
+
+    photo_codes, photo_ids = album.photo_index()
+    results = []
+    for i, threshold in enumerate(thresholds):
+        rows, similarities = _concat_hits(hits[bounds[i]:bounds[i + 1]])
+        keep = similarities > threshold
+        if len(album.deleted_rows) and len(rows):
+            # Index types that cannot delete (HNSW) still hold tombstoned rows
+            keep &= ~np.isin(rows, album.deleted_rows)
+        rows, similarities = rows[keep], similarities[keep]
+
+        if len(similarities):
+            max_similarity = float(similarities.max())
+        else:
+            if top_similarities is None:
+                # No hits: a top-1 lookup still reports how close the best face was
+                top_similarities = index.search(queries, 1)[0][:, 0]
+            max_similarity = float(top_similarities[bounds[i]:bounds[i + 1]].max())
+        results.append((aggregate_matches(rows, similarities, photo_codes, photo_ids), max_similarity))
+    return results
+
+def search_combined_many(combined, query_sets, thresholds):
+    """``search_matrix_many`` over a CombinedMatrix: one matrix multiply for every
+    album and query set. Returns one ``{album_id: (matches, max_similarity)}`` per set."""
+    queries, bounds = _stack_queries(query_sets)
+    all_similarities = scores(queries, combined.matrix, combined.scale) if len(combined.matrix) else None
+    margin = rerank_margin(combined.matrix.dtype)
+    results = []
+    for i, threshold in enumerate(thresholds):
+        per_album = {}
+        for a, album_id in enumerate(combined.album_ids):
+            start, end = combined.bounds[a], combined.bounds[a + 1]
+            if start == end:
+                per_album[album_id] = ([], 0.0)
+                continue
+            similarities = all_similarities[bounds[i]:bounds[i + 1], start:end]
+            rows, hit_similarities = _hits_above(similarities, queries[bounds[i]:bounds[i + 1]], threshold, margin,
+                                                 *combined.exact_maps[a])
+            photo_codes, photo_ids = combined.photo_maps[a]
+            per_album[album_id] = (aggregate_matches(rows, hit_similarities, photo_codes, photo_ids),
+                                   float(similarities.max()))
+        results.append(per_album)
+    return results
@@ -0,0 +1,51 @@
+const crypto = require('crypto');
+
+const FACE_API_URL = process.env.FACE_API_URL || 'http://localhost:5001';
+// Several face-api replicas: comma-separated base URLs, the same list (and order-independent
+// ring) as REPLICAS on the Python side. Each album always goes to the same replica.
+const FACE_API_REPLICAS = (process.env.FACE_API_REPLICAS || '')
+  .split(',')
+  .map(url => url.trim().replace(/\/+$/, ''))
+  .filter(Boolean);
+const RING_VNODES = parseInt(process.env.RING_VNODES || '64', 10);
+
+// 32-bit ring position: first 8 hex digits of the MD5 (python/replicas.py ring_hash)
+function ringHash(key) {
+  return parseInt(crypto.createHash('md5').update(String(key)).digest('hex').slice(0, 8), 16);
+}
+
+// Sorted [position, replica] points, vnodes per replica (python/replicas.py HashRing)
+function buildRing(replicas, vnodes = RING_VNODES) {
+  return replicas
+    .flatMap(replica => Array.from({ length: vnodes }, (_, i) => [ringHash(`${replica}#${i}`), replica]))
+    .sort((a, b) => a[0] - b[0] || (a[1] < b[1] ? -1 : a[1] > b[1] ? 1 : 0));
+}
+
+// Replica owning an album on a ring (null if the ring is empty)
+function ringOwner(ring, albumId) {
+  if (ring.length === 0) {
+    return null;
+  }
+  const position = ringHash(albumId);
+  // First point strictly after the album's position, wrapping around
+  let low = 0;
+  let high = ring.length;
+  while (low < high) {
+    const mid = (low + high) >> 1;
+    if (ring[mid][0] <= position) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return ring[low % ring.length][1];
+}
+
+const ring = buildRing(FACE_API_REPLICAS);
+
+// Base URL of the face-api replica serving an album
+function faceApiUrl(albumId) {
+  return ringOwner(ring, albumId) || FACE_API_URL;
+}
+
+module.exports = { FACE_API_URL, FACE_API_REPLICAS, faceApiUrl, buildRing, ringOwner };
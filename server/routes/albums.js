@@ -7,10 +7,10 @@ const { searchLimiter, syncLimiter, passwordLimiter, photosLimiter } = require('
 const { validate, createAlbumSchema, updateAlbumSchema, verifyPasswordSchema, searchSchema } = require('../middleware/validator');
 const { getCache, setCache, deleteCache, CACHE_KEYS, CACHE_TTL } = require('../redis');
 const { addEncodingJob, getEncodingStatus } = require('../queue');
+const { faceApiUrl } = require('../faceApi');
 
 const router = express.Router();
 
-const FACE_API_URL = process.env.FACE_API_URL || 'http://localhost:5001';
 const USE_QUEUE = process.env.USE_QUEUE === 'true';
 
 function extractFolderId(driveLink) {
@@ -104,11 +104,11 @@ async function encodeFacesForAlbum(albumId, photos) {
   
   // Direct call to Face API with timeout
   const controller = new AbortController();
-  const timeoutId = setTimeout(() => controller.abort(), 300000); // 5 minutes timeout for encoding
+  const timeoutId = setTimeout(() => controller.abort(), 30000); // only queues the job, encoding runs in the background
   
   try {
     console.log(`Starting face encoding for album ${albumId} with ${photos.length} photos...`);
-    const response = await fetch(`${FACE_API_URL}/encode-album`, {
+    const response = await fetch(`${faceApiUrl(albumId)}/encode-album`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
@@ -121,8 +121,9 @@ async function encodeFacesForAlbum(albumId, photos) {
       signal: controller.signal
     });
     clearTimeout(timeoutId);
+    // The Face API runs the encode as a background job (progress via /encoding-status)
     const result = await response.json();
-    console.log(`Face encoding completed for album ${albumId}:`, result);
+    console.log(`Face encoding job for album ${albumId}:`, result);
     
     // Invalidate cache
     await deleteCache(CACHE_KEYS.ALBUM_ENCODINGS(albumId));
@@ -147,7 +148,7 @@ async function encodeNewPhotos(albumId, newPhotos) {
   try {
     console.log(`Starting incremental encoding for album ${albumId} with ${newPhotos.length} new photos...`);
     
-    const response = await fetch(`${FACE_API_URL}/encode-incremental`, {
+    const response = await fetch(`${faceApiUrl(albumId)}/encode-incremental`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
@@ -186,7 +187,7 @@ async function removePhotoEncodings(albumId, photoIds) {
   const timeoutId = setTimeout(() => controller.abort(), 60000); // 60s timeout
   
   try {
-    const response = await fetch(`${FACE_API_URL}/remove-photos`, {
+    const response = await fetch(`${faceApiUrl(albumId)}/remove-photos`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
@@ -309,7 +310,7 @@ router.get('/:id/encoding-status', async (req, res) => {
     }
     
     // Fall back to Face API
-    const response = await fetch(`${FACE_API_URL}/encoding-status/${req.params.id}`);
+    const response = await fetch(`${faceApiUrl(req.params.id)}/encoding-status/${req.params.id}`);
     const status = await response.json();
     res.json(status);
   } catch (err) {
@@ -523,14 +524,12 @@ router.post('/:id/search', searchLimiter, validate(searchSchema), async (req, re
   const timeoutId = setTimeout(() => controller.abort(), 60000); // 60s timeout
 
   try {
-    const response = await fetch(`${FACE_API_URL}/search`, {
+    // Gửi ảnh dạng binary (không bọc base64/JSON lần nữa), tham số trên query string
+    const params = new URLSearchParams({ album_id: albumId, threshold: threshold || 0.4 });
+    const response = await fetch(`${faceApiUrl(albumId)}/search?${params}`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        album_id: albumId,
-        image: image,
-        threshold: threshold || 0.4
-      }),
+      headers: { 'Content-Type': 'application/octet-stream' },
+      body: Buffer.from(image.slice(image.indexOf(',') + 1), 'base64'),
       signal: controller.signal
     });
     clearTimeout(timeoutId);
@@ -0,0 +1,26 @@
+// Replica ring parity with python/replicas.py: both sides assert python/tests/ring_vectors.json
+const test = require('node:test');
+const assert = require('node:assert');
+const path = require('path');
+
+const { buildRing, ringOwner } = require('../faceApi');
+const vectors = require(path.join(__dirname, '..', '..', 'python', 'tests', 'ring_vectors.json'));
+
+for (const { replicas, vnodes, owners } of vectors) {
+  test(`ring owners (${replicas.length} replicas, ${vnodes} vnodes)`, () => {
+    const ring = buildRing(replicas, vnodes);
+    for (const [albumId, owner] of Object.entries(owners)) {
+      assert.strictEqual(ringOwner(ring, albumId), owner, `album ${JSON.stringify(albumId)}`);
+    }
+    assert.strictEqual(ringOwner(buildRing([...replicas].reverse(), vnodes), '42'), owners['42']);
+  });
+}
+
+test('numeric album ids hash like strings', () => {
+  const { replicas, vnodes, owners } = vectors[0];
+  assert.strictEqual(ringOwner(buildRing(replicas, vnodes), 7), owners['7']);
+});
+
+test('empty ring has no owner', () => {
+  assert.strictEqual(ringOwner(buildRing([]), '7'), null);
+});
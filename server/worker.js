@@ -2,10 +2,35 @@ require('dotenv').config();
 const { encodingQueue, updateEncodingStatus } = require('./queue');
 const { setCache, deleteCache, CACHE_KEYS, CACHE_TTL } = require('./redis');
 
-const FACE_API_URL = process.env.FACE_API_URL || 'http://localhost:5001';
+const { faceApiUrl } = require('./faceApi');
+
+const JOB_POLL_INTERVAL = 2000;
 
 console.log('🔧 Starting Face Encoding Worker...');
 
+// Poll a Face API encode job until it completes, fails or is cancelled
+async function waitForFaceApiJob(albumId, jobId, onProgress) {
+  while (true) {
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+    let response;
+    try {
+      response = await fetch(`${faceApiUrl(albumId)}/jobs/${jobId}`);
+    } catch (err) {
+      // Face API restarting: the job resumes from its checkpoint, keep polling
+      console.warn(`⚠️ Face API unavailable while polling job ${jobId}: ${err.message}`);
+      continue;
+    }
+    if (response.status === 404) {
+      throw new Error(`Face API job ${jobId} not found`);
+    }
+    const status = await response.json();
+    if (['completed', 'failed', 'cancelled'].includes(status.status)) {
+      return status;
+    }
+    await onProgress(status);
+  }
+}
+
 // Process encoding jobs
 encodingQueue.process(async (job) => {
   const { albumId, photos } = job.data;
@@ -21,7 +46,7 @@ encodingQueue.process(async (job) => {
     });
     
     // Call Python Face API
-    const response = await fetch(`${FACE_API_URL}/encode-album`, {
+    const response = await fetch(`${faceApiUrl(albumId)}/encode-album`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
@@ -33,16 +58,32 @@ encodingQueue.process(async (job) => {
       })
     });
     
-    if (!response.ok) {
-      throw new Error(`Face API error: ${response.status}`);
+    // 202 = new job, 409 = album already encoding: follow that job either way
+    const submitted = await response.json();
+    if (!submitted.job_id) {
+      throw new Error(submitted.error || `Face API error: ${response.status}`);
     }
     
-    const result = await response.json();
+    const result = await waitForFaceApiJob(albumId, submitted.job_id, async (status) => {
+      await updateEncodingStatus(albumId, 'encoding', {
+        total_photos: status.total_photos,
+        processed_photos: status.processed_photos,
+        total_faces: status.total_faces,
+        face_api_job_id: status.job_id
+      });
+      await job.progress(Math.floor(status.progress_percent));
+    });
+    
+    if (result.status !== 'completed') {
+      throw new Error(result.error || `Face API job ${result.status}`);
+    }
+    result.success = true;
+    result.processed = result.processed_photos;
     
     // Cache the encodings
     if (result.success) {
       // Fetch and cache encodings
-      const encodingsResponse = await fetch(`${FACE_API_URL}/get-encodings/${albumId}`);
+      const encodingsResponse = await fetch(`${faceApiUrl(albumId)}/get-encodings/${albumId}`);
       if (encodingsResponse.ok) {
         const encodings = await encodingsResponse.json();
         await setCache(